@@ -5,6 +5,7 @@ import hashlib
 
 from ckanext.dgu.drupalclient import DrupalClient, DrupalXmlRpcSetupError, \
      DrupalRequestError
+from ckanext.dgu.authentication.drupal_cache import DrupalLookupCache
 from xmlrpclib import ServerProxy
 
 log = logging.getLogger(__name__)
@@ -23,6 +24,14 @@ class DrupalAuthMiddleware(object):
         self.seconds_between_checking_drupal_cookie = int(minutes_between_checking_drupal_cookie) * 60
         # if that int() raises a ValueError then the app will not start
 
+        # Drupal's answers about sessions and users are cached (shared
+        # between processes) if drupal_cache_filepath is configured
+        drupal_cache_filepath = app_conf.get('drupal_cache_filepath') if app_conf else None
+        self.drupal_cache = DrupalLookupCache(drupal_cache_filepath) \
+            if drupal_cache_filepath else None
+        self.seconds_to_cache_drupal_lookups = int((app_conf.get('seconds_to_cache_drupal_lookups') if app_conf else None) or 300)
+        self.seconds_to_cache_invalid_drupal_sessions = int((app_conf.get('seconds_to_cache_invalid_drupal_sessions') if app_conf else None) or 60)
+
     def _parse_cookies(self, environ):
         is_ckan_cookie = [False]
         drupal_session_id = [False]
@@ -187,11 +196,9 @@ class DrupalAuthMiddleware(object):
         the equivalent CKAN user with properties copied from Drupal and log the
         person in with auth_tkt and its cookie.
         '''
-        if self.drupal_client is None:
-            self.drupal_client = DrupalClient()
         # ask drupal for the drupal_user_id for this session
         try:
-            drupal_user_id = self.drupal_client.get_user_id_from_session_id(drupal_session_id)
+            drupal_user_id = self._get_user_id_from_session_id(drupal_session_id)
         except DrupalRequestError, e:
             log.error('Error checking session with Drupal: %s', e)
             return
@@ -200,34 +207,25 @@ class DrupalAuthMiddleware(object):
             return
 
         # ask drupal about this user
-        drupal_user_properties = self.drupal_client.get_user_properties(drupal_user_id)
+        drupal_user_properties = self._get_user_properties(drupal_user_id)
         user_dict = DrupalUserMapping.drupal_user_to_ckan_user(
                 drupal_user_properties)
-
-        # see if user already exists in CKAN
         ckan_user_name = user_dict['name']
-        from ckan import model
-        from ckan.model.meta import Session
-        query = Session.query(model.User).filter_by(name=unicode(ckan_user_name))
-        if not query.count():
-            # need to add this user to CKAN
-            user = model.User(**user_dict)
-            Session.add(user)
-            Session.commit()
-            log.debug('Drupal user added to CKAN as: %s', user.name)
+        drupal_roles = drupal_user_properties['roles'].values()
+
+        # The CKAN user only needs updating if the Drupal details have
+        # changed since it was last done
+        fingerprint = DrupalLookupCache.fingerprint((user_dict, drupal_roles))
+        if self.drupal_cache and self.drupal_cache.get(
+                DrupalLookupCache.synced_key(ckan_user_name)) == (True, fingerprint):
+            log.debug('Drupal user unchanged since last synced: %s', ckan_user_name)
+            user_name = ckan_user_name
         else:
-            user = query.one()
-            log.debug('Drupal user found in CKAN: %s', user.name)
-
-            if user.email != user_dict['email'] or \
-                    user.fullname != user_dict['name']:
-                user.email = user_dict['email']
-                user.fullname = user_dict['fullname']
-                log.debug('User details updated from Drupal: %s %s',
-                          user.email, user.fullname)
-                model.Session.commit()
-
-        self.set_roles(ckan_user_name, drupal_user_properties['roles'].values())
+            user_name = self._sync_user(user_dict, drupal_roles)
+            if self.drupal_cache:
+                self.drupal_cache.set(DrupalLookupCache.synced_key(ckan_user_name),
+                                      fingerprint,
+                                      self.seconds_to_cache_drupal_lookups)
 
         # There is a chance that on this request we needed to get authtkt
         # to log-out. This would have created headers like this:
@@ -250,8 +248,76 @@ class DrupalAuthMiddleware(object):
             new_headers.extend(headers)
 
         # Tell app during this request that the user is logged in
-        environ['REMOTE_USER'] = user.name
-        log.debug('Set REMOTE_USER = %r', user.name)
+        environ['REMOTE_USER'] = user_name
+        log.debug('Set REMOTE_USER = %r', user_name)
+
+    def _get_drupal_client(self):
+        if self.drupal_client is None:
+            self.drupal_client = DrupalClient()
+        return self.drupal_client
+
+    def _get_user_id_from_session_id(self, drupal_session_id):
+        '''Asks Drupal (or the cache) for the user id of the session. Returns
+        None if the session is not valid, which is also cached, for a
+        shorter time.'''
+        if self.drupal_cache:
+            key = DrupalLookupCache.session_key(drupal_session_id)
+            found, drupal_user_id = self.drupal_cache.get(key)
+            if found:
+                log.debug('Drupal session found in cache')
+                return drupal_user_id
+        drupal_user_id = self._get_drupal_client()\
+            .get_user_id_from_session_id(drupal_session_id)
+        if self.drupal_cache:
+            self.drupal_cache.set(
+                key, drupal_user_id,
+                self.seconds_to_cache_drupal_lookups if drupal_user_id
+                else self.seconds_to_cache_invalid_drupal_sessions)
+        return drupal_user_id
+
+    def _get_user_properties(self, drupal_user_id):
+        '''Asks Drupal (or the cache) for the user's properties.'''
+        if self.drupal_cache:
+            key = DrupalLookupCache.user_key(drupal_user_id)
+            found, properties = self.drupal_cache.get(key)
+            if found:
+                log.debug('Drupal user found in cache: %s', drupal_user_id)
+                return properties
+        properties = self._get_drupal_client().get_user_properties(drupal_user_id)
+        if self.drupal_cache:
+            self.drupal_cache.set(key, properties,
+                                  self.seconds_to_cache_drupal_lookups)
+        return properties
+
+    def _sync_user(self, user_dict, drupal_roles):
+        '''Creates or updates the CKAN user with the details from Drupal, and
+        sets its roles. Returns the CKAN user name.'''
+        # see if user already exists in CKAN
+        ckan_user_name = user_dict['name']
+        from ckan import model
+        from ckan.model.meta import Session
+        query = Session.query(model.User).filter_by(name=unicode(ckan_user_name))
+        if not query.count():
+            # need to add this user to CKAN
+            user = model.User(**user_dict)
+            Session.add(user)
+            Session.commit()
+            log.debug('Drupal user added to CKAN as: %s', user.name)
+        else:
+            user = query.one()
+            log.debug('Drupal user found in CKAN: %s', user.name)
+
+            if user.email != user_dict['email'] or \
+                    user.fullname != user_dict['name']:
+                user.email = user_dict['email']
+                user.fullname = user_dict['fullname']
+                log.debug('User details updated from Drupal: %s %s',
+                          user.email, user.fullname)
+                model.Session.commit()
+        user_name = user.name
+
+        self.set_roles(ckan_user_name, drupal_roles)
+        return user_name
 
     def set_roles(self, user_name, drupal_roles):
         '''Sets CKAN user roles based on the drupal roles.
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class DrupalLookupCache(object):
+    '''A TTL cache of lookups made to Drupal, kept in a local SQLite file so
+    that it is shared by all the worker processes on the server.
+
+    Entries are stored as JSON. When it grows beyond max_entries, the
+    entries closest to expiry are dropped.'''
+
+    def __init__(self, filepath, max_entries=10000):
+        self.filepath = filepath
+        self.max_entries = max_entries
+        # sqlite connections can't be shared between threads
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute('''CREATE TABLE IF NOT EXISTS drupal_cache (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            expires REAL NOT NULL)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS drupal_cache_expires '
+                     'ON drupal_cache (expires)')
+        conn.commit()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # other processes may hold the write lock briefly
+            conn = sqlite3.connect(self.filepath, timeout=5)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        '''Returns (found, value). A cached value can be None, e.g. to
+        remember that a session is invalid.'''
+        try:
+            row = self._connection().execute(
+                'SELECT value FROM drupal_cache WHERE key=? AND expires>?',
+                (key, time.time())).fetchone()
+        except sqlite3.Error, e:
+            log.warning('Drupal cache could not be read: %s', e)
+            return False, None
+        if row is None:
+            return False, None
+        return True, json.loads(row[0])
+
+    def set(self, key, value, seconds):
+        conn = self._connection()
+        try:
+            conn.execute('INSERT OR REPLACE INTO drupal_cache VALUES (?, ?, ?)',
+                         (key, json.dumps(value, default=unicode),
+                          time.time() + seconds))
+            (count,) = conn.execute(
+                'SELECT count(*) FROM drupal_cache').fetchone()
+            if count > self.max_entries:
+                count -= conn.execute('DELETE FROM drupal_cache WHERE expires<?',
+                                      (time.time(),)).rowcount
+                if count > self.max_entries:
+                    conn.execute(
+                        '''DELETE FROM drupal_cache WHERE key IN (
+                             SELECT key FROM drupal_cache ORDER BY expires
+                             LIMIT ?)''', (count - self.max_entries,))
+            conn.commit()
+        except sqlite3.Error, e:
+            log.warning('Drupal cache could not be written: %s', e)
+            conn.rollback()
+
+    def delete(self, key):
+        conn = self._connection()
+        try:
+            conn.execute('DELETE FROM drupal_cache WHERE key=?', (key,))
+            conn.commit()
+        except sqlite3.Error, e:
+            log.warning('Drupal cache could not be written: %s', e)
+            conn.rollback()
+
+    @staticmethod
+    def session_key(drupal_session_id):
+        # Session ids are as good as passwords, so are not stored as they are
+        return 'session:%s' % hashlib.sha256(drupal_session_id).hexdigest()
+
+    @staticmethod
+    def user_key(drupal_user_id):
+        return 'user:%s' % drupal_user_id
+
+    @staticmethod
+    def synced_key(ckan_user_name):
+        return 'synced:%s' % ckan_user_name
+
+    @staticmethod
+    def realname_key(drupal_user_id):
+        return 'realname:%s' % drupal_user_id
+
+    @staticmethod
+    def fingerprint(obj):
+        '''A hash of some JSON-serializable details, to tell if they have
+        changed.'''
+        return hashlib.sha1(json.dumps(obj, sort_keys=True,
+                                       default=unicode)).hexdigest()
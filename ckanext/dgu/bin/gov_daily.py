@@ -9,6 +9,7 @@ import datetime
 import re
 import urllib2
 import json
+import multiprocessing
 
 from common import load_config, register_translator
 
@@ -36,6 +37,7 @@ def command(config_file):
                                DumpAnalysis)
 
     from pylons import config
+    from paste.deploy.converters import asbool
 
     # settings
     ckan_instance_name = os.path.basename(config_file).replace('.ini', '')
@@ -44,12 +46,14 @@ def command(config_file):
         default_analysis_dir = '/var/lib/ckan/%s/static/dump_analysis' % ckan_instance_name
         default_backup_dir = '/var/backups/ckan/%s' % ckan_instance_name
         default_openspending_reports_dir = '/var/lib/ckan/%s/openspending_reports' % ckan_instance_name
+        default_dump_store_filepath = '/var/lib/ckan/%s/dump_store.sqlite' % ckan_instance_name
     else:
         # test purposes
         default_dump_dir = '~/dump'
         default_analysis_dir = '~/dump_analysis'
         default_backup_dir = '~/backups'
         default_openspending_reports_dir = '~/openspending_reports'
+        default_dump_store_filepath = '~/dump_store.sqlite'
     dump_dir = os.path.expanduser(config.get('ckan.dump_dir',
                                              default_dump_dir))
     analysis_dir = os.path.expanduser(config.get('ckan.dump_analysis_dir',
@@ -65,7 +69,11 @@ def command(config_file):
                                'data.gov.uk-analysis')
     backup_filebase = config.get('ckan.backup_filename_base',
                                  ckan_instance_name + '.%Y-%m-%d.pg_dump')
-    tmp_filepath = config.get('ckan.temp_filepath', '/tmp/dump.tmp')
+    dump_processes = int(config.get('ckan.dump_processes',
+                                    multiprocessing.cpu_count()))
+    dump_incremental = asbool(config.get('ckan.dump_incremental', False))
+    dump_store_filepath = os.path.expanduser(config.get('ckan.dump_store_filepath',
+                                                        default_dump_store_filepath))
     openspending_reports_url = config.get('ckan.openspending_reports_url',
                                           'http://data.etl.openspending.org/uk25k/report/')
 
@@ -193,48 +201,59 @@ def command(config_file):
         logging.getLogger("MARKDOWN").setLevel(logging.WARN)
 
 
-        # Explicitly dump the packages and resources to their respective CSV files
-        # before zipping them up and moving them into position.
+        # Dump the packages and resources to their respective CSV files,
+        # streaming them straight into the zip.
         import ckanext.dgu.lib.dumper as dumperlib
 
         dump_filepath = os.path.join(dump_dir, dump_file_base + '.csv.zip')
 
-        log.info('Creating CSV files: %s' % dump_filepath)
-        dumpobj = dumperlib.CSVDumper()
-        dumpobj.dump()
-
-        dataset_file, resource_file = dumpobj.close()
-
-        log.info('Dumped datasets file is %dMb in size' % (os.path.getsize(dataset_file) / (1024*1024)))
-        log.info('Dumped resources file is %dMb in size' % (os.path.getsize(resource_file) / (1024*1024)))
+        if dump_incremental:
+            # Only re-render the datasets that changed since the last dump
+            from ckanext.dgu.lib.incremental_dumper import IncrementalDumper
+            log.info('Updating incremental dump store: %s' % dump_store_filepath)
+            incremental_dumper = IncrementalDumper(dump_store_filepath)
+            incremental_dumper.update()
 
+        log.info('Creating CSV files: %s' % dump_filepath)
         dump_file = zipfile.ZipFile(dump_filepath, 'w', zipfile.ZIP_DEFLATED)
-        dump_file.write(dataset_file, "datasets.csv")
-        dump_file.write(resource_file, "resources.csv")
+        dataset_file = dumperlib.ZipMemberWriter(dump_file, "datasets.csv")
+        # resources.csv is written alongside datasets.csv, so it is spooled
+        # (compressed) until datasets.csv is finished
+        resource_file = dumperlib.ZipMemberWriter(dump_file, "resources.csv",
+                                                  spool=True)
+        if dump_incremental:
+            incremental_dumper.write_csv(dataset_file, resource_file)
+        else:
+            dumpobj = dumperlib.CSVDumper(dataset_file, resource_file)
+            dumpobj.dump(processes=dump_processes)
+            dumpobj.close()
         dump_file.close()
 
+        log.info('Dumped datasets file is %dMb in size' % (dataset_file.file_size / (1024*1024)))
+        log.info('Dumped resources file is %dMb in size' % (resource_file.file_size / (1024*1024)))
+
         link_filepath = os.path.join(dump_dir, "data.gov.uk-ckan-meta-data-latest.csv.zip")
 
         if os.path.exists(link_filepath):
             os.unlink(link_filepath)
         os.symlink(dump_filepath, link_filepath)
-        os.remove(dataset_file)
-        os.remove(resource_file)
 
         # Dump the json and unpublished csv to the usual place.
-        for file_type, dumper_ in (('json', dumper.SimpleDumper().dump_json),
-                                  ('unpublished.csv', inventory_dumper),
-                                 ):
+        if dump_incremental:
+            dumpers = (('json', incremental_dumper.write_json),
+                       ('unpublished.csv', incremental_dumper.write_unpublished))
+        else:
+            dumpers = (('json', lambda f: dumper.SimpleDumper().dump_json(f, query)),
+                       ('unpublished.csv', lambda f: inventory_dumper(f, query)))
+        for file_type, dumper_ in dumpers:
             dump_filename = '%s.%s' % (dump_file_base, file_type)
             dump_filepath = os.path.join(dump_dir, dump_filename + '.zip')
-            tmp_file = open(tmp_filepath, 'w+b')
             log.info('Creating %s file: %s' % (file_type, dump_filepath))
-            dumper_(tmp_file, query)
-            tmp_file.close()
-            log.info('Dumped data file is %dMb in size' % (os.path.getsize(tmp_filepath) / (1024*1024)))
             dump_file = zipfile.ZipFile(dump_filepath, 'w', zipfile.ZIP_DEFLATED)
-            dump_file.write(tmp_filepath, dump_filename)
+            with dumperlib.ZipMemberWriter(dump_file, dump_filename) as member_file:
+                dumper_(member_file)
             dump_file.close()
+            log.info('Dumped data file is %dMb in size' % (member_file.file_size / (1024*1024)))
 
             # Setup a symbolic link to dump_filepath from data.gov.uk-ckan-meta-data-latest.{0}.zip
             # so that it is up-to-date with the latest version for both JSON and CSV.
@@ -245,7 +264,8 @@ def command(config_file):
                 os.unlink(link_filepath)
             os.symlink(dump_filepath, link_filepath)
 
-            os.remove(tmp_filepath)
+        if dump_incremental:
+            incremental_dumper.close()
         report_time_taken(log)
 
     # Dump analysis
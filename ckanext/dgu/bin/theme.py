@@ -74,7 +74,7 @@ def get_freq_dist(package_options, level):
 
 
 def categorize(options, test=False):
-    from ckanext.dgu.lib.theme import categorize_package2, PRIMARY_THEME
+    from ckanext.dgu.lib.theme import categorize_packages, PRIMARY_THEME
 
     stats = StatsList()
     stats.report_value_limit = 1000
@@ -95,9 +95,9 @@ def categorize(options, test=False):
 
     themes_to_write = {}  # pkg_name:themes
 
-    for pkg in packages:
+    packages = list(packages)
+    for pkg, themes in zip(packages, categorize_packages(packages, stats)):
         print 'Dataset: %s' % pkg.name
-        themes = categorize_package2(pkg, stats)
         if options.write and not pkg.extras.get(PRIMARY_THEME) and themes:
             themes_to_write[pkg.name] = themes
 
@@ -122,7 +122,7 @@ def write_themes(themes_to_write):
     model.repo.commit_and_remove()
 
 def recategorize(options):
-    from ckanext.dgu.lib.theme import (categorize_package2, PRIMARY_THEME,
+    from ckanext.dgu.lib.theme import (categorize_packages, PRIMARY_THEME,
             SECONDARY_THEMES, Themes)
 
     stats = StatsList()
@@ -149,9 +149,9 @@ def recategorize(options):
 
     themes_to_write = {}  # pkg_name:themes
 
-    for pkg in packages:
+    packages = list(packages)
+    for pkg, themes in zip(packages, categorize_packages(packages)):
         print 'Dataset: %s' % pkg.name
-        themes = categorize_package2(pkg)
         existing_theme = pkg.extras.get(PRIMARY_THEME)
         pkg_identity = '%s (%s)' % (pkg.name, existing_theme)
         if not themes:
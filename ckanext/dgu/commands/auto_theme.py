@@ -0,0 +1,259 @@
+import csv
+import json
+import logging
+import os
+
+from ckan.lib.cli import CkanCommand
+# No other CKAN imports allowed until _load_config is run,
+# or logging is disabled
+
+
+def _categorize_chunk(pkg_dicts):
+    '''Run in the worker processes. Returns the guessed themes of each
+    package as (pkg_id, [theme_score, ...]).'''
+    from ckanext.dgu.lib.theme import categorize_package2
+    return [(pkg_dict['id'], categorize_package2(pkg_dict))
+            for pkg_dict in pkg_dicts]
+
+
+class AutoTheme(CkanCommand):
+    """
+    Guesses the themes of datasets (as bin/theme.py recategorize does, but
+    in bulk), in parallel processes. Changes are written in a revision per
+    batch and listed in a CSV report. Progress is saved to a checkpoint file
+    after every batch, so an interrupted run carries on where it stopped
+    when run again.
+
+    Usage:
+        auto_theme run
+            - guess the themes of all active datasets (or carry on with an
+              interrupted run)
+        auto_theme reset
+            - abandon an interrupted run, so the next run starts again
+    """
+    summary = __doc__.strip().split('\n')[0]
+    usage = '\n' + __doc__
+    max_args = 1
+    min_args = 1
+
+    def __init__(self, name):
+        super(AutoTheme, self).__init__(name)
+        self.parser.add_option('-w', '--write',
+                               action='store_true', dest='write', default=False,
+                               help='Write the theme changes to the datasets')
+        self.parser.add_option('-p', '--processes',
+                               type='int', dest='processes', default=None,
+                               help='Number of worker processes (default: '
+                                    'the number of CPUs)')
+        self.parser.add_option('-b', '--batch-size',
+                               type='int', dest='batch_size', default=500,
+                               help='Number of datasets per batch')
+        self.parser.add_option('--publisher', dest='publisher',
+                               help='Only datasets of this publisher')
+        self.parser.add_option('--uncategorized',
+                               action='store_true', dest='uncategorized',
+                               default=False,
+                               help='Only datasets without a primary theme')
+        self.parser.add_option('--checkpoint', dest='checkpoint',
+                               default='auto_theme_checkpoint.json',
+                               help='Filepath of the checkpoint')
+        self.parser.add_option('--report', dest='report',
+                               default='auto_theme_changes.csv',
+                               help='Filepath of the CSV report of theme '
+                                    'changes')
+
+    def command(self):
+        self._load_config()
+        self.log = logging.getLogger(__name__)
+
+        cmd = self.args[0]
+        if cmd == 'run':
+            self.run()
+        elif cmd == 'reset':
+            for filepath in (self.options.checkpoint, self.options.report):
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+            self.log.info('Checkpoint and report removed')
+        else:
+            print 'Command %s not recognized' % cmd
+            print self.usage
+
+    def _read_checkpoint(self):
+        if not os.path.exists(self.options.checkpoint):
+            return {}
+        with open(self.options.checkpoint) as f:
+            return json.load(f)
+
+    def _write_checkpoint(self, checkpoint):
+        # write then rename, so that a checkpoint is never half-written
+        tmp_filepath = self.options.checkpoint + '.tmp'
+        with open(tmp_filepath, 'w') as f:
+            json.dump(checkpoint, f)
+        os.rename(tmp_filepath, self.options.checkpoint)
+
+    def run(self):
+        '''Themes the datasets, batch by batch, carrying on from the
+        checkpoint if there is one.'''
+        import multiprocessing
+        from ckan import model
+        from ckanext.dgu.lib.theme import (Themes, PRIMARY_THEME,
+                                           SECONDARY_THEMES)
+
+        checkpoint = self._read_checkpoint()
+        if checkpoint:
+            if checkpoint['options'] != self._checkpoint_options():
+                print 'The checkpoint %s was made with different options ' \
+                      '(%r). Run "auto_theme reset" to start again.' % \
+                      (self.options.checkpoint, checkpoint['options'])
+                return
+            self.log.info('Resuming after %i datasets (%i changed)',
+                          checkpoint['done'], checkpoint['changed'])
+        else:
+            checkpoint = {'options': self._checkpoint_options(),
+                          'last_id': None, 'done': 0, 'changed': 0}
+
+        # Load the themes before forking, so the workers inherit them and
+        # don't need the database. Their connections are not shared either.
+        Themes.instance()
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        resuming = checkpoint['last_id'] is not None
+        report_file = open(self.options.report, 'ab' if resuming else 'wb')
+        report = csv.writer(report_file)
+        if not resuming:
+            report.writerow(['name', 'old primary theme', 'new primary theme',
+                             'old secondary themes', 'new secondary themes',
+                             'score', 'reasons'])
+
+        processes = self.options.processes or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes)
+        # a few chunks per worker in each batch keeps them all busy
+        chunk_size = max(1, self.options.batch_size / (processes * 2))
+        try:
+            for pkg_dicts in self._package_batches(checkpoint['last_id']):
+                chunks = [pkg_dicts[i:i + chunk_size]
+                          for i in xrange(0, len(pkg_dicts), chunk_size)]
+                results = {}
+                for chunk_results in pool.map(_categorize_chunk, chunks):
+                    results.update(chunk_results)
+                changes = self._changes(pkg_dicts, results)
+                for pkg_dict, primary, secondary, theme_scores in changes:
+                    row = [pkg_dict['name'],
+                           pkg_dict['extras'].get(PRIMARY_THEME, ''),
+                           primary,
+                           pkg_dict['extras'].get(SECONDARY_THEMES, ''),
+                           secondary or '',
+                           theme_scores[0]['score'],
+                           '; '.join(theme_scores[0]['reasons'])]
+                    report.writerow([v.encode('utf-8')
+                                     if isinstance(v, unicode) else v
+                                     for v in row])
+                if self.options.write and changes:
+                    self._write_changes(changes)
+                report_file.flush()
+                model.Session.remove()
+
+                checkpoint['last_id'] = pkg_dicts[-1]['id']
+                checkpoint['done'] += len(pkg_dicts)
+                checkpoint['changed'] += len(changes)
+                self._write_checkpoint(checkpoint)
+                self.log.info('Themed %i datasets, %i changed',
+                              checkpoint['done'], checkpoint['changed'])
+        finally:
+            pool.close()
+            pool.join()
+            report_file.close()
+        # the run is complete, so the next one starts from the beginning
+        if os.path.exists(self.options.checkpoint):
+            os.remove(self.options.checkpoint)
+        self.log.info('Finished - %i datasets themed, %i changed. See %s',
+                      checkpoint['done'], checkpoint['changed'],
+                      self.options.report)
+
+    def _checkpoint_options(self):
+        '''The options that determine which datasets are done, which a
+        resumed run must share.'''
+        return {'publisher': self.options.publisher,
+                'uncategorized': self.options.uncategorized,
+                'write': self.options.write}
+
+    def _package_batches(self, after_id):
+        '''Yields batches of the datasets to theme, as the dicts that
+        categorize_package2 takes, in order of id, starting after the given
+        id. Only the text needed is got from the database.'''
+        from ckan import model
+        from ckanext.dgu.lib.theme import PRIMARY_THEME, get_tags_and_extras
+
+        q = model.Session.query(model.Package.id, model.Package.name,
+                                model.Package.title, model.Package.notes)\
+                 .filter(model.Package.state == 'active')
+        if self.options.publisher:
+            publisher = model.Group.get(self.options.publisher)
+            assert publisher, 'Publisher not found: %s' % self.options.publisher
+            q = q.filter(model.Package.owner_org == publisher.id)
+        if self.options.uncategorized:
+            themed = model.Session.query(model.PackageExtra.package_id)\
+                          .filter(model.PackageExtra.key == PRIMARY_THEME)\
+                          .filter(model.PackageExtra.value != '')\
+                          .filter(model.PackageExtra.state == 'active')
+            q = q.filter(~model.Package.id.in_(themed))
+        q = q.order_by(model.Package.id)
+
+        while True:
+            # the session is removed after each batch
+            batch_q = q.with_session(model.Session())
+            if after_id:
+                batch_q = batch_q.filter(model.Package.id > after_id)
+            rows = batch_q.limit(self.options.batch_size).all()
+            if not rows:
+                return
+            tags, extras = get_tags_and_extras([row.id for row in rows])
+            yield [{'id': row.id,
+                    'name': row.name,
+                    'title': row.title,
+                    'notes': row.notes,
+                    'tags': tags[row.id],
+                    'extras': extras[row.id]}
+                   for row in rows]
+            after_id = rows[-1].id
+
+    def _changes(self, pkg_dicts, results):
+        '''Returns the datasets whose guessed themes differ from their
+        current ones, as (pkg_dict, primary, secondary, theme_scores).
+        secondary is None if there is no guess for it.'''
+        from ckanext.dgu.lib.theme import PRIMARY_THEME, SECONDARY_THEMES
+
+        changes = []
+        for pkg_dict in pkg_dicts:
+            theme_scores = results[pkg_dict['id']]
+            if not theme_scores:
+                continue
+            primary = theme_scores[0]['name']
+            secondary = json.dumps([theme_scores[1]['name']]) \
+                if len(theme_scores) > 1 else None
+            extras = pkg_dict['extras']
+            if extras.get(PRIMARY_THEME) == primary and \
+                    (secondary is None or
+                     extras.get(SECONDARY_THEMES) == secondary):
+                continue
+            changes.append((pkg_dict, primary, secondary, theme_scores))
+        return changes
+
+    def _write_changes(self, changes):
+        '''Writes the theme changes of a batch in one revision.'''
+        from ckan import model
+        from ckanext.dgu.lib.theme import PRIMARY_THEME, SECONDARY_THEMES
+
+        themes_by_id = dict((pkg_dict['id'], (primary, secondary))
+                            for pkg_dict, primary, secondary, _ in changes)
+        rev = model.repo.new_revision()
+        rev.author = 'autotheme'
+        rev.message = 'Themes guessed by auto_theme'
+        for pkg in model.Session.query(model.Package)\
+                .filter(model.Package.id.in_(themes_by_id.keys())):
+            primary, secondary = themes_by_id[pkg.id]
+            pkg.extras[PRIMARY_THEME] = primary
+            if secondary is not None:
+                pkg.extras[SECONDARY_THEMES] = secondary
+        model.repo.commit_and_remove()
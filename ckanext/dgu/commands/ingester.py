@@ -25,6 +25,9 @@ class Ingester(CkanCommand):
             the named-item.  This should be a value returned from a
             call to list
 
+    Rows are committed in batches and the progress is saved in a checkpoint
+    file, so if a read stops part way through, running it again carries on
+    where it stopped. Errors with rows are listed at the end.
 
     """
     summary = __doc__.strip().split('\n')[0]
@@ -35,6 +38,15 @@ class Ingester(CkanCommand):
 
     def __init__(self, name):
         super(Ingester, self).__init__(name)
+        self.parser.add_option('-b', '--batch-size',
+                               type='int', dest='batch_size', default=100,
+                               help='Number of rows committed at a time')
+        self.parser.add_option('--checkpoint', dest='checkpoint',
+                               help='Filepath of the checkpoint (default: the '
+                                    'filename with ".checkpoint" added)')
+        self.parser.add_option('--errors', dest='errors',
+                               help='Filepath to write a CSV of the errors '
+                                    'with rows to')
 
     def command(self):
         self._load_config()
@@ -101,20 +113,61 @@ class Ingester(CkanCommand):
 
             return True, ""
 
+        import ckan.model as model
+        from ckanext.dgu.model.commitment import Commitment
+        from ckanext.dgu.model.commitment import ODS_ORGS
+
+        # What the rows of the current batch refer to, looked up by
+        # prepare_batch
+        orgs = {}  # name: Group
+        datasets = {}  # name: Package
+        commitments = {}  # (source, dataset_name, text, publisher): Commitment
+
+        def prepare_batch(rows):
+            """
+            Looks up the publishers, datasets and existing commitments of
+            the rows, in a query each.
+            """
+            org_names = set(ODS_ORGS[row[0].strip()] for row in rows
+                            if row[0].strip() in ODS_ORGS)
+            orgs.clear()
+            if org_names:
+                orgs.update((org.name, org) for org in
+                            model.Session.query(model.Group)
+                            .filter(model.Group.name.in_(org_names)))
+
+            dataset_names = set()
+            for row in rows:
+                parts = row[6].strip().split()
+                if parts:
+                    dataset_names.add(self._url_to_dataset_name(parts[0]))
+            datasets.clear()
+            if dataset_names:
+                datasets.update((pkg.name, pkg) for pkg in
+                                model.Session.query(model.Package)
+                                .filter(model.Package.name.in_(dataset_names))
+                                .filter(model.Package.state=='active'))
+
+            sources = set(row[1] for row in rows)
+            commitments.clear()
+            if orgs and sources:
+                for c in model.Session.query(Commitment)\
+                        .filter(Commitment.source.in_(sources))\
+                        .filter(Commitment.publisher.in_(orgs.keys())):
+                    key = (c.source, c.dataset_name, c.commitment_text,
+                           c.publisher)
+                    commitments.setdefault(key, c)
+
         def process_row(row):
             """
             Reads each row and tries to create a new commitment database entry after
             trying to determine if a matching one already exists.
             """
-            import ckan.model as model
-            from ckanext.dgu.model.commitment import Commitment
-            from ckanext.dgu.model.commitment import ODS_ORGS, ODS_LINKS
-
             short_org = row[0].strip()
             org_name = ODS_ORGS.get(short_org, None)
             if not org_name:
                 raise ingest.IngestException("Failed to lookup group {0}".format(short_org), True)
-            org = model.Group.get(org_name)
+            org = orgs.get(org_name)
             if not org:
                 raise ingest.IngestException("Failed to find group {0}".format(org_name), True)
 
@@ -123,9 +176,7 @@ class Ingester(CkanCommand):
             parts = row[6].strip().split()
             if parts:
                 dataset_name = self._url_to_dataset_name(parts[0])
-                dataset = model.Session.query(model.Package)\
-                    .filter(model.Package.name==dataset_name)\
-                    .filter(model.Package.state=='active').first()
+                dataset = datasets.get(dataset_name)
             if not dataset:
                 if parts and parts[0].startswith('http'):
                     dataset = parts[0]
@@ -139,13 +190,12 @@ class Ingester(CkanCommand):
             published  = row[5]
 
             # Delete a record that matches based on source and name
-            c = model.Session.query(Commitment)\
-                .filter(Commitment.source==source)\
-                .filter(Commitment.dataset_name==name)\
-                .filter(Commitment.commitment_text==text)\
-                .filter(Commitment.publisher==org.name).first()
+            key = (source, name, text, org.name)
+            c = commitments.get(key)
             if not c:
                 c = Commitment()
+                # a later row in the batch may match it
+                commitments[key] = c
                 log.info("Creating new commitment")
             else:
                 log.info("Updating existing commitment")
@@ -163,15 +213,9 @@ class Ingester(CkanCommand):
                 c.dataset = dataset
             c.state = 'active'
             model.Session.add(c)
-            model.Session.commit()
 
-        try:
-            ingester = ingest.Ingester(filename)
-            ingester.process(process_row, header_validate, row_validate)
-        except ingest.IngestException, ie:
-            print ie
-            log.exception(ie)
-            return
+        self._ingest(filename, process_row, header_validate, row_validate,
+                     prepare_batch)
 
 
     def core_datasets(self, filename):
@@ -195,20 +239,33 @@ class Ingester(CkanCommand):
 
             return True, ""
 
+        import ckan.model as model
+
+        packages = {}  # name: Package, for the rows of the current batch
+
+        def prepare_batch(rows):
+            """ Looks up the datasets of the rows in one query """
+            names = set(self._url_to_dataset_name(row[2].strip())
+                        for row in rows if row[2].strip())
+            packages.clear()
+            if names:
+                packages.update((pkg.name, pkg) for pkg in
+                                model.Session.query(model.Package)
+                                .filter(model.Package.name.in_(names)))
+
         def process_row(row):
             """
             Reads each row and after working out which dataset it is, sets the core-dataset
             extra to be True.
             """
-            import ckan.model as model
-
             # Validation will catch this later, but for now we will just log the problem.
             if row[2].strip() == '':
                 log.warn(u'Dataset url is required - skipping for now')
                 return
 
             dataset_name = self._url_to_dataset_name(row[2].strip())
-            pkg = model.Package.get(dataset_name)
+            # it may be given by id rather than name
+            pkg = packages.get(dataset_name) or model.Package.get(dataset_name)
             if not pkg:
                 # Complain, but carry on.
                 raise ingest.IngestException("Failed to find package {0}".format(dataset_name), True)
@@ -219,15 +276,31 @@ class Ingester(CkanCommand):
 
             pkg.extras['core-dataset'] = True
             model.Session.add(pkg)
-            model.Session.commit()
-
-        try:
-            ingester = ingest.Ingester(filename)
-            ingester.process(process_row, header_validate, row_validate)
-        except ingest.IngestException, ie:
-            print ie
-            log.exception(ie)
-            return
+
+        self._ingest(filename, process_row, header_validate, row_validate,
+                     prepare_batch)
+
+    def _ingest(self, filename, process_row, header_validate, row_validate,
+                prepare_batch):
+        """
+        Processes the rows of the file in batches, committing each, and
+        prints the report of what happened.
+        """
+        import ckan.model as model
+
+        checkpoint = self.options.checkpoint or filename + '.checkpoint'
+        ingester = ingest.Ingester(filename)
+        report = ingester.process(process_row, header_validate, row_validate,
+                                  prepare_batch=prepare_batch,
+                                  session=model.Session,
+                                  batch_size=self.options.batch_size,
+                                  checkpoint=checkpoint)
+        print report.summary().encode('utf-8')
+        if self.options.errors:
+            report.write_csv(self.options.errors)
+            print 'Errors written to {0}'.format(self.options.errors)
+        if report.aborted:
+            print 'Run the command again to carry on from where it stopped.'
 
 
     def _url_to_dataset_name(self, url):
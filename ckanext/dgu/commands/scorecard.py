@@ -0,0 +1,56 @@
+import logging
+
+from ckan.lib.cli import CkanCommand
+# No other CKAN imports allowed until _load_config is run,
+# or logging is disabled
+
+
+class PublisherScorecardCommand(CkanCommand):
+    """
+    Maintains the publisher scorecards - the resource counts, openness
+    scores, broken links and traffic lights shown for each publisher.
+
+    Usage:
+        publisher_scorecard init
+            - create the publisher_scorecard table
+        publisher_scorecard refresh [publisher_name ...]
+            - recompute the scorecards of all publishers, or just the ones given
+        publisher_scorecard refresh_stale
+            - recompute the scorecards whose datasets have changed since they
+              were last computed (run this regularly, e.g. every few minutes)
+    """
+    summary = __doc__.strip().split('\n')[0]
+    usage = '\n' + __doc__
+    max_args = None
+    min_args = 1
+
+    def command(self):
+        self._load_config()
+        self.log = logging.getLogger(__name__)
+
+        from ckan import model
+        from ckanext.dgu.lib import scorecard
+
+        cmd = self.args[0]
+        if cmd == 'init':
+            import ckanext.dgu.model.publisher_scorecard as scorecard_model
+            scorecard_model.init_tables(model.meta.engine)
+            self.log.info('Publisher scorecard table is setup')
+        elif cmd == 'refresh':
+            publisher_ids = None
+            if len(self.args) > 1:
+                publisher_ids = []
+                for name in self.args[1:]:
+                    publisher = model.Group.get(name)
+                    if not publisher:
+                        print 'Publisher not found: %s' % name
+                        return
+                    publisher_ids.append(publisher.id)
+            scorecard.refresh_scorecards(publisher_ids)
+            self.log.info('Scorecards refreshed')
+        elif cmd == 'refresh_stale':
+            stale_ids = scorecard.refresh_stale_scorecards()
+            self.log.info('Refreshed %i stale scorecards', len(stale_ids))
+        else:
+            print 'Command %s not recognized' % cmd
+            print self.usage
@@ -0,0 +1,70 @@
+import logging
+
+from ckan.lib.cli import CkanCommand
+
+
+class SearchIndexBatch(CkanCommand):
+    """
+    Rebuilds the search index in batches, prefetching the DGU index fields
+    (publisher hierarchy, QA, popularity, schemas) for each batch, rather
+    than looking them up for each dataset in turn.
+
+    Usage:
+        search_index_batch rebuild [package_name_or_id ...]
+            - reindex all active datasets, or just the ones given
+    """
+    summary = __doc__.strip().split('\n')[0]
+    usage = '\n' + __doc__
+    max_args = None
+    min_args = 1
+
+    def __init__(self, name):
+        super(SearchIndexBatch, self).__init__(name)
+        self.parser.add_option('-b', '--batch-size',
+                               type='int', dest='batch_size', default=500,
+                               help='Number of datasets per batch')
+
+    def command(self):
+        self._load_config()
+        self.log = logging.getLogger(__name__)
+
+        cmd = self.args[0]
+        if cmd == 'rebuild':
+            self.rebuild(self.args[1:], self.options.batch_size)
+        else:
+            print 'Command %s not recognized' % cmd
+            print self.usage
+
+    def rebuild(self, package_refs, batch_size):
+        from ckan import model
+        from ckan.lib.search import index_for
+        from ckan.logic import get_action
+        from ckanext.dgu.search_indexing import SearchIndexing
+
+        q = model.Session.query(model.Package.id)\
+                 .filter(model.Package.state == 'active')
+        if package_refs:
+            q = q.filter(model.Package.name.in_(package_refs) |
+                         model.Package.id.in_(package_refs))
+        package_ids = [id_ for (id_,) in q.order_by(model.Package.name)]
+        self.log.info('Reindexing %i datasets in batches of %i',
+                      len(package_ids), batch_size)
+
+        package_index = index_for(model.Package)
+        context = {'model': model, 'session': model.Session,
+                   'ignore_auth': True, 'validate': False,
+                   'use_cache': False}
+        for i in xrange(0, len(package_ids), batch_size):
+            batch_ids = package_ids[i:i + batch_size]
+            with SearchIndexing.batch(batch_ids):
+                for package_id in batch_ids:
+                    pkg_dict = get_action('package_show')(
+                        context.copy(), {'id': package_id})
+                    package_index.update_dict(pkg_dict, defer_commit=True)
+            package_index.commit()
+            # don't let the session accumulate every object loaded
+            model.Session.remove()
+            self.log.info('Reindexed %i/%i',
+                          min(i + batch_size, len(package_ids)),
+                          len(package_ids))
+        self.log.info('Finished reindexing')
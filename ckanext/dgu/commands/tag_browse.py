@@ -0,0 +1,45 @@
+import logging
+
+from ckan.lib.cli import CkanCommand
+# No other CKAN imports allowed until _load_config is run,
+# or logging is disabled
+
+
+class TagBrowseCommand(CkanCommand):
+    """
+    Maintains the tables behind the tag browse pages (/data/tag), which show
+    the tags a letter at a time.
+
+    Usage:
+        tag_browse init
+            - create the tag_letter_count table and the index of tag names
+              for prefix queries
+        tag_browse refresh
+            - recount the tags for each letter (this happens automatically
+              when tags change)
+    """
+    summary = __doc__.strip().split('\n')[0]
+    usage = '\n' + __doc__
+    max_args = 1
+    min_args = 1
+
+    def command(self):
+        self._load_config()
+        self.log = logging.getLogger(__name__)
+
+        from ckan import model
+        from ckanext.dgu.lib import tag_browse
+
+        cmd = self.args[0]
+        if cmd == 'init':
+            import ckanext.dgu.model.tag_letter_count as tag_letter_count_model
+            tag_letter_count_model.init_tables(model.meta.engine)
+            self.log.info('Tag browse tables are setup')
+        elif cmd == 'refresh':
+            tag_browse.clear_letter_counts(model.Session)
+            model.Session.commit()
+            counts = tag_browse.letter_counts()
+            self.log.info('Tags counted: %i', sum(counts.values()))
+        else:
+            print 'Command %s not recognized' % cmd
+            print self.usage
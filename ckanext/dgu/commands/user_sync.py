@@ -47,10 +47,20 @@ class UserSync(CkanCommand):
             users = users.filter(model.User.fullname == user)
         users = users.all()
         log.info('Drupal users in CKAN: %s', len(users))
+        # Request the users from Drupal in parallel
+        drupal_user_ids = [DrupalUserMapping.ckan_user_name_to_drupal_id(user.name)
+                           for user in users]
+        errors = {}
+        drupal_users = drupal.get_users_properties(drupal_user_ids,
+                                                   errors=errors)
+        log.info('Drupal users retrieved: %s errors: %s',
+                 len(drupal_users), len(errors))
         for user in users:
             drupal_user_id = DrupalUserMapping.ckan_user_name_to_drupal_id(user.name)
             try:
-                drupal_user = drupal.get_user_properties(drupal_user_id)
+                if drupal_user_id in errors:
+                    raise errors[drupal_user_id]
+                drupal_user = drupal_users[drupal_user_id]
             except DrupalRequestError, e:
                 if 'There is no user with ID' in str(e):
                     log.info(stats.add('Removed deleted user',
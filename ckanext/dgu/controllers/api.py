@@ -1,5 +1,6 @@
 import datetime
 import logging
+import time
 import csv
 import StringIO
 
@@ -17,6 +18,14 @@ log = logging.getLogger(__name__)
 
 default_limit = 10
 
+# (limit, published_only): (time, response) for latest_datasets. It is
+# cleared when a dataset is committed (see ApiPlugin).
+_latest_datasets_cache = {}
+LATEST_DATASETS_CACHE_SECONDS = 60
+
+def clear_latest_datasets_cache():
+    _latest_datasets_cache.clear()
+
 
 class DguApiController(ApiController):
 
@@ -32,6 +41,9 @@ class DguApiController(ApiController):
         '''Designed for the dgu home page, shows lists the latest datasets
         that got changed (exluding extra, group and tag changes) with lots
         of details about each dataset.
+
+        The details all come from the search index, and the response is
+        cached briefly, since the home page requests it so often.
         '''
         try:
             limit = int(request.params.get('limit', default_limit))
@@ -40,47 +52,54 @@ class DguApiController(ApiController):
 
         limit = min(100, limit) # max value
 
-        from ckan.lib.search import SearchError
+        cache_key = (limit, bool(published_only))
+        cached = _latest_datasets_cache.get(cache_key)
+        if cached and time.time() - cached[0] < LATEST_DATASETS_CACHE_SECONDS:
+            return self._finish_ok(cached[1])
+
+        from ckan.lib.search import SearchError, query_for
         fq = 'capacity:"public"'
         if published_only:
              fq = fq + ' unpublished:false'
 
         try:
-            # package search
-            context = {'model': model, 'session': model.Session,
-                       'user': 'visitor'}
-            data_dict = {
-                'q':'',
+            # search for just the fields needed - no need for the database
+            query = query_for(model.Package)
+            query.run({
+                'q': '',
                 'fq': fq,
-                'facet':'false',
-                'start':0,
+                'facet': 'false',
+                'start': 0,
                 'rows': limit,
-                'sort': 'metadata_modified desc'
-            }
-            query = get_action('package_search')(context,data_dict)
+                'sort': 'metadata_modified desc',
+                'fl': 'name title notes publisher publisher_title metadata_modified',
+                })
         except SearchError, se:
             log.error('Search error: %s', se)
+            return self._finish_ok([])
 
         pkg_dicts = []
-        for pkg_dict in query['results']:
-            pkg = model.Package.get(pkg_dict['id'])
-            publisher = pkg.get_organization()
-            if publisher:
-                pub_title = publisher.title
-                pub_link = '/publisher/%s' % publisher.name
-            else:
-                pub_title = pub_link = None
-            last_modified = pkg.metadata_modified
+        for doc in query.results:
+            publisher_name = doc.get('publisher')
+            publisher_title = doc.get('publisher_title')
+            if publisher_name and not publisher_title:
+                # indexed before publisher_title was added
+                publisher = model.Group.by_name(publisher_name)
+                publisher_title = publisher.title if publisher else None
+            # Solr dates are like '2014-01-31T12:00:00.123Z'
+            last_modified = (doc.get('metadata_modified') or '').rstrip('Z')
             pkg_dict = OrderedDict((
-                ('name', pkg.name),
-                ('title', pkg.title),
-                ('notes', pkg.notes),
-                ('dataset_link', '/dataset/%s' % pkg.name),
-                ('publisher_title', pub_title),
-                ('publisher_link', pub_link),
-                ('metadata_modified', last_modified.isoformat()),
+                ('name', doc['name']),
+                ('title', doc.get('title')),
+                ('notes', doc.get('notes')),
+                ('dataset_link', '/dataset/%s' % doc['name']),
+                ('publisher_title', publisher_title),
+                ('publisher_link', '/publisher/%s' % publisher_name
+                                   if publisher_name else None),
+                ('metadata_modified', last_modified),
                 ))
             pkg_dicts.append(pkg_dict)
+        _latest_datasets_cache[cache_key] = (time.time(), pkg_dicts)
         return self._finish_ok(pkg_dicts)
 
     def revisions(self):
@@ -92,13 +111,28 @@ class DguApiController(ApiController):
           since-revision-id
           since-timestamp (utc)
           in-the-last-x-minutes
+          continue-from (the continue_from value of a previous response)
+
+        If results_limited is true in the response, then there are more
+        revisions to come - request them with continue-from.
         '''
+        from ckanext.dgu.lib.revisions import changed_package_ids_by_revision
+
         # parse options
         rev_id = request.params.get('since-revision-id')
         since_timestamp = request.params.get('since-timestamp')
         in_the_last_x_minutes = request.params.get('in-the-last-x-minutes')
+        continue_from = request.params.get('continue-from')
         now = datetime.datetime.utcnow()
-        if rev_id is not None:
+        after_rev_id = None
+        if continue_from is not None:
+            try:
+                since_timestamp, after_rev_id = continue_from.split(',', 1)
+                since_timestamp = datetime.datetime.strptime(
+                    since_timestamp, '%Y-%m-%dT%H:%M:%S.%f')
+            except ValueError:
+                abort(400, 'Could not parse continue-from "%s"' % continue_from)
+        elif rev_id is not None:
             rev = model.Session.query(model.Revision).get(rev_id)
             if not rev:
                 abort(400, 'Revision ID "%s" does not exist' % rev_id)
@@ -117,7 +151,7 @@ class DguApiController(ApiController):
             since_timestamp = now - \
                          datetime.timedelta(minutes=in_the_last_x_minutes)
         else:
-            abort(400, 'Must specify revisions parameter. It must be one from: since-revision-id since-timestamp in-the-last-x-minutes')
+            abort(400, 'Must specify revisions parameter. It must be one from: since-revision-id since-timestamp in-the-last-x-minutes continue-from')
 
         # limit is higher if sysadmin
         if is_sysadmin():
@@ -125,82 +159,71 @@ class DguApiController(ApiController):
         else:
             max_limit = 50
 
-        # Get the revisions in the requested time frame
-        revs = model.Session.query(model.Revision) \
-               .filter(model.Revision.timestamp >= since_timestamp) \
-               .order_by(model.Revision.timestamp.asc()) \
-               .limit(max_limit) \
-               .all()
+        # Get the revisions in the requested time frame. They are ordered by
+        # id as well as timestamp, so that continue-from can pick up exactly
+        # where the previous response finished.
+        revs = model.Session.query(model.Revision)
+        if after_rev_id is None:
+            revs = revs.filter(model.Revision.timestamp >= since_timestamp)
+        else:
+            revs = revs.filter(
+                (model.Revision.timestamp > since_timestamp) |
+                ((model.Revision.timestamp == since_timestamp) &
+                 (model.Revision.id > after_rev_id)))
+        revs = revs.order_by(model.Revision.timestamp.asc(),
+                             model.Revision.id.asc()) \
+                   .limit(max_limit) \
+                   .all()
+        results_limited = len(revs) == max_limit
+
+        # See which packages have changed in these revisions - all in one
+        # query. Stop before the revision that takes the number of datasets
+        # over the limit (but always include the first revision).
+        package_ids_by_revision = changed_package_ids_by_revision(
+            [rev.id for rev in revs])
+        changed_package_ids = set()
+        for i, rev in enumerate(revs):
+            rev_package_ids = package_ids_by_revision.get(rev.id, set())
+            if i and len(changed_package_ids | rev_package_ids) > max_limit:
+                revs = revs[:i]
+                results_limited = True
+                break
+            changed_package_ids |= rev_package_ids
+
         result = OrderedDict((
             ('number_of_revisions', len(revs)),
             ('since_timestamp', since_timestamp.strftime('%Y-%m-%d %H:%M')),
             ('current_timestamp', now.strftime('%Y-%m-%d %H:%M')),
             ('since_revision_id', revs[0].id if revs else None),
             ('newest_revision_id', revs[-1].id if revs else None),
-            ('results_limited', len(revs) == max_limit)))
+            ('results_limited', results_limited)))
+        if results_limited:
+            result['continue_from'] = '%s,%s' % (
+                revs[-1].timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+                revs[-1].id)
 
-        # See which packages have changed in the time frame
-        changed_package_ids = set()
-        query = model.Session.query(model.PackageRevision) \
-                .join(model.Revision) \
-                .filter(model.Revision.timestamp >= since_timestamp) \
-                .limit(max_limit)
-        if query.count() == max_limit:
-            result['results_limited'] = True
-        changed_package_ids.update([pkg_rev.id for pkg_rev in query.all()])
-
-        if not result['results_limited']:
-            for related_type in (model.PackageTagRevision,
-                                 model.PackageExtraRevision):
-                query = model.Session.query(related_type) \
-                        .join(model.Revision) \
-                        .filter(model.Revision.timestamp >= since_timestamp) \
-                        .limit(max_limit)
-                res = query.all()
-                if len(res) == max_limit:
-                    result['results_limited'] = True
-                changed_package_ids.update([obj_rev.package_id \
-                                            for obj_rev in res])
-
-        if not result['results_limited']:
-            query = model.Session.query(model.ResourceRevision) \
-                    .join(model.Revision) \
-                    .filter(model.Revision.timestamp >= since_timestamp) \
-                    .join(model.ResourceGroup,
-                          model.ResourceRevision.resource_group_id == model.ResourceGroup.id) \
-                    .limit(max_limit)
-            res = query.all()
-            if len(res) == max_limit:
-                result['results_limited'] = True
-            changed_package_ids.update([obj_rev.resource_group.package_id \
-                                        for obj_rev in res])
-
-        if not result['results_limited']:
-            query = model.Session.query(model.MemberRevision) \
-                    .filter_by(table_name='package') \
-                    .join(model.Revision) \
-                    .filter(model.Revision.timestamp >= since_timestamp) \
-                    .limit(max_limit)
-            res = query.all()
-            if len(res) == max_limit:
-                result['results_limited'] = True
-            changed_package_ids.update([obj_rev.table_id for obj_rev in res])
-
-        # due to corrupt old obj revision tables, some package_ids may be blank
-        changed_package_ids.discard(None)
-
-        result['datasets'] = [self._mini_pkg_dict(pkg_id) for pkg_id in changed_package_ids]
+        result['datasets'] = self._mini_pkg_dicts(changed_package_ids)
         return self._finish_ok(result)
 
-    def _mini_pkg_dict(self, pkg_id):
-        '''For a package id, return the basic details for the package in a
-        dictionary.
-        Quite expensive - does two database lookups - so be careful with running it
-        lots of times.
+    def _mini_pkg_dicts(self, pkg_ids):
+        '''For some package ids, return the basic details for each package in
+        a dictionary. The packages and their publishers are got in one
+        query.
+        '''
+        if not pkg_ids:
+            return []
+        rows = model.Session.query(model.Package, model.Group) \
+                    .outerjoin(model.Group,
+                               model.Group.id == model.Package.owner_org) \
+                    .filter(model.Package.id.in_(pkg_ids)) \
+                    .order_by(model.Package.name)
+        return [self._mini_pkg_dict(pkg, pub) for pkg, pub in rows]
+
+    def _mini_pkg_dict(self, pkg, pub):
+        '''For a package and its publisher, return the basic details for the
+        package in a dictionary.
         '''
-        pkg = model.Session.query(model.Package).get(pkg_id)
-        pub = pkg.get_organization()
-        return OrderedDict((('id', pkg_id),
+        return OrderedDict((('id', pkg.id),
                             ('name', pkg.name),
                             ('title', pkg.title),
                             ('notes', markdown_extract(pkg.notes)),
@@ -2,10 +2,10 @@ import json
 import logging
 import os
 import pylons
-import re
 import sqlalchemy
 import urlparse
 import datetime
+import email.utils
 import urllib
 import shutil
 import uuid
@@ -13,6 +13,7 @@ import uuid
 from pylons import config
 from ckan.lib.helpers import flash_success, flash_error
 from ckanext.dgu.lib import helpers as dgu_helpers
+from ckanext.dgu.lib import resource_cache as resource_cache_lib
 from ckan.lib.base import BaseController, model, abort, h, redirect
 from ckanext.dgu.plugins_toolkit import request, c, render, _, NotAuthorized, get_action
 
@@ -171,6 +172,34 @@ class DataController(BaseController):
             'dgu.openspending_reports_dir',
             '/var/lib/ckan/dgu/openspending_reports'))
 
+    def nii_report_csv(self):
+        """
+        The NII report as CSV, streamed to the client as the rows are read
+        from the database, rather than built up in the report cache first.
+        """
+        import csv
+        import StringIO
+        from pylons import response
+        from ckanext.dgu.lib.reports import nii_report_csv_rows
+
+        response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+        response.headers['Content-Disposition'] = 'attachment; filename=nii.csv'
+
+        def stream():
+            buf = StringIO.StringIO()
+            writer = csv.writer(buf)
+            try:
+                for row in nii_report_csv_rows():
+                    writer.writerow([v.encode('utf-8') if isinstance(v, unicode)
+                                     else v for v in row])
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+            finally:
+                # this runs after the request's session has been removed
+                model.Session.remove()
+        return stream()
+
     def openspending_report(self):
         self._set_openspending_reports_dir()
         c.content = open (c.openspending_report_dir + "/index.html").read()
@@ -237,75 +266,85 @@ class DataController(BaseController):
         is responsible for rendering the data.  When the data to be rendered
         is HTML it will add a header to show that the content is cached, and
         set a <base> header if not present to make sure all relative links are
-        resolved correctly.
+        resolved correctly. The HTML is rewritten as it is streamed out, and
+        kept on disk for the next request (see ckanext.dgu.lib.resource_cache).
         """
         from pylons import response
-        from paste.fileapp import FileApp
         from ckanext.dgu.lib.helpers import tidy_url
-        from ckanext.qa.model import QA
 
         archive_root = pylons.config.get('ckanext-archiver.archive_dir')
         if not archive_root:
             # Bad configuration likely to cause this.
             abort(404, "Could not find archive folder")
 
-        resource = model.Resource.get(resource_id)
-
-        fmt = ""
-        if resource:
-            qa = QA.get_for_resource(resource.id)
-            if qa:
-                fmt = qa.format
-
-        is_html = fmt == "HTML"
-
         filepath = os.path.join(archive_root, root, resource_id, filename).encode('utf-8')
         filepath = urllib.quote(filepath)
         if not os.path.exists(filepath):
             abort(404, "Resource is not cached")
 
-        file_size = os.path.getsize(filepath)
+        if not os.access(filepath, os.R_OK):
+            log.error('Error reading resource cache file: %s', filepath)
+            abort(403, "The system was unable to read this resource from the cache. Admins have been notified")
+
+        fmt, resource_url = resource_cache_lib.resource_format_and_url(resource_id)
+        is_html = fmt == "HTML"
+
         if not is_html:
-            # Content-Type is determined by FileApp based on the extension.
+            # Content-Type is determined by the file extension.
             # Using the format provided by QA isn't an option currently as
             # for zip files it gives the format of the content of the zip.
-            headers = [('Content-Length', str(file_size))]
-            fapp = FileApp(filepath, headers=headers)
-            return fapp(request.environ, self.start_response)
-
-        origin = tidy_url(resource.url)
+            return resource_cache_lib.serve_file(
+                request.environ, self.start_response, filepath)
+
+        # The rewritten page changes with the file and the resource URL
+        key = resource_cache_lib.file_key(filepath, resource_url)
+        etag = resource_cache_lib.etag(key)
+        content_type = 'text/html; charset=utf-8'
+        rewritten_dir = self._get_rewritten_cache_dir()
+        rewritten_filepath = None
+        if rewritten_dir:
+            rewritten_filepath = resource_cache_lib.rewritten_filepath(
+                rewritten_dir, resource_id, filepath, key)
+            if os.path.exists(rewritten_filepath):
+                # already rewritten, so serve it as it is
+                return resource_cache_lib.serve_file(
+                    request.environ, self.start_response, rewritten_filepath,
+                    content_type=content_type, etag_=etag)
+
+        last_modified = os.path.getmtime(filepath)
+        response.headers['ETag'] = etag
+        response.headers['Last-Modified'] = email.utils.formatdate(
+            last_modified, usegmt=True)
+        if resource_cache_lib.is_not_modified(request.environ, etag,
+                                              last_modified):
+            response.status_int = 304
+            return ''
+
+        origin = tidy_url(resource_url)
         parts = urlparse.urlparse(origin)
         url = "{0}://{1}".format(parts.scheme, parts.netloc)
         base_string = "<head><base href='{0}'>".format(url)
 
-        response.headers['Content-Type'] = 'text/html; charset=utf-8'
-        try:
-            f = open(filepath, "r")
-        except IOError:
-            log.error('Error reading resource cache file: %s', filepath)
-            abort(403, "The system was unable to read this resource from the cache. Admins have been notified")
-
-        content = f.read()
-        f.close()
-
-        if not re.search("<base ", content, re.IGNORECASE):
-            compiled_head = re.compile(re.escape("<head>"), re.IGNORECASE)
-            content = compiled_head.sub( base_string, content, re.IGNORECASE)
-
-        if not '__archiver__cache__header__' in content:
-            # We should insert our HTML block at the bottom of the page with
-            # the appropriate CSS to render it at the top.  Easier to insert
-            # before </body>.
-            c.url = resource.url
-            replacement = render("data/cache_header.html")
-            try:
-                compiled_body = re.compile(re.escape("</body>"), re.IGNORECASE)
-                content = compiled_body.sub( "{0}</body>".format(replacement), content, re.IGNORECASE)
-            except Exception, e:
-                log.warn("Failed to do the replacement in resource<{0}> and file: {1}".format(resource.id, filepath))
-                return
-
-        response.write(content)
+        # We should insert our HTML block at the bottom of the page with
+        # the appropriate CSS to render it at the top.  Easier to insert
+        # before </body>.
+        c.url = resource_url
+        header = render("data/cache_header.html").encode('utf-8')
+
+        response.headers['Content-Type'] = content_type
+        if rewritten_filepath:
+            return resource_cache_lib.rewrite_and_keep(
+                filepath, rewritten_filepath, base_string, header)
+        return resource_cache_lib.rewrite_html(filepath, base_string, header)
+
+    def _get_rewritten_cache_dir(self):
+        '''Where the rewritten HTML pages of the resource cache are kept.
+        Defaults to a directory in the cache_dir.'''
+        rewritten_dir = pylons.config.get('dgu.rewritten_cache_dir')
+        if not rewritten_dir and pylons.config.get('cache_dir'):
+            rewritten_dir = os.path.join(pylons.config['cache_dir'],
+                                         'resource_cache_rewritten')
+        return rewritten_dir
 
     def viz_upload(self):
         """
@@ -1,6 +1,7 @@
 import os
 import csv
 import json
+import StringIO
 from urllib import urlencode
 
 from pylons import response, config
@@ -159,6 +160,7 @@ class InventoryController(BaseController):
 
         c.task = root
         c.task.packages = None
+        c.progress = None
 
         for t in tasks:
             # Looks for a completed version with errors and stuff
@@ -170,6 +172,9 @@ class InventoryController(BaseController):
 
                 if t.value:
                     c.task.packages = json.loads(t.value)
+            elif t.key == 'progress' and t.value:
+                # e.g. {"total": 200, "processed": 50}
+                c.progress = json.loads(t.value)
 
         return render('inventory/status.html')
 
@@ -304,16 +309,30 @@ class InventoryController(BaseController):
 
         groups = [c.group]
         if request.params.get('include_sub') == 'true':
-            groups = go_down_tree(c.group)
+            groups = list(go_down_tree(c.group))
 
         # Set the content-disposition so that it downloads the file
         # response.headers['Content-Type'] = "text/plain; charset=utf-8"
         response.headers['Content-Type'] = "text/csv; charset=utf-8"
         response.headers['Content-Disposition'] = str('attachment; filename=%s-inventory.csv' % (c.group.name,))
 
-        writer = csv.writer(response)
-        inventory_lib.render_inventory_header(writer)
-        for gp in groups:
-            ds = gp.members_of_type(model.Package).all()
-            inventory_lib.render_inventory_row(writer, ds, gp)
+        # The rows are streamed out as they are got, a batch of groups at a
+        # time, so that the first arrive immediately.
+        def stream():
+            buf = StringIO.StringIO()
+            writer = csv.writer(buf)
+            inventory_lib.render_inventory_header(writer)
+            try:
+                for i, row in enumerate(
+                        inventory_lib.inventory_download_rows(groups)):
+                    writer.writerow(row)
+                    if i % 100 == 99:
+                        yield buf.getvalue()
+                        buf.seek(0)
+                        buf.truncate()
+                yield buf.getvalue()
+            finally:
+                # this runs after the request's session has been removed
+                model.Session.remove()
+        return stream()
 
@@ -2,11 +2,14 @@ from ckan.controllers.tag import TagController as BaseTagController
 from ckan import model
 from ckan.lib.helpers import Page
 from ckan.lib.base import abort
-from ckanext.dgu.lib.alphabet_paginate_large import AlphaPageLarge
+from ckanext.dgu.lib.alphabet_paginate_large import AlphaPageCounted
+from ckanext.dgu.lib import tag_browse
 from ckanext.dgu.plugins_toolkit import render, c, request, _, ObjectNotFound, NotAuthorized, ValidationError, get_action, check_access
 from ckan.lib.base import h
 
 LIMIT = 50
+TAGS_PER_LETTER_PAGE = 500
+PAGING_THRESHOLD = 50
 
 class TagController(BaseTagController):
     def index(self):
@@ -44,13 +47,35 @@ class TagController(BaseTagController):
                             )
             c.page.items = [tag_dict['name'] for tag_dict in result_dict['results']]
         else:
-            results = get_action('tag_list')(context, data_dict)
+            # Only the tags on the requested page are got (by first letter,
+            # then a page within the letter), rather than every tag.
+            letter = request.params.get('page', 'A')
+            other_text = _('Other')
+            try:
+                letter_page = max(int(request.params.get('n', 1)), 1)
+            except ValueError:
+                abort(404, _('Not found'))
+            if letter != other_text and letter not in tag_browse.LETTERS:
+                abort(404, _('Not found'))
+            counts = tag_browse.letter_counts()
+            counts[other_text] = counts.pop(tag_browse.OTHER, 0)
+            if sum(counts.values()) < PAGING_THRESHOLD:
+                # too few to paginate, so show them all
+                tags = tag_browse.tags_for_letter(None)
+            else:
+                tags = tag_browse.tags_for_letter(
+                    tag_browse.OTHER if letter == other_text else letter,
+                    limit=TAGS_PER_LETTER_PAGE,
+                    offset=(letter_page - 1) * TAGS_PER_LETTER_PAGE)
 
-            c.page = AlphaPageLarge(
-                collection=results,
-                page=request.params.get('page', 'A'),
-                alpha_attribute='name',
-                other_text=_('Other'),
+            c.page = AlphaPageCounted(
+                items=tags,
+                letter_counts=counts,
+                page=letter,
+                letter_page=letter_page,
+                items_per_page=TAGS_PER_LETTER_PAGE,
+                paging_threshold=PAGING_THRESHOLD,
+                other_text=other_text,
                 controller_name='ckanext.dgu.controllers.tag:TagController',
             )
 
@@ -1,9 +1,13 @@
 import re
 import logging
 import socket
-from xmlrpclib import ServerProxy, Fault, ProtocolError
+import threading
+import time
+import httplib
+from xmlrpclib import ServerProxy, Transport, Fault, ProtocolError
 from xml.parsers.expat import ExpatError
 from httplib import BadStatusLine
+from multiprocessing.pool import ThreadPool
 
 log = logging.getLogger(__name__)
 
@@ -11,12 +15,82 @@ class DrupalXmlRpcSetupError(Exception): pass
 class DrupalRequestError(Exception): pass
 class DrupalKeyError(Exception): pass
 
+class PersistentTransport(Transport):
+    '''XMLRPC transport that keeps its HTTP(S) connection open between calls
+    (HTTP/1.1 keep-alive), with a socket timeout. Failed requests are retried
+    on a fresh connection, since keep-alive connections can be dropped by the
+    server at any time. (All the Drupal calls made are reads, so are safe to
+    repeat.)'''
+    def __init__(self, scheme='http', timeout=None, retries=2,
+                 use_datetime=0):
+        Transport.__init__(self, use_datetime)
+        self.scheme = scheme
+        self.timeout = timeout
+        self.retries = retries
+
+    def make_connection(self, host):
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        if self.scheme == 'https':
+            connection = httplib.HTTPSConnection(chost, None,
+                                                 timeout=self.timeout,
+                                                 **(x509 or {}))
+        else:
+            connection = httplib.HTTPConnection(chost, timeout=self.timeout)
+        self._connection = host, connection
+        return connection
+
+    def request(self, host, handler, request_body, verbose=0):
+        for attempt in xrange(self.retries + 1):
+            try:
+                return self.single_request(host, handler, request_body,
+                                           verbose)
+            except (socket.error, httplib.HTTPException), e:
+                self.close()
+                if attempt == self.retries:
+                    raise
+                log.debug('Retrying Drupal request after error: %r', e)
+                time.sleep(0.5 * attempt)
+
 class DrupalClient(object):
     def __init__(self, xmlrpc_settings=None):
         '''If you do not supply xmlrpc settings then it looks them
-        up in the pylons config.'''
+        up in the pylons config.
+
+        Each thread gets its own connection to Drupal, which is kept open
+        between calls.'''
         self.xmlrpc_url, self.xmlrpc_url_log_safe = DrupalClient.get_xmlrpc_url(xmlrpc_settings)
-        self.drupal = ServerProxy(self.xmlrpc_url)
+        self.timeout, self.retries = DrupalClient.get_connection_settings(xmlrpc_settings)
+        self._local = threading.local()
+
+    @property
+    def drupal(self):
+        proxy = getattr(self._local, 'proxy', None)
+        if proxy is None:
+            scheme = self.xmlrpc_url.split(':', 1)[0]
+            transport = PersistentTransport(scheme, timeout=self.timeout,
+                                            retries=self.retries)
+            proxy = ServerProxy(self.xmlrpc_url, transport=transport)
+            self._local.proxy = proxy
+        return proxy
+
+    @staticmethod
+    def get_connection_settings(xmlrpc_settings=None):
+        '''Returns the timeout (seconds) and number of retries for requests,
+        from xmlrpc_settings (xmlrpc_timeout, xmlrpc_retries) or the pylons
+        config (dgu.xmlrpc_timeout, dgu.xmlrpc_retries).'''
+        if xmlrpc_settings is not None:
+            timeout = xmlrpc_settings.get('xmlrpc_timeout')
+            retries = xmlrpc_settings.get('xmlrpc_retries')
+        else:
+            try:
+                from pylons import config
+            except ImportError:
+                config = {}
+            timeout = config.get('dgu.xmlrpc_timeout')
+            retries = config.get('dgu.xmlrpc_retries')
+        return float(timeout or 30), int(retries if retries is not None else 2)
 
     @staticmethod
     def get_xmlrpc_url(xmlrpc_settings=None):
@@ -78,6 +152,42 @@ class DrupalClient(object):
         log.info('Obtained Drupal user: %r', unicode(user)[:200])
         return user
 
+    def get_users_properties(self, user_ids, threads=4, errors=None):
+        '''Requests the properties of many Drupal users, using a few
+        threads (each with its own connection) to make the requests in
+        parallel. Returns a dict of user_id: properties.
+
+        If an errors dict is supplied then users that cannot be retrieved
+        are recorded in it (user_id: DrupalRequestError). Otherwise the first
+        such error is raised. An unexpected exception for one user (e.g. a
+        broken connection) is recorded as a DrupalRequestError too, rather
+        than stopping the others.'''
+        def get(user_id):
+            try:
+                return user_id, self.get_user_properties(user_id), None
+            except DrupalRequestError, e:
+                return user_id, None, e
+            except Exception, e:
+                log.exception('Error getting Drupal user %r', user_id)
+                return user_id, None, DrupalRequestError(
+                    'Error getting Drupal user %r: %r' % (user_id, e))
+
+        pool = ThreadPool(min(threads, len(user_ids)) or 1)
+        try:
+            results = pool.map(get, user_ids)
+        finally:
+            pool.close()
+            pool.join()
+        users = {}
+        for user_id, properties, error in results:
+            if error:
+                if errors is None:
+                    raise error
+                errors[user_id] = error
+            else:
+                users[user_id] = properties
+        return users
+
     def get_user_id_from_session_id(self, session_id):
         try:
             user_id = self.drupal.session.retrieve(session_id)
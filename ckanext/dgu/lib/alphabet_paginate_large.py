@@ -68,3 +68,74 @@ class AlphaPageLarge(AlphaPage):
         ul = HTML.tag('ul', *pages)
         div = HTML.div(ul, class_='pagination pagination-alphabet')
         return div
+
+
+class AlphaPageCounted(AlphaPageLarge):
+    '''
+    An AlphaPageLarge for which the caller has already got the items on the
+    page and the number of items for each letter. A letter with many items
+    is split into numbered pages of items_per_page.
+    '''
+    def __init__(self, items, letter_counts, page, other_text,
+                 letter_page=1, items_per_page=200, paging_threshold=50,
+                 controller_name='tag'):
+        '''
+        @param items - the items on the current page
+        @param letter_counts - dict of the number of items for each letter
+                               (keyed by the letters and other_text)
+        @param letter_page - the number of the page within the letter
+        @param items_per_page - the maximum number of items on a page
+        '''
+        super(AlphaPageCounted, self).__init__(
+            collection=None, alpha_attribute=None, page=page,
+            other_text=other_text, paging_threshold=paging_threshold,
+            controller_name=controller_name)
+        self._items = items
+        self.letter_counts = letter_counts
+        self.letter_page = letter_page
+        self.items_per_page = items_per_page
+
+    @property
+    def items(self):
+        return self._items
+
+    @property
+    def item_count(self):
+        return sum(self.letter_counts.values())
+
+    def pager(self, q=None):
+        '''Returns pager html - the letters, with those without items
+        disabled, and then the numbered pages of the current letter if it has
+        more than one.'''
+        if self.item_count < self.paging_threshold:
+            return ''
+        page = q or self.page
+        pages = []
+        for letter in self.letters:
+            href = url_for(controller=self.controller_name, action='index', page=letter)
+            link = HTML.a(href=href, c=letter)
+            if letter == page:
+                li_class = 'active'
+            elif not self.letter_counts.get(letter):
+                li_class = 'disabled'
+            else:
+                li_class = ''
+            attributes = {'class_': li_class} if li_class else {}
+            pages.append(HTML.li(link, **attributes))
+        html = HTML.div(HTML.tag('ul', *pages),
+                        class_='pagination pagination-alphabet')
+
+        num_letter_pages = (self.letter_counts.get(page, 0) - 1) \
+            / self.items_per_page + 1
+        if num_letter_pages > 1:
+            letter_pages = []
+            for letter_page in xrange(1, num_letter_pages + 1):
+                href = url_for(controller=self.controller_name,
+                               action='index', page=page, n=letter_page)
+                link = HTML.a(href=href, c=str(letter_page))
+                attributes = {'class_': 'active'} \
+                    if letter_page == self.letter_page else {}
+                letter_pages.append(HTML.li(link, **attributes))
+            html += HTML.div(HTML.tag('ul', *letter_pages),
+                             class_='pagination')
+        return html
@@ -6,14 +6,21 @@ them.
 """
 import unicodecsv as csv
 import json
+import multiprocessing
+import os
+import shutil
 import tempfile
+import time
 import urlparse
+import zipfile
+import zlib
 
 from paste.deploy.converters import asbool
 
 from pylons import config
 import ckan.logic as logic
 import ckan.model as model
+from ckanext.dgu.lib.publisher import PublisherHierarchy
 
 IGNORE_KEYS = [
     u'ratings_count',
@@ -59,35 +66,192 @@ def make_nice_name(name):
     return name.replace('_', ' ').replace('-', ' ').title()
 
 
-class CSVDumper(object):
+class ZipMemberWriter(object):
+    '''A writable file-like object that deflates what is written to it
+    straight into a new member of a ZipFile (opened for writing), so the
+    member\'s content never needs to be held in a file of its own. The zip
+    produced is the same as if ZipFile.write() had been used.
+
+    Only one member can be written to a zip at a time. To write two at once,
+    make one of them with spool=True - its compressed data is held in a
+    temporary file and added to the zip when it is closed, which must be after
+    the other member is closed.
+    '''
+    def __init__(self, zip_file, arcname, spool=False):
+        self.zip_file = zip_file
+        self.zinfo = zipfile.ZipInfo(arcname,
+                                     time.localtime(time.time())[:6])
+        self.zinfo.external_attr = 0644 << 16L
+        self.zinfo.compress_type = zipfile.ZIP_DEFLATED
+        self.zinfo.flag_bits = 0x00
+        self.zinfo.CRC = 0
+        self.zinfo.compress_size = 0
+        self.zinfo.file_size = 0
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                            zlib.DEFLATED, -15)
+        self.closed = False
+        if spool:
+            self._out = tempfile.TemporaryFile()
+        else:
+            self._start_member()
+            self._out = self.zip_file.fp
+
+    def _start_member(self):
+        self.zinfo.header_offset = self.zip_file.fp.tell()
+        self.zip_file._writecheck(self.zinfo)
+        self.zip_file._didModify = True
+        # The header gets rewritten with the CRC and sizes at the end
+        self.zip_file.fp.write(self.zinfo.FileHeader(False))
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.zinfo.file_size += len(data)
+        self.zinfo.CRC = zipfile.crc32(data, self.zinfo.CRC) & 0xffffffff
+        compressed = self._compressor.compress(data)
+        self.zinfo.compress_size += len(compressed)
+        self._out.write(compressed)
 
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        compressed = self._compressor.flush()
+        self.zinfo.compress_size += len(compressed)
+        self._out.write(compressed)
+        if self.zinfo.file_size > zipfile.ZIP64_LIMIT or \
+                self.zinfo.compress_size > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile('Zip member %s would require ZIP64 '
+                                       'extensions' % self.zinfo.filename)
+        if self._out is not self.zip_file.fp:
+            self._start_member()
+            self._out.seek(0)
+            shutil.copyfileobj(self._out, self.zip_file.fp)
+            self._out.close()
+        # Seek backwards and write the header with the correct CRC and sizes
+        fp = self.zip_file.fp
+        position = fp.tell()
+        fp.seek(self.zinfo.header_offset, 0)
+        fp.write(self.zinfo.FileHeader(False))
+        fp.seek(position, 0)
+        self.zip_file.filelist.append(self.zinfo)
+        self.zip_file.NameToInfo[self.zinfo.filename] = self.zinfo
+
+    @property
+    def file_size(self):
+        return self.zinfo.file_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
 
-    def __init__(self, *args, **kwargs):
-        self.dataset_file = tempfile.NamedTemporaryFile(delete=False)
-        self.resource_file = tempfile.NamedTemporaryFile(delete=False)
+
+class CSVDumper(object):
+    '''Dumps datasets and resources to CSV. By default these are written to
+    temporary files, whose filenames close() returns, but any writable file
+    objects (e.g. ZipMemberWriters) can be supplied instead.'''
+
+    def __init__(self, dataset_file=None, resource_file=None):
+        self.dataset_file = dataset_file or \
+            tempfile.NamedTemporaryFile(delete=False)
+        self.resource_file = resource_file or \
+            tempfile.NamedTemporaryFile(delete=False)
 
         self.dataset_csv = csv.writer(self.dataset_file)
         self.resource_csv = csv.writer(self.resource_file)
 
-        self.dataset_filename = self.dataset_file.name
-        self.resource_filename = self.resource_file.name
+        self.dataset_filename = getattr(self.dataset_file, 'name', None)
+        self.resource_filename = getattr(self.resource_file, 'name', None)
 
         self.organization_cache = {}
 
-        self.keys = []
+        self.dataset_keys = None
+
+    def dump(self, limit=None, processes=1):
+        '''Dumps all the active public datasets, in name order.
+
+        With processes > 1, the datasets are split into shards, each dumped
+        to partial CSV files by a pool of worker processes, and then the parts
+        are joined in order, giving the same output as a serial dump.
+        '''
+        package_ids = self._package_ids(limit)
+        if not package_ids:
+            return
+        self.dataset_keys = self.get_dataset_keys()
+        self.write_header(self.dataset_keys)
+
+        if processes > 1:
+            self._dump_sharded(package_ids, processes)
+        else:
+            self._dump_packages(package_ids)
 
-    def dump(self, limit=None):
-        packages = model.Session.query(model.Package)\
+    def _package_ids(self, limit=None):
+        q = model.Session.query(model.Package.id)\
             .filter(model.Package.state == 'active')\
             .filter(model.Package.private == False)\
-            .order_by('name')
+            .order_by(model.Package.name)
         if limit:
-            packages = packages.limit(limit)
-
-        first = True
-        for pkg in packages.yield_per(200):
-            self.write_object(pkg, first)
-            first = False
+            q = q.limit(limit)
+        return [id_ for (id_,) in q]
+
+    def _dump_packages(self, package_ids):
+        # Fetch in chunks, as the ids are too many to go in one IN clause
+        chunk_size = 1000
+        for i in xrange(0, len(package_ids), chunk_size):
+            packages = model.Session.query(model.Package)\
+                .filter(model.Package.id.in_(package_ids[i:i + chunk_size]))\
+                .order_by(model.Package.name)
+            for pkg in packages.yield_per(200):
+                self.write_object(pkg)
+            model.Session.expunge_all()
+
+    def _dump_sharded(self, package_ids, processes):
+        # More shards than processes, so that a slow shard doesn't hold up
+        # the end of the dump too much.
+        num_shards = processes * 4
+        shard_size = max(1, -(-len(package_ids) // num_shards))
+        shards = [(package_ids[i:i + shard_size], self.dataset_keys)
+                  for i in xrange(0, len(package_ids), shard_size)]
+
+        # Load this before forking, so the workers all share it
+        PublisherHierarchy.instance()
+        # Don't let the workers inherit open database connections - they each
+        # need their own.
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            # map() returns the parts in the order of the shards
+            parts = pool.map(_dump_shard, shards, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        for dataset_part, resource_part in parts:
+            for part, out_file in ((dataset_part, self.dataset_file),
+                                   (resource_part, self.resource_file)):
+                with open(part, 'rb') as f:
+                    shutil.copyfileobj(f, out_file)
+                os.remove(part)
+
+    def get_dataset_keys(self):
+        '''Returns the dataset columns for the dump - the same for every
+        dump, whichever datasets are in it: the fields of as_dict() (only
+        the extras vary from package to package), the interesting extras,
+        and the ODI certificate URL in place of the certificate. This is
+        worked out before any rows are written, so that every shard of a dump
+        uses the same columns. Returns [] if there are no packages.'''
+        pkg = model.Session.query(model.Package).first()
+        if not pkg:
+            return []
+        keys = set(self._flatten_fields(pkg.as_dict())[0])
+        keys.update(INTERESTING_EXTRAS)
+        keys.add(u'odi-certificate-url')
+        keys.discard(u'odi-certificate')
+        return sorted(keys)
 
     def _encode(self, s):
         ''' csv.write doesn't do encoding - call this on all row cells
@@ -106,14 +270,20 @@ class CSVDumper(object):
         return s
 
     def write_object(self, pkg, first=False):
-        pkg_dict, resources = self._flatten(pkg)
-
-        if first:
-            # TODO Get a better list of fields to dump than just what we see in
-            # the first dataset...
-            self.dataset_keys = sorted(pkg_dict.keys())
+        if first and self.dataset_keys is None:
+            self.dataset_keys = self.get_dataset_keys()
             self.write_header(self.dataset_keys)
 
+        dataset_row, resource_rows = self.render_object(pkg)
+        self.dataset_csv.writerow(dataset_row)
+        for row in resource_rows:
+            self.resource_csv.writerow(row)
+
+    def render_object(self, pkg):
+        '''Returns the row for datasets.csv and the rows for resources.csv
+        for a package.'''
+        pkg_dict, resources = self._flatten(pkg)
+
         url = config.get('ckan.site_url')
         full_url = urlparse.urljoin(url, '/dataset/%s' % pkg.name)
 
@@ -123,9 +293,9 @@ class CSVDumper(object):
             org = model.Group.get(pkg.owner_org)
             organization = org.title
 
-            parent_group_hierarchy = org.get_parent_group_hierarchy('organization')
-            if parent_group_hierarchy:
-                top_level_publisher = parent_group_hierarchy[0].title
+            top_level_id = PublisherHierarchy.instance().top_level_id(org.id)
+            if top_level_id and top_level_id != org.id:
+                top_level_publisher = model.Group.get(top_level_id).title
             else:
                 top_level_publisher = organization
 
@@ -145,18 +315,19 @@ class CSVDumper(object):
         vals = [self._encode(val) for val in [pkg.name, pkg.title, full_url, organization, top_level_publisher, license, published, nii, location, import_source]]
         vals += [self._encode(pkg_dict.get(k)) for k in self.dataset_keys]
 
-        self.dataset_csv.writerow(vals)
-
         # Flatten the list
         resources = sum(resources, [])
 
+        resource_rows = []
         for resource in resources:
             # Important to include the date column for timeseries.
             date = resource.get('date', '')
 
             row = [pkg.name, resource['url'], resource['format'], resource.get('description', ''),
                 resource['id'], resource['position'], date, organization, top_level_publisher]
-            self.resource_csv.writerow(row)
+            resource_rows.append(row)
+
+        return vals, resource_rows
 
     def write_header(self, dataset_keys):
         """
@@ -177,12 +348,11 @@ class CSVDumper(object):
         self.dataset_csv.writerow(dataset_header_row)
         self.resource_csv.writerow(resource_header_row)
 
-    def _flatten(self, pkg):
+    def _flatten_fields(self, pkg_dict):
         """
-        Pull and flatten the package dict, making sure to promote any interesting
-        extras we find.
+        Flattens the fields of the package dict, other than the extras.
+        Returns the flattened dict and the list of resources.
         """
-        pkg_dict = pkg.as_dict()
         resources = []
 
         new_dict = {}
@@ -207,6 +377,16 @@ class CSVDumper(object):
 
             new_dict[name] = value
 
+        return new_dict, resources
+
+    def _flatten(self, pkg):
+        """
+        Pull and flatten the package dict, making sure to promote any interesting
+        extras we find.
+        """
+        pkg_dict = pkg.as_dict()
+        new_dict, resources = self._flatten_fields(pkg_dict)
+
         # Make sure all the extras we are interested in have keys
         for k in INTERESTING_EXTRAS:
             new_dict[k] = ''
@@ -254,3 +434,16 @@ class CSVDumper(object):
         self.resource_file.close()
 
         return self.dataset_filename, self.resource_filename
+
+
+def _dump_shard(args):
+    '''Dumps the given packages to partial (headerless) dataset and resource
+    CSV files, returning their filenames.'''
+    package_ids, dataset_keys = args
+    dumper = CSVDumper()
+    dumper.dataset_keys = dataset_keys
+    try:
+        dumper._dump_packages(package_ids)
+    finally:
+        model.Session.remove()
+    return dumper.close()
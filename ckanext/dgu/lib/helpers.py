@@ -1558,81 +1558,24 @@ def publisher_performance_data(publisher, include_sub_publishers):
 
         broken_links - green = 0%, amber <= 60% broken links, red > 60% broken
         openness - green if all > 4 *, amber for 50%> 3*, red otherwise
+
+        These are looked up in the publisher_scorecard table, which is kept up
+        to date by the publisher_scorecard paster command. If the table has
+        not been created, or the publisher's scorecard has not been worked
+        out yet, they are worked out on the fly instead.
     """
     try:
         import ckanext.qa
     except ImportError:
         return None
-    import time
-    from ckanext.qa.reports import broken_resource_links_for_organisation
-    from ckanext.dgu.lib import publisher as publib
-
-    start_time = time.time()
-
-    rcount = publib.resource_count(publisher, include_sub_publishers)
-    log.debug("{p} has {r} resources".format(p=publisher.name, r=rcount))
-
-    # Issues data
-    issues = "green"
-
-    if 'issues' in config['ckan.plugins']:
-        # If issues are installed then we can use the info to determine
-        # whether the issues are older than a month, between a fortnight
-        # and a month, or less than a fortnight.
-        from ckanext.issues.lib import util
-
-        more_than_month = util.old_unresolved(publisher, days=30)
-        more_than_fortnight = util.old_unresolved(publisher, days=14)
-
-        if more_than_month:
-            issues = 'red'
-        elif more_than_fortnight:
-            issues = 'amber'
-        else:
-            issues = 'green'
+    from ckanext.dgu.lib import scorecard as scorecard_lib
 
-    spending = 'green'
-    if publisher_has_spend_data(publisher):
-        spending = 'red'
-
-    # TODO: Add a count to result of broken_resource_links_for_organisation or write a version
-    # that returns count().
-    data = broken_resource_links_for_organisation(publisher.name, include_sub_publishers, use_cache=True)
-    broken_count = len(data['data'])
-
-    if broken_count == 0 or rcount == 0:
-        pct = 0
-    else:
-        pct = int(100 * float(broken_count)/float(rcount))
-    log.debug("{d}% of resources in {p} are broken".format(d=pct, p=publisher.name))
-
-    broken_links = 'green'
-    if 1 < pct <= 60:
-        broken_links = 'amber'
-    elif pct > 60:
-        broken_links = 'red'
-
-    openness = ''
-    total, counters = publib.openness_scores(publisher, include_sub_publishers)
-    number_x_or_above = lambda x: sum(counters.get(str(c),0) for c in xrange(x, 6))
-
-    above_3 = number_x_or_above(3)
-    pct_above_3 = int(100 * float(total)/float(above_3)) if above_3 else 0
-
-    if number_x_or_above(4) == total:
-        openness = 'green'
-    elif pct_above_3 >= 50:
-        openness = 'amber'
-    else:
-        openness = 'red'
-
-    log.debug("publisher performance data took {d} seconds".format(d=time.time()-start_time))
-    return {
-        'broken_links': broken_links,
-        'openness': openness,
-        'issues': issues,
-        'spending': spending
-    }
+    if scorecard_lib.scorecard_table_exists():
+        scorecard = scorecard_lib.get_scorecard(publisher,
+                                                include_sub_publishers)
+        if scorecard:
+            return scorecard.traffic_lights()
+    return scorecard_lib.live_traffic_lights(publisher, include_sub_publishers)
 
 def publisher_has_spend_data(publisher):
     return publisher.extras.get('category','') == 'ministerial-department'
@@ -1888,16 +1831,9 @@ def inventory_status(package_items):
         yield pkg,grp, pkg.extras.get('publish-date', ''), pkg.extras.get('release-notes', ''), action
 
 def themes_count():
-    from ckan import model
-    theme_count = {}
-    for theme, theme_dict in themes().items():
-        count = model.Session.query(model.Package)\
-            .join(model.PackageExtra)\
-            .filter(model.PackageExtra.key=='theme-primary')\
-            .filter(model.PackageExtra.value==theme_dict['title'])\
-            .filter(model.Package.state=='active').count()
-        theme_count[theme_dict['title']] = count
-    return theme_count
+    '''Returns the number of datasets with each primary theme.'''
+    from ckanext.dgu.lib.theme import theme_counts
+    return theme_counts()['primary']
 
 def themes():
     from ckanext.dgu.lib.theme import Themes
@@ -0,0 +1,175 @@
+"""
+Keeps the metadata dumps (CSV, JSON and unpublished CSV) up to date
+incrementally. The rendered rows for every dataset are kept in a local SQLite
+store between runs, and each run only re-renders the datasets that have
+changed (according to the revision tables) since the previous one. The dump
+files are then written out from the store.
+"""
+import csv
+import datetime
+import json
+import logging
+import os
+import sqlite3
+
+from ckan import model
+from ckanext.dgu.lib.dumper import CSVDumper
+from ckanext.dgu.lib.inventory import INVENTORY_DUMP_HEADER, inventory_dump_row
+from ckanext.dgu.lib.publisher import PublisherHierarchy
+from ckanext.dgu.lib.revisions import (changed_package_ids,
+                                       changed_organization_ids)
+
+log = logging.getLogger(__name__)
+
+# Revisions are timestamped when they are created, not when committed, so a
+# long transaction can commit a revision dated before the previous run
+# started. Looking back a bit further than the previous run catches these.
+REVISION_MARGIN = datetime.timedelta(hours=1)
+
+
+class IncrementalDumper(object):
+
+    def __init__(self, store_filepath):
+        self.store = sqlite3.connect(store_filepath)
+        self.store.execute('''CREATE TABLE IF NOT EXISTS dataset (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            private INTEGER NOT NULL,
+            dataset_row TEXT NOT NULL,
+            resource_rows TEXT NOT NULL,
+            json TEXT NOT NULL,
+            unpublished_row TEXT)''')
+        self.store.execute('CREATE INDEX IF NOT EXISTS dataset_name '
+                           'ON dataset (name)')
+        self.store.execute('''CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT)''')
+        self.store.commit()
+        self.csv_dumper = CSVDumper()
+
+    def _get_meta(self, key):
+        row = self.store.execute('SELECT value FROM meta WHERE key=?',
+                                 (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set_meta(self, key, value):
+        self.store.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                           (key, json.dumps(value)))
+
+    def update(self):
+        '''Brings the store up to date with the database.'''
+        started = datetime.datetime.utcnow()
+        current_ids = set(id_ for (id_,) in
+                          model.Session.query(model.Package.id)
+                          .filter(model.Package.state == 'active'))
+        stored_ids = set(id_ for (id_,) in
+                         self.store.execute('SELECT id FROM dataset'))
+
+        removed_ids = stored_ids - current_ids
+        self.store.executemany('DELETE FROM dataset WHERE id=?',
+                               [(id_,) for id_ in removed_ids])
+
+        # The columns don't depend on any dataset's extras, so they only
+        # change (and everything is rendered again) when the code does
+        dataset_keys = self.csv_dumper.get_dataset_keys()
+        self.csv_dumper.dataset_keys = dataset_keys
+        last_started = self._get_meta('last_started')
+        if last_started is None or dataset_keys != self._get_meta('dataset_keys'):
+            log.info('Dumping all datasets')
+            ids_to_render = current_ids
+        else:
+            since = datetime.datetime.strptime(last_started,
+                                               '%Y-%m-%dT%H:%M:%S.%f') \
+                - REVISION_MARGIN
+            ids_to_render = (current_ids - stored_ids) | \
+                (changed_package_ids(since) & current_ids)
+            # Organization titles are in the rows, including the top-level
+            # organization of every sub-organization, so changing one, or
+            # moving it in the hierarchy, affects its descendants too
+            org_ids = set()
+            hierarchy = PublisherHierarchy.instance()
+            for org_id in changed_organization_ids(since):
+                org_ids.update(hierarchy.descendant_ids(org_id))
+            if org_ids:
+                ids_to_render |= set(
+                    id_ for (id_,) in model.Session.query(model.Package.id)
+                    .filter(model.Package.owner_org.in_(org_ids))
+                    .filter(model.Package.state == 'active'))
+            log.info('Datasets changed since %s: %i', since,
+                     len(ids_to_render))
+        log.info('Datasets removed: %i', len(removed_ids))
+
+        self._render(sorted(ids_to_render))
+
+        self._set_meta('dataset_keys', dataset_keys)
+        self._set_meta('last_started',
+                       started.strftime('%Y-%m-%dT%H:%M:%S.%f'))
+        self.store.commit()
+
+    def _render(self, package_ids):
+        chunk_size = 1000
+        for i in xrange(0, len(package_ids), chunk_size):
+            packages = model.Session.query(model.Package)\
+                .filter(model.Package.id.in_(package_ids[i:i + chunk_size]))
+            rows = []
+            for pkg in packages:
+                dataset_row, resource_rows = self.csv_dumper.render_object(pkg)
+                rows.append((
+                    pkg.id, pkg.name, pkg.private,
+                    json.dumps(dataset_row), json.dumps(resource_rows),
+                    self._render_json(pkg),
+                    json.dumps(inventory_dump_row(pkg))))
+            self.store.executemany(
+                'INSERT OR REPLACE INTO dataset VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows)
+            self.store.commit()
+            model.Session.expunge_all()
+            log.info('Rendered %i/%i', i + len(rows), len(package_ids))
+
+    def _render_json(self, pkg):
+        '''The dataset as it appears in the JSON dump, as written by
+        ckan.lib.dumper.SimpleDumper.dump_json, which indents it within a
+        list.'''
+        list_json = json.dumps([pkg.as_dict()], indent=4)
+        # strip off the '[\n' and '\n]'
+        return list_json[2:-2]
+
+    def write_csv(self, dataset_file, resource_file):
+        '''Writes datasets.csv and resources.csv from the store to the given
+        files, as CSVDumper.dump would.'''
+        writer = CSVDumper(dataset_file, resource_file)
+        writer.write_header(self.csv_dumper.dataset_keys)
+        for dataset_row, resource_rows in self.store.execute(
+                'SELECT dataset_row, resource_rows FROM dataset '
+                'WHERE NOT private ORDER BY name'):
+            writer.dataset_csv.writerow(json.loads(dataset_row))
+            for row in json.loads(resource_rows):
+                writer.resource_csv.writerow(row)
+        writer.close()
+
+    def write_json(self, dump_file_obj):
+        '''Writes the JSON dump, as SimpleDumper.dump_json would.'''
+        first = True
+        for (pkg_json,) in self.store.execute(
+                'SELECT json FROM dataset ORDER BY name'):
+            dump_file_obj.write('[\n' if first else ', \n')
+            dump_file_obj.write(pkg_json.encode('utf-8'))
+            first = False
+        dump_file_obj.write('[]' if first else '\n]')
+
+    def write_unpublished(self, dump_file_obj):
+        '''Writes the unpublished datasets CSV, as inventory_dumper would.'''
+        writer = csv.writer(dump_file_obj)
+        writer.writerow(INVENTORY_DUMP_HEADER)
+        for (row,) in self.store.execute(
+                'SELECT unpublished_row FROM dataset ORDER BY name'):
+            row = json.loads(row)
+            if row:
+                writer.writerow([v.encode('utf-8') if isinstance(v, unicode)
+                                 else v for v in row])
+
+    def close(self):
+        self.store.close()
+        # The renderer's own temporary files are never written to
+        for filename in self.csv_dumper.close():
+            os.remove(filename)
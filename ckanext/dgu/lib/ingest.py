@@ -20,7 +20,18 @@ The processing function should have the following signature:
 and should return nothing. If a failure occurs then the function should raise
 a IngestException which accepts a message and whether the process should
 attempt to continue of fail immediately.
+
+The rows are read from the file as they are needed and are validated and
+processed a batch at a time. Problems with rows don't stop the processing -
+they are collected in the IngestReport that process returns. If a session is
+given then it is committed after each batch, and if a checkpoint filepath is
+given then the progress is saved there after each batch, so that if the
+processing stops part way through, running it again on the same file carries
+on where it stopped.
 """
+import csv
+import itertools
+import json
 import logging
 import messytables
 import os
@@ -38,6 +49,54 @@ class IngestException(Exception):
         super(IngestException,self).__init__(err_message)
 
 
+class IngestReport(object):
+    """
+    The outcome of processing a file - the number of rows processed, the
+    number of blank rows skipped and the errors with rows, as a list of
+    (row_number, message). Rows are numbered as in the spreadsheet, so the
+    header is row 1.
+
+    If the processing stopped part way through then aborted is the reason.
+    """
+    def __init__(self):
+        self.processed = 0
+        self.skipped = 0
+        self.errors = []
+        self.aborted = None
+
+    def add_error(self, row_number, message):
+        self.errors.append((row_number, unicode(message)))
+
+    def summary(self):
+        lines = ['Processed {0} rows, skipped {1} blank rows, {2} errors'
+                 .format(self.processed, self.skipped, len(self.errors))]
+        for row_number, message in self.errors:
+            lines.append(u'Row {0}: {1}'.format(row_number, message))
+        if self.aborted:
+            lines.append(u'Stopped: {0}'.format(self.aborted))
+        return '\n'.join(lines)
+
+    def write_csv(self, filepath):
+        with open(filepath, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Row', 'Error'])
+            for row_number, message in self.errors:
+                writer.writerow([row_number, message.encode('utf-8')])
+
+    def to_dict(self):
+        return {'processed': self.processed,
+                'skipped': self.skipped,
+                'errors': self.errors}
+
+    @classmethod
+    def from_dict(cls, report_dict):
+        report = cls()
+        report.processed = report_dict['processed']
+        report.skipped = report_dict['skipped']
+        report.errors = [tuple(error) for error in report_dict['errors']]
+        return report
+
+
 class Ingester(object):
 
     def __init__(self, filename):
@@ -46,6 +105,7 @@ class Ingester(object):
         will attempt to load the file and ensure that messytables knows how to
         process it.
         """
+        self.filename = filename
         self.tableset = None
 
         try:
@@ -56,55 +116,149 @@ class Ingester(object):
             if str(e) == "Unrecognized MIME type: text/plain":
                 # Attempt to force the load as a CSV file to work around messytables
                 # not recognising text/plain
-                self.tableset = messytables.any_tableset(filename, mimetype="text/csv")
+                self.tableset = messytables.any_tableset(open(filename, 'r'),
+                    mimetype="text/csv")
             else:
                 log.exception(e)
                 raise Exception(u"Failed to load the file at {0}".format(filename))
 
-    def process(self, processor, header_validator=None, row_validator=None):
+    def process(self, processor, header_validator=None, row_validator=None,
+                prepare_batch=None, session=None, batch_size=100,
+                checkpoint=None):
         """
         This method will iterate through the tabular data (in the first table/sheet)
         and after running any validators (on headers, and each row) will attempt to
         use the user-supplied processor to handle each row.
+
+        The rows are done in batches of batch_size. Before a batch is
+        processed, prepare_batch (if given) is called with its valid rows, so
+        that it can look up what they need in a few queries, rather than a
+        few per row. After the batch, the session (if given) is committed
+        and the progress is saved in the checkpoint file (if given).
+
+        Returns an IngestReport.
         """
-        first = True
-        count = 0
+        rows = iter(self.tableset.tables[0])
+        try:
+            header_row = [x.value for x in rows.next()]
+        except StopIteration:
+            report = IngestReport()
+            report.aborted = 'The file has no rows'
+            return report
+
+        # Process the validation of the header row if we have
+        # been given a validator
+        if header_validator:
+            ok,err = header_validator(header_row)
+            if not ok:
+                report = IngestReport()
+                report.aborted = err
+                return report
+
+        done, report = self._read_checkpoint(checkpoint)
+        if done:
+            log.info('Resuming after row {0}'.format(done))
+
+        # the header is row 1
+        numbered_rows = itertools.izip(itertools.count(2), rows)
+        while True:
+            batch = list(itertools.islice(numbered_rows, batch_size))
+            if not batch:
+                break
+            if batch[-1][0] <= done:
+                # done in a previous run
+                continue
+            if not self._process_batch(batch, done, report, processor,
+                                       row_validator, prepare_batch, session):
+                return report
+            if checkpoint:
+                self._write_checkpoint(checkpoint, batch[-1][0], report)
 
-        for row in self.tableset.tables[0]:
+        if checkpoint and os.path.exists(checkpoint):
+            # finished, so the next run starts from the beginning
+            os.remove(checkpoint)
+        log.info("Processed {0} rows".format(report.processed))
+        return report
 
+    def _process_batch(self, batch, done, report, processor, row_validator,
+                       prepare_batch, session):
+        '''Validates and processes the rows of the batch, recording what
+        happens in the report. Returns False if the processing has to stop,
+        in which case the batch is rolled back.'''
+        valid_rows = []
+        skipped = 0
+        errors = []
+        for row_number, row in batch:
+            if row_number <= done:
+                continue
             raw_row = [x.value for x in row]
-            if first:
-                # Process the validation of the header row if we have
-                # been given a validator
-                first = False
-
-                if header_validator:
-                    ok,err = header_validator(raw_row)
-                    if not ok:
-                        raise IngestException(err,False)
-            else:
-                # If the entire row is empty, then we should probably stop
-                # processing and explain why but this will then not handle
-                # blank rows in the middle of the table. We will raise an
-                # exception in this case so that the processor() can decide
-                # how to notify the user.
-                if not any(raw_row):
-                    raise IngestException("Encountered a blank row in the table")
-
-                # Process the individual rows in the file
-                if row_validator:
-                    ok,err = row_validator(raw_row)
-                    if not ok:
-                        raise IngestException(err,False)
-
-                # Pass
+            # Blank rows (e.g. at the end of a sheet) are skipped
+            if not any(raw_row):
+                skipped += 1
+                continue
+
+            # Process the individual rows in the file
+            if row_validator:
+                ok,err = row_validator(raw_row)
+                if not ok:
+                    errors.append((row_number, err))
+                    continue
+            valid_rows.append((row_number, raw_row))
+
+        processed = 0
+        row_number = None
+        try:
+            if prepare_batch and valid_rows:
+                prepare_batch([raw_row for _, raw_row in valid_rows])
+            for row_number, raw_row in valid_rows:
                 try:
                     processor(raw_row)
-                    count = count + 1
+                    processed += 1
                 except IngestException, ie:
-                    if ie.should_continue:
-                        log.warning('Ingest error, but continuing: %s', ie)
-                        continue
-                    raise ie
+                    if not ie.should_continue:
+                        raise
+                    log.warning('Ingest error, but continuing: %s', ie)
+                    errors.append((row_number, ie))
+            if session:
+                session.commit()
+        except Exception, e:
+            if session:
+                session.rollback()
+            if not isinstance(e, IngestException):
+                log.exception(e)
+            report.aborted = u'Row {0}: {1}'.format(row_number, e) \
+                if row_number else unicode(e)
+            return False
+
+        report.processed += processed
+        report.skipped += skipped
+        for row_number, err in sorted(errors):
+            report.add_error(row_number, err)
+        return True
+
+    def _file_key(self):
+        stat = os.stat(self.filename)
+        return '{0} {1} {2}'.format(os.path.abspath(self.filename),
+                                    stat.st_mtime, stat.st_size)
+
+    def _read_checkpoint(self, checkpoint):
+        '''Returns the number of the last row done in a previous run of this
+        file and the report so far, or (0, IngestReport()) to start from the
+        beginning.'''
+        if not checkpoint or not os.path.exists(checkpoint):
+            return 0, IngestReport()
+        with open(checkpoint) as f:
+            saved = json.load(f)
+        if saved['file'] != self._file_key():
+            log.warning('Ignoring checkpoint {0} as it is for a different '
+                        'file: {1}'.format(checkpoint, saved['file']))
+            return 0, IngestReport()
+        return saved['done'], IngestReport.from_dict(saved['report'])
 
-        log.info("Processed {0} rows".format(count))
+    def _write_checkpoint(self, checkpoint, done, report):
+        # write then rename, so that a checkpoint is never half-written
+        tmp_filepath = checkpoint + '.tmp'
+        with open(tmp_filepath, 'w') as f:
+            json.dump({'file': self._file_key(), 'done': done,
+                       'report': report.to_dict()}, f)
+        os.rename(tmp_filepath, checkpoint)
@@ -6,42 +6,51 @@ from ckanext.dgu.plugins_toolkit import (c, NotAuthorized,
     ValidationError, get_action, check_access)
 from ckan.lib.search import SearchIndexError
 
+INVENTORY_DUMP_HEADER = ["Name", "Description", "Department", "Publish date",
+                         "Release notes"]
+
 def inventory_dumper(tmpfile, query):
     """ Dumps all of the inventory items to the open tmpfile using the
         packages provided by query """
     import csv
-    import dateutil.parser
 
     writer = csv.writer(tmpfile)
-    writer.writerow(["Name", "Description", "Department", "Publish date", "Release notes"])
+    writer.writerow(INVENTORY_DUMP_HEADER)
     for pkg in query.all():
-        if not pkg.extras.get('unpublished', False):
-            continue
-
-        org = pkg.get_organization()
-        if not org:
-            # This should not happen, but does appear in test data during development
-            grp = 'Unknown'
-        else:
-            grp = org.title
-
-
-        publish_date = pkg.extras.get('publish-date', '')
-        if publish_date:
-            try:
-                dt = dateutil.parser.parse(publish_date)
-                publish_date = dt.strftime('%d/%m/%Y')
-            except Exception, e:
-                publish_date = ""
-
-        row = [pkg.title.encode('utf-8')]
-        row.append(pkg.notes.encode('utf-8') or "")
-        row.append(grp)
-        row.append(publish_date)
-        row.append(pkg.extras.get('release-notes', '').encode('utf-8'))
+        row = inventory_dump_row(pkg)
+        if row:
+            writer.writerow(row)
 
-        writer.writerow(row)
+def inventory_dump_row(pkg):
+    """ Returns the inventory dump row for a package, or None if it is not
+        an inventory item (i.e. it is published) """
+    import dateutil.parser
+
+    if not pkg.extras.get('unpublished', False):
+        return None
+
+    org = pkg.get_organization()
+    if not org:
+        # This should not happen, but does appear in test data during development
+        grp = 'Unknown'
+    else:
+        grp = org.title
+
+
+    publish_date = pkg.extras.get('publish-date', '')
+    if publish_date:
+        try:
+            dt = dateutil.parser.parse(publish_date)
+            publish_date = dt.strftime('%d/%m/%Y')
+        except Exception, e:
+            publish_date = ""
 
+    row = [pkg.title.encode('utf-8')]
+    row.append(pkg.notes.encode('utf-8') or "")
+    row.append(grp)
+    row.append(publish_date)
+    row.append(pkg.extras.get('release-notes', '').encode('utf-8'))
+    return row
 
 
 def enqueue_document(user, filename, publisher):
@@ -120,6 +129,70 @@ def render_inventory_row(writer, datasets, group):
         writer.writerow(row)
 
 
+def inventory_download_rows(groups, groups_per_batch=50):
+    """
+    Yields the inventory download rows (as render_inventory_row writes them,
+    but already encoded) of the active datasets of the groups, in the order
+    of the groups. The datasets, their numbers of resources and unpublished
+    extras are got in a few queries per batch of groups, rather than a few
+    per dataset.
+    """
+    from sqlalchemy import func
+    from ckan import model
+
+    def encode(s):
+        return s.encode('utf-8')
+
+    for i in xrange(0, len(groups), groups_per_batch):
+        batch = groups[i:i + groups_per_batch]
+        # as group.members_of_type(model.Package)
+        datasets = model.Session.query(model.Member.group_id,
+                                       model.Package.id,
+                                       model.Package.title,
+                                       model.Package.notes,
+                                       model.Package.state)\
+            .join(model.Package, model.Package.id == model.Member.table_id)\
+            .filter(model.Member.group_id.in_([g.id for g in batch]))\
+            .filter(model.Member.table_name == 'package')\
+            .filter(model.Member.state == 'active')\
+            .filter(model.Package.state == 'active')\
+            .order_by(model.Package.name)\
+            .all()
+        dataset_ids = list(set(row.id for row in datasets))
+
+        num_resources = {}
+        unpublished = {}
+        for j in xrange(0, len(dataset_ids), 1000):
+            ids = dataset_ids[j:j + 1000]
+            # as len(dataset.resources)
+            num_resources.update(
+                model.Session.query(model.ResourceGroup.package_id,
+                                    func.count(model.Resource.id))
+                .join(model.Resource,
+                      model.Resource.resource_group_id == model.ResourceGroup.id)
+                .filter(model.ResourceGroup.package_id.in_(ids))
+                .filter(model.Resource.state != 'deleted')
+                .group_by(model.ResourceGroup.package_id))
+            unpublished.update(
+                model.Session.query(model.PackageExtra.package_id,
+                                    model.PackageExtra.value)
+                .filter(model.PackageExtra.package_id.in_(ids))
+                .filter(model.PackageExtra.key == 'unpublished')
+                .filter(model.PackageExtra.state == 'active'))
+
+        datasets_by_group_id = {}
+        for row in datasets:
+            datasets_by_group_id.setdefault(row.group_id, []).append(row)
+        for group in batch:
+            for dataset in datasets_by_group_id.get(group.id, []):
+                yield [encode(group.title),
+                       encode(dataset.title),
+                       encode(dataset.notes or "No description").strip(),
+                       str(num_resources.get(dataset.id, 0)),
+                       encode(unicode(unpublished.get(dataset.id, False))),
+                       encode(dataset.state)]
+
+
 class UploadFileHelper(object):
     """
     A contextmanager for handling file uploads by writing it to disk and
@@ -9,12 +9,21 @@ Linked Data Registries are currently at the 'proof of concept' stage. Current se
 Registries contain entites which are ignored:
 * system content
 * registers that are just containers for other registers
+
+The sub-registers of a register are downloaded in parallel. If a cache_dir is
+given, the downloads are kept there and only downloaded again if the server
+says they have changed (by ETag/Last-Modified).
 '''
 
+import hashlib
+import json
+import os
 import rdflib
 from rdflib.namespace import RDF, RDFS
+import requests
 import uuid
 import logging
+from multiprocessing.pool import ThreadPool
 
 from ckan.common import OrderedDict
 from ckanext.harvest.harvesters.base import HarvesterBase
@@ -36,6 +45,62 @@ DGU_TYPE__CONTROLLED_LIST = 'Controlled list'
 TTL_PARAM = '?_format=ttl'
 METADATA_PARAM = '&_view=with_metadata'
 
+# Number of registers downloaded at a time
+FETCH_THREADS = 4
+FETCH_TIMEOUT = 60
+
+log = logging.getLogger(__name__)
+
+def fetch(url, cache_dir=None):
+    '''Returns the content at the URL. If a cache_dir is given, the content
+    is kept there, along with its ETag/Last-Modified, and a conditional
+    request is made, so that it is only downloaded again if it has
+    changed.'''
+    headers = {}
+    if cache_dir:
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        content_filepath = os.path.join(cache_dir, key)
+        headers_filepath = content_filepath + '.json'
+        cached_headers = {}
+        if os.path.exists(content_filepath) and \
+                os.path.exists(headers_filepath):
+            with open(headers_filepath) as f:
+                cached_headers = json.load(f)
+        if cached_headers.get('etag'):
+            headers['If-None-Match'] = cached_headers['etag']
+        if cached_headers.get('last-modified'):
+            headers['If-Modified-Since'] = cached_headers['last-modified']
+
+    res = requests.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+    if res.status_code == 304 and headers:
+        log.debug('Not changed: %s', url)
+        with open(content_filepath, 'rb') as f:
+            return f.read()
+    res.raise_for_status()
+    content = res.content
+
+    if cache_dir:
+        new_headers = dict((header, res.headers[header])
+                           for header in ('etag', 'last-modified')
+                           if res.headers.get(header))
+        if new_headers:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            # write then rename, so that the cache is never half-written
+            for filepath, data in ((content_filepath, content),
+                                   (headers_filepath, json.dumps(new_headers))):
+                with open(filepath + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.rename(filepath + '.tmp', filepath)
+    return content
+
+def fetch_graph(url, cache_dir=None):
+    '''Returns an rdflib.Graph of the Turtle at the URL. Relative URIs in it
+    are resolved against the URL, as when rdflib downloads it itself.'''
+    graph = rdflib.Graph()
+    graph.parse(data=fetch(url, cache_dir), format='turtle', publicID=url)
+    return graph
+
 def printable_uri(uri):
     for namespace, abbrev in ((REG, 'reg'), (SKOS, 'skos'),
                               (OWL, 'owl'), (LDP, 'ldp')):
@@ -43,9 +108,13 @@ def printable_uri(uri):
     return uri
 
 class LinkedDataRegistry(object):
-    def __init__(self, top_level_uri):
+    def __init__(self, top_level_uri, cache_dir=None, threads=FETCH_THREADS):
         self.graphs = {}  # URI: rdflib.Graph()
+        self.subjects_by_type = {}  # URI: {rdf type: set(subject URIs)}
+        self.members = {}  # URI: [member item URIs]
         self.top_level_uri = top_level_uri
+        self.cache_dir = cache_dir
+        self.threads = threads
         self.get_resource(top_level_uri)
 
     #def _graph_has_resource(self, uri):
@@ -55,12 +124,41 @@ class LinkedDataRegistry(object):
         '''Returns the full details of the URI by resolving it directly.'''
         if str(uri) not in self.graphs:
             # need to download it
-            url = uri + TTL_PARAM
-            self.graphs[str(uri)] = rdflib.Graph()
-            self.graphs[str(uri)].parse(url)
+            self._add_graph(uri, fetch_graph(uri + TTL_PARAM, self.cache_dir))
         res = self.graphs[str(uri)].resource(uri)
         return res
 
+    def get_resources(self, uris):
+        '''Downloads the URIs (that aren't already) in parallel, so that
+        get_resource will have them.'''
+        uris = [uri for uri in uris if str(uri) not in self.graphs]
+        if not uris:
+            return
+        pool = ThreadPool(min(self.threads, len(uris)))
+        try:
+            graphs = pool.map(
+                lambda uri: fetch_graph(uri + TTL_PARAM, self.cache_dir), uris)
+        finally:
+            pool.close()
+            pool.join()
+        for uri, graph in zip(uris, graphs):
+            self._add_graph(uri, graph)
+
+    def _add_graph(self, uri, graph):
+        self.graphs[str(uri)] = graph
+        # index the subjects by rdf type, once
+        subjects_by_type = {}
+        for subj_uri, type_uri in graph.subject_objects(RDF.type):
+            subjects_by_type.setdefault(type_uri, set()).add(subj_uri)
+        self.subjects_by_type[str(uri)] = subjects_by_type
+
+    def release(self, uri):
+        '''Frees the memory used for the URI's graph, once it is finished
+        with. (get_resource and get_member_items will download it again, if
+        needed.)'''
+        for by_uri in (self.graphs, self.subjects_by_type, self.members):
+            by_uri.pop(str(uri), None)
+
     def has_sub_registers(self, register):
         for subreg in register[REG.subregister]:
             return True
@@ -81,20 +179,28 @@ class LinkedDataRegistry(object):
         return False
 
     def get_member_items(self, register):
-        graph = self.graphs[str(register.identifier)]
-        for subj_uri in set(graph.subjects()):
-            if type(subj_uri) == rdflib.term.BNode:
-                # not sure where the blank nodes are from
-                continue
-            if subj_uri == register.identifier:
-                # ignore triples about itself - we just want its children
-                continue
-            subj = graph.resource(subj_uri)
-            types = [t.identifier for t in subj[RDF.type]]
-            if REG.Register in types:
-                # ignore sub-registers
-                continue
-            yield subj  # NB it's only the triples given when resolving its parent
+        uri = str(register.identifier)
+        if uri not in self.graphs:
+            # it has been released, so download it again
+            self.get_resource(register.identifier)
+        graph = self.graphs[uri]
+        if uri not in self.members:
+            sub_registers = self.subjects_by_type[uri].get(REG.Register, set())
+            members = []
+            for subj_uri in set(graph.subjects()):
+                if type(subj_uri) == rdflib.term.BNode:
+                    # not sure where the blank nodes are from
+                    continue
+                if subj_uri == register.identifier:
+                    # ignore triples about itself - we just want its children
+                    continue
+                if subj_uri in sub_registers:
+                    # ignore sub-registers
+                    continue
+                members.append(subj_uri)
+            self.members[uri] = members
+        for subj_uri in self.members[uri]:
+            yield graph.resource(subj_uri)  # NB it's only the triples given when resolving its parent
 
     def should_harvest_register(self, register):
         # Harvest if it contains a member item (not expecting sub-registers)
@@ -121,11 +227,18 @@ class LinkedDataRegistry(object):
         res = self.get_resource(uri)
         if self.should_harvest_register(res):
             yield res
+            # the register and its members have been dealt with
+            self.release(uri)
         else:
+            subres_uris = []
             for subres_uri in self.get_sub_registers(res):
                 if '/system/' in subres_uri:
                     print 'Skipping system register: ', subres_uri
                     continue
+                subres_uris.append(subres_uri)
+            self.release(uri)
+            self.get_resources(subres_uris)
+            for subres_uri in subres_uris:
                 for res in self._get_harvestable_resources(subres_uri, recurses + 1):
                     yield res
 
@@ -206,12 +319,12 @@ class LinkedDataRegistryHarvester(HarvesterBase, p.SingletonPlugin):
         else:
             extras['licence_url'] = licence_url
             # not sure how this will display as just as URL
-        pkg_dict['owner_org'] = cls.get_publisher(resource).id
+        pkg_dict['owner_org'] = cls.get_publisher(resource, ldr.cache_dir).id
         resources.append({'description': 'Web page for this %s on a Linked Data Registry' % dgu_type,
                           'url': uri,
                           'format': 'HTML',
                           'resource_type': 'documentation'})
-        metadata = cls.get_resource_metadata(uri)
+        metadata = cls.get_resource_metadata(uri, ldr.cache_dir)
         status = metadata[REG.status].next()
         extras['status'] = str(status).split('#')[-1]
         extras['harvested_version'] = str(metadata[OWL.versionInfo].next())
@@ -223,23 +336,22 @@ class LinkedDataRegistryHarvester(HarvesterBase, p.SingletonPlugin):
         return pkg_dict, action
 
     @classmethod
-    def get_resource_metadata(cls, uri):
+    def get_resource_metadata(cls, uri, cache_dir=None):
         url = uri + TTL_PARAM + METADATA_PARAM
-        graph = rdflib.Graph()
-        graph.parse(url)
+        graph = fetch_graph(url, cache_dir)
         uri_parts = uri.split('/')
         uri_parts[-1] = '_' + uri_parts[-1]
         metadata_uri = '/'.join(uri_parts)
         return graph.resource(metadata_uri)
 
     @classmethod
-    def get_publisher(cls, resource):
+    def get_publisher(cls, resource, cache_dir=None):
         from ckan import model
 
         publisher_uri = str(resource[DCT.publisher].next().identifier)
         assert publisher_uri
         publisher_url = publisher_uri + TTL_PARAM
-        publisher_graph = rdflib.Graph().parse(publisher_url)
+        publisher_graph = fetch_graph(publisher_url, cache_dir)
         publisher_resource = publisher_graph.resource(publisher_uri)
         publisher_label = unicode(publisher_resource[RDFS.label].next())
         results = model.Group.search_by_name_or_title(publisher_label, is_org=True).all()
@@ -324,10 +436,12 @@ if __name__ == '__main__':
     themeLogger.addHandler(handler)
     #logging.basicConfig(level=logging.DEBUG, format='%(message)s')
 
+    from pylons import config
     top_uri = 'http://environment.data.gov.uk/registry/def'
     #top_uri = 'http://codes.wmo.int/'
     #top_uri = 'http://codes.wmo.int/49-2'
-    ldr = LinkedDataRegistry(top_uri)
+    ldr = LinkedDataRegistry(
+        top_uri, cache_dir=config.get('dgu.linked_data_registry_cache_dir'))
     #res = ldr.get_resource(top_uri)
     #sr = [sr for sr in ldr.get_sub_registers(res)][0]
     #ldr.get_resource(sr.identifier)
@@ -1,32 +1,169 @@
-from ckan import model
+import time
 import logging
 
+from sqlalchemy import func
+
+from ckan import model
+
 log = logging.getLogger(__name__)
 
+
+class PublisherHierarchy(object):
+    '''Singleton holding the whole organization tree in memory, so that
+    ancestors, descendants and top-level publisher can be found with
+    dictionary lookups, rather than a member query per level of the tree.
+
+    It is loaded on first use and thrown away by PublisherPlugin.before_commit
+    whenever organizations or their membership change. Since other processes
+    won't see that, it is also reloaded once it is older than
+    dgu.publisher_hierarchy_max_age seconds (default 300).
+    '''
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance and cls._instance.is_stale():
+            cls._instance = None
+        if not cls._instance:
+            cls._instance = PublisherHierarchy()
+        return cls._instance
+
+    @classmethod
+    def invalidate(cls):
+        cls._instance = None
+
+    def __init__(self):
+        from pylons import config
+        self.max_age = int(config.get('dgu.publisher_hierarchy_max_age', 300))
+        self.loaded = time.time()
+        self.names = {}      # id:name
+        self.ids = {}        # name:id
+        self.parent = {}     # id:parent_id
+        self.children = {}   # id:[child_id]
+
+        for id_, name in model.Session.query(model.Group.id, model.Group.name)\
+                .filter(model.Group.type == 'organization'):
+            self.names[id_] = name
+            self.ids[name] = id_
+            self.children[id_] = []
+
+        parent_links = model.Session.query(model.Member.table_id,
+                                           model.Member.group_id)\
+            .filter(model.Member.table_name == 'group')\
+            .filter(model.Member.state == 'active')\
+            .order_by(model.Member.table_id, model.Member.group_id)
+        for child_id, parent_id in parent_links:
+            if child_id not in self.names or parent_id not in self.names:
+                continue
+            if child_id in self.parent:
+                log.warning('Publisher %s has more than one parent publisher. '
+                            'Ignoring all but the first.',
+                            self.names[child_id])
+                continue
+            self.parent[child_id] = parent_id
+            self.children[parent_id].append(child_id)
+        for child_ids in self.children.values():
+            child_ids.sort(key=self.names.get)
+
+        self._ancestors = {}
+        self._descendants = {}
+
+    def is_stale(self):
+        return time.time() - self.loaded > self.max_age
+
+    def _id(self, publisher_name_or_id):
+        if publisher_name_or_id in self.names:
+            return publisher_name_or_id
+        return self.ids.get(publisher_name_or_id)
+
+    def ancestor_ids(self, publisher_name_or_id):
+        '''Returns the ids of the publisher and its ancestors, starting with
+        the publisher itself and ending with the top-level one.'''
+        id_ = self._id(publisher_name_or_id)
+        if id_ is None:
+            return []
+        if id_ not in self._ancestors:
+            ancestors = []
+            next_id = id_
+            while next_id is not None and next_id not in ancestors:
+                ancestors.append(next_id)
+                next_id = self.parent.get(next_id)
+            if next_id is not None:
+                log.error('Publisher hierarchy has a loop: %s',
+                          [self.names[a] for a in ancestors])
+            self._ancestors[id_] = ancestors
+        return self._ancestors[id_]
+
+    def descendant_ids(self, publisher_name_or_id):
+        '''Returns the ids of the publisher and all its descendants, depth
+        first, starting with the publisher itself.'''
+        id_ = self._id(publisher_name_or_id)
+        if id_ is None:
+            return []
+        if id_ not in self._descendants:
+            descendants = []
+            to_visit = [id_]
+            while to_visit:
+                next_id = to_visit.pop()
+                if next_id in descendants:
+                    continue
+                descendants.append(next_id)
+                to_visit.extend(reversed(self.children[next_id]))
+            self._descendants[id_] = descendants
+        return self._descendants[id_]
+
+    def top_level_id(self, publisher_name_or_id):
+        ancestors = self.ancestor_ids(publisher_name_or_id)
+        return ancestors[-1] if ancestors else None
+
+    def ancestor_names(self, publisher_name_or_id):
+        return [self.names[id_]
+                for id_ in self.ancestor_ids(publisher_name_or_id)]
+
+    def descendant_names(self, publisher_name_or_id):
+        return [self.names[id_]
+                for id_ in self.descendant_ids(publisher_name_or_id)]
+
+
+def _groups_in_order(group_ids):
+    '''Loads the Groups with the given ids in one query, returning them in
+    the same order.'''
+    if not group_ids:
+        return []
+    groups = dict((g.id, g) for g in model.Session.query(model.Group)
+                  .filter(model.Group.id.in_(group_ids)))
+    return [groups[id_] for id_ in group_ids if id_ in groups]
+
+
 def go_up_tree(publisher):
     '''Provided with a publisher object, it walks up the hierarchy and yields
     each publisher, including the one you supply.
 
-    Essentially this is a slower version of Group.get_parent_group_hierarchy
-    because it returns Group objects, rather than dicts. And it includes the
-    publisher you supply.
+    Essentially this is a version of Group.get_parent_group_hierarchy that
+    returns Group objects, rather than dicts. And it includes the publisher
+    you supply.
     '''
-    yield publisher
-    for parent in publisher.get_parent_groups(type='organization'):
-        for grandparent in go_up_tree(parent):
-            yield grandparent
+    ancestor_ids = PublisherHierarchy.instance().ancestor_ids(publisher.id)
+    if not ancestor_ids:
+        # e.g. created since the hierarchy was loaded
+        yield publisher
+        return
+    for group in _groups_in_order(ancestor_ids):
+        yield publisher if group.id == publisher.id else group
 
 def go_down_tree(publisher):
     '''Provided with a publisher object, it walks down the hierarchy and yields
     each publisher, including the one you supply.
-   
-    Essentially this is a slower version of Group.get_children_group_hierarchy
-    because it returns Group objects, rather than dicts.
+
+    Essentially this is a version of Group.get_children_group_hierarchy that
+    returns Group objects, rather than dicts.
     '''
-    yield publisher
-    for child in publisher.get_children_groups(type='organization'):
-        for grandchild in go_down_tree(child):
-            yield grandchild
+    descendant_ids = PublisherHierarchy.instance().descendant_ids(publisher.id)
+    if not descendant_ids:
+        yield publisher
+        return
+    for group in _groups_in_order(descendant_ids):
+        yield publisher if group.id == publisher.id else group
 
 def find_group_admins(group):
     '''Look for publisher admins up the tree'''
@@ -46,6 +183,10 @@ def cached_openness_scores(reports_to_run=None):
     This function is called by the ICachedReport plugin which will
     iterate over all of the publishers and generate an openness score
     for them on a regular basis
+
+    The scores of all datasets are counted in one query, and added up for
+    each publisher (with and without its sub-publishers) in memory. A
+    dataset in more than one of the publishers is only counted once.
     """
     import json
     from ckan.lib.json import DateTimeJsonEncoder
@@ -64,19 +205,115 @@ def cached_openness_scores(reports_to_run=None):
     log.info("Generating openness-scores report")
     log.info("Fetching %d publishers" % publishers.count())
 
+    counts_by_package = openness_scores_by_package()
+    package_ids_by_publisher = publisher_package_ids()
     for publisher in publishers.all():
         # Run the openness report with and without include_sub_organisations set
         if 'openness-scores' in local_reports:
-          log.info("Generating openness scores for %s" % publisher.name)
-          val = openness_scores(publisher, use_cache=False)
+          package_ids = package_ids_by_publisher.get(publisher.id, ())
+          val = _sum_openness_scores(counts_by_package, package_ids)
           model.DataCache.set(publisher.name, "openness-scores", json.dumps(val,cls=DateTimeJsonEncoder))
 
         if 'openness-scores-withsub' in local_reports:
-          val = openness_scores(publisher, include_sub_publishers=True, use_cache=False)
+          package_ids = packages_of_publishers(package_ids_by_publisher,
+                                               _publisher_ids(publisher, True))
+          val = _sum_openness_scores(counts_by_package, package_ids)
           model.DataCache.set(publisher.name, "openness-scores-withsub", json.dumps(val,cls=DateTimeJsonEncoder))
 
     model.Session.commit()
 
+def _publisher_ids(publisher, include_sub_publishers):
+    if include_sub_publishers:
+        return PublisherHierarchy.instance().descendant_ids(publisher.id) \
+            or [publisher.id]
+    return [publisher.id]
+
+def _publisher_packages_query(publisher_ids):
+    return model.Session.query(model.Member.table_id)\
+        .filter(model.Member.table_name == 'package')\
+        .filter(model.Member.state == 'active')\
+        .filter(model.Member.group_id.in_(publisher_ids))
+
+def package_resources_query(publisher_ids, *columns):
+    '''Query over the active resources of active datasets, with the
+    dataset id as the first column. Optionally filtered to the datasets of
+    the given publishers - a dataset in more than one of them still has
+    each of its resources just once.'''
+    q = model.Session.query(model.Package.id, *columns)\
+        .join(model.ResourceGroup,
+              model.ResourceGroup.package_id == model.Package.id)\
+        .join(model.Resource,
+              model.Resource.resource_group_id == model.ResourceGroup.id)\
+        .filter(model.Package.state == 'active')\
+        .filter(model.Resource.state == 'active')
+    if publisher_ids is not None:
+        q = q.filter(model.Package.id.in_(
+            _publisher_packages_query(publisher_ids).subquery()))
+    return q
+
+def publisher_package_ids(publisher_ids=None):
+    """
+        Returns the ids of the active datasets of every publisher (not
+        including sub-publishers), or just the given ones, like:
+        {publisher_id: set([package_id, ...])}
+    """
+    from collections import defaultdict
+
+    q = model.Session.query(model.Member.group_id, model.Member.table_id)\
+        .join(model.Package, model.Package.id == model.Member.table_id)\
+        .filter(model.Member.table_name == 'package')\
+        .filter(model.Member.state == 'active')\
+        .filter(model.Package.state == 'active')
+    if publisher_ids is not None:
+        q = q.filter(model.Member.group_id.in_(publisher_ids))
+
+    package_ids = defaultdict(set)
+    for publisher_id, package_id in q:
+        package_ids[publisher_id].add(package_id)
+    return package_ids
+
+def packages_of_publishers(package_ids_by_publisher, publisher_ids):
+    '''The ids of the datasets of any of the given publishers, from the
+    result of publisher_package_ids().'''
+    package_ids = set()
+    for publisher_id in publisher_ids:
+        package_ids.update(package_ids_by_publisher.get(publisher_id, ()))
+    return package_ids
+
+def openness_scores_by_package(publisher_ids=None):
+    """
+        Counts the resources with each openness score (from the task_status
+        table), for every dataset, or just those of the given publishers, in
+        one grouped query. Returns a dict like:
+        {package_id: {'0': 3, '1': 0, '2': 1 ...}}
+    """
+    from collections import defaultdict
+
+    q = package_resources_query(publisher_ids,
+                                model.TaskStatus.value,
+                                func.count(model.Resource.id))\
+        .join(model.TaskStatus,
+              model.TaskStatus.entity_id == model.Resource.id)\
+        .filter(model.TaskStatus.task_type == 'qa')\
+        .filter(model.TaskStatus.entity_type == 'resource')\
+        .filter(model.TaskStatus.key == 'openness_score')\
+        .group_by(model.Package.id, model.TaskStatus.value)
+
+    counts = defaultdict(lambda: defaultdict(int))
+    for package_id, score, count in q:
+        counts[package_id][str(int(score))] += count
+    return counts
+
+def _sum_openness_scores(counts_by_package, package_ids):
+    from collections import defaultdict
+
+    d = defaultdict(int)
+    for package_id in package_ids:
+        for score, count in counts_by_package.get(package_id, {}).items():
+            d[score] += count
+    total = sum(d.values())
+    return total, d
+
 def openness_scores(publisher, include_sub_publishers=False, use_cache=True):
     """
         For the provided publisher, this grabs the resource ids
@@ -85,8 +322,6 @@ def openness_scores(publisher, include_sub_publishers=False, use_cache=True):
         the same as the resource count) and dictionary containing
         a count for each score such as {0:3, 1:0, 2:1 ...}
     """
-    from collections import defaultdict
-
     if use_cache:
         key = 'openness-scores'
         if include_sub_publishers:
@@ -96,51 +331,17 @@ def openness_scores(publisher, include_sub_publishers=False, use_cache=True):
             log.info("Found openness score in cache: %s" % cache)
             return cache
 
-
-    q = """SELECT TS.value::INT from task_status  as TS
-           WHERE TS.task_type='qa' AND
-                 TS.entity_type ='resource' AND
-                 TS.key = 'openness_score' AND
-                 TS.entity_id in (
-                   SELECT R.id from resource  as R
-                   INNER JOIN resource_group as RG ON RG.id = R.resource_group_id
-                   INNER JOIN package as P ON P.id = RG.package_id
-                   WHERE P.state = 'active' AND R.state='active' AND
-                         P.id in (SELECT table_id FROM member
-                                  WHERE group_id in ({pub_id})
-                                  AND table_name='package' AND state='active')
-                                 );"""
-
-    d = defaultdict(int)
-
-    if include_sub_publishers:
-        pubids = ["'%s'" % p.id for p in go_down_tree(publisher)]
-    else:
-        pubids = ["'%s'" % publisher.id]
-
-    for m in model.Session.execute(q.format(pub_id=','.join(pubids))):
-        d[str(m[0])] += 1
-    total = sum(d.values())
-
-    return total, d
+    pubids = _publisher_ids(publisher, include_sub_publishers)
+    counts = openness_scores_by_package(pubids)
+    return _sum_openness_scores(counts, counts.keys())
 
 def resource_count(publisher, include_sub_publishers=False):
     """
         Counts the number of active resources within active datasets and
         returns the scalar.
     """
-    q = """SELECT count(R.id) from resource  as R
-           INNER JOIN resource_group as RG ON RG.id = R.resource_group_id
-           INNER JOIN package as P ON P.id = RG.package_id
-           WHERE P.state = 'active' AND R.state='active' AND
-                 P.id in (SELECT table_id FROM member
-                          WHERE group_id IN ({pub_id})
-                          AND table_name='package' AND state='active');"""
-
-    if include_sub_publishers:
-        pubids = ["'%s'" % p.id for p in go_down_tree(publisher)]
-    else:
-        pubids = ["'%s'" % publisher.id]
-
-    return model.Session.scalar(q.format(pub_id=','.join(pubids)))
+    pubids = _publisher_ids(publisher, include_sub_publishers)
+    return package_resources_query(pubids)\
+        .with_entities(func.count(model.Resource.id))\
+        .scalar()
 
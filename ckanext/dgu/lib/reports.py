@@ -1,57 +1,113 @@
 import collections
 import datetime
+import itertools
 import logging
 import os
+import time
+
+import sqlalchemy
 
 from ckan import model
 from ckan.lib.helpers import OrderedDict
 import ckan.plugins as p
 from ckanext.report import lib
-from ckanext.dgu.lib.publisher import go_up_tree
+from ckanext.dgu.lib.publisher import go_up_tree, PublisherHierarchy
 from ckanext.dgu.lib import helpers as dgu_helpers
 
 log = logging.getLogger(__name__)
 
 
+# Report pre-computation
+#
+# When a report is cached for every organization, with and without
+# sub-organizations, its *_combinations generator first works out a partial
+# result for every organization in one pass over the data. The report's
+# generate function then merges the partial results of the organization and,
+# if asked, its sub-organizations, rather than querying again.
+
+_precomputed = {}  # report_name: (timestamp, data)
+PRECOMPUTED_MAX_AGE = datetime.timedelta(hours=1)
+
+def set_precomputed(report_name, data):
+    _precomputed[report_name] = (datetime.datetime.now(), data)
+
+def get_precomputed(report_name):
+    '''Returns the data precomputed for the report, if it is recent,
+    otherwise None.'''
+    timestamp, data = _precomputed.get(report_name, (None, None))
+    if timestamp and datetime.datetime.now() - timestamp < PRECOMPUTED_MAX_AGE:
+        return data
+    return None
+
+def clear_precomputed(report_name):
+    _precomputed.pop(report_name, None)
+
+def organization_ids(organization, include_sub_organizations):
+    '''Returns the ids of the organization and, if asked, its
+    sub-organizations.'''
+    if include_sub_organizations:
+        return PublisherHierarchy.instance().descendant_ids(organization.id) \
+            or [organization.id]
+    return [organization.id]
+
+def merge_precomputed(partials_by_organization_id, organization,
+                      include_sub_organizations):
+    '''Returns the list of precomputed partial results for the organization
+    and, if asked, its sub-organizations.'''
+    return [partials_by_organization_id[id_]
+            for id_ in organization_ids(organization, include_sub_organizations)
+            if id_ in partials_by_organization_id]
+
+
 # NII
 
 
-def nii_report():
-    '''A list of the NII datasets, grouped by publisher, with details of broken
-    links and source.'''
-    nii_dataset_q = model.Session.query(model.Package)\
+def nii_datasets():
+    '''Yields (dataset_details, organization, num_resources) for each NII
+    dataset, ordered by publisher and title.
+
+    The datasets, their organizations, resource counts and broken resources
+    are all got in one query, which has a row per broken resource. These are
+    grouped back into datasets here.'''
+    from ckanext.archiver.model import Archival
+
+    num_resources_q = model.Session.query(
+            model.ResourceGroup.package_id,
+            sqlalchemy.func.count(model.Resource.id).label('num_resources'))\
+        .join(model.Resource,
+              model.Resource.resource_group_id == model.ResourceGroup.id)\
+        .filter(model.Resource.state != 'deleted')\
+        .group_by(model.ResourceGroup.package_id)\
+        .subquery()
+    broken_q = model.Session.query(
+            Archival.package_id,
+            model.Resource.id.label('resource_id'),
+            model.Resource.description.label('resource_description'))\
+        .join(model.Resource, Archival.resource_id == model.Resource.id)\
+        .filter(Archival.is_broken == True)\
+        .filter(model.Resource.state == 'active')\
+        .subquery()
+    rows = model.Session.query(model.Package, model.Group,
+                               num_resources_q.c.num_resources,
+                               broken_q.c.resource_id,
+                               broken_q.c.resource_description)\
         .join(model.PackageExtra, model.PackageExtra.package_id == model.Package.id)\
         .join(model.Group, model.Package.owner_org == model.Group.id)\
+        .outerjoin(num_resources_q,
+                   num_resources_q.c.package_id == model.Package.id)\
+        .outerjoin(broken_q, broken_q.c.package_id == model.Package.id)\
         .filter(model.PackageExtra.key == 'core-dataset')\
         .filter(model.PackageExtra.value == 'true')\
-        .filter(model.Package.state == 'active')
-    nii_dataset_objects = nii_dataset_q\
-            .order_by(model.Group.title, model.Package.title).all()
-
-    def broken_resources_for_package(package_id):
-        from ckanext.archiver.model import Archival
-
-        results = model.Session.query(Archival, model.Resource)\
-                       .filter(Archival.package_id == package_id)\
-                       .filter(Archival.is_broken == True)\
-                       .join(model.Package, Archival.package_id == model.Package.id)\
-                       .filter(model.Package.state == 'active')\
-                       .join(model.Resource, Archival.resource_id == model.Resource.id)\
-                       .filter(model.Resource.state == 'active')
-
-        broken_resources = [(resource.description, resource.id)
-                            for archival, resource in results.all()]
-        return broken_resources
-
-    nii_dataset_details = []
-    num_resources = 0
-    num_broken_resources = 0
-    num_broken_datasets = 0
-    broken_organization_names = set()
-    nii_organizations = set()
-    for dataset_object in nii_dataset_objects:
-        broken_resources = broken_resources_for_package(dataset_object.id)
-        org = dataset_object.get_organization()
+        .filter(model.Package.state == 'active')\
+        .options(sqlalchemy.orm.subqueryload('_extras'))\
+        .order_by(model.Group.title, model.Package.title, model.Package.id)
+
+    for (dataset_object, org, num_resources), dataset_rows in \
+            itertools.groupby(rows, key=lambda row: row[:3]):
+        broken_resources = [(resource_description, resource_id)
+                            for _, _, _, resource_id, resource_description
+                            in dataset_rows
+                            if resource_id]
         dataset_details = {
                 'name': dataset_object.name,
                 'title': dataset_object.title,
@@ -61,13 +117,26 @@ def nii_report():
                 'num_broken_resources': len(broken_resources),
                 'broken_resources': broken_resources,
                 }
+        yield dataset_details, org, num_resources or 0
+
+def nii_report():
+    '''A list of the NII datasets, grouped by publisher, with details of broken
+    links and source.'''
+    nii_dataset_details = []
+    num_resources = 0
+    num_broken_resources = 0
+    num_broken_datasets = 0
+    broken_organization_names = set()
+    nii_organizations = set()
+    for dataset_details, org, num_dataset_resources in nii_datasets():
         nii_dataset_details.append(dataset_details)
+        broken_resources = dataset_details['broken_resources']
         if broken_resources:
             num_broken_resources += len(broken_resources)
             num_broken_datasets += 1
             broken_organization_names.add(org.name)
         nii_organizations.add(org)
-        num_resources += len(dataset_object.resources)
+        num_resources += num_dataset_resources
 
     org_tuples = [(org.name, org.title) for org in
                   sorted(nii_organizations, key=lambda o: o.title)]
@@ -75,13 +144,28 @@ def nii_report():
     return {'table': nii_dataset_details,
             'organizations': org_tuples,
             'num_resources': num_resources,
-            'num_datasets': len(nii_dataset_objects),
+            'num_datasets': len(nii_dataset_details),
             'num_organizations': len(nii_organizations),
             'num_broken_resources': num_broken_resources,
             'num_broken_datasets': num_broken_datasets,
             'num_broken_organizations': len(broken_organization_names),
             }
 
+NII_CSV_HEADER = ('Publisher name', 'Publisher title', 'Dataset name',
+                  'Dataset title', 'Unpublished', 'Number of resources',
+                  'Number of broken resources', 'Broken resource IDs')
+
+def nii_report_csv_rows():
+    '''Yields the NII report as CSV rows (the header first), as the datasets
+    are read from the database, so the CSV can be streamed.'''
+    yield NII_CSV_HEADER
+    for dataset_details, org, num_resources in nii_datasets():
+        yield (org.name, org.title, dataset_details['name'],
+               dataset_details['title'], dataset_details['unpublished'],
+               num_resources, dataset_details['num_broken_resources'],
+               ' '.join(resource_id for _, resource_id
+                        in dataset_details['broken_resources']))
+
 nii_report_info = {
     'name': 'nii',
     'title': 'National Information Infrastructure',
@@ -106,15 +190,49 @@ def publisher_resources(organization=None,
     if not org:
         raise p.toolkit.ObjectNotFound('Publisher not found')
 
-    # Get packages
-    pkgs = model.Session.query(model.Package)\
-                .filter_by(state='active')
-    pkgs = lib.filter_by_organizations(pkgs, organization,
-                                       include_sub_organizations).all()
+    partials_by_org_id = get_precomputed('publisher-resources')
+    if partials_by_org_id is None:
+        partials_by_org_id = publisher_resources_by_organization(
+            organization_ids(org, include_sub_organizations))
+    partials = merge_precomputed(partials_by_org_id, org,
+                                 include_sub_organizations)
 
-    # Get their resources
-    def create_row(pkg_, resource_dict):
-        org_ = pkg_.get_organization()
+    return {'organization_name': org.name,
+            'organization_title': org.title,
+            'num_datasets': sum(partial['num_datasets'] for partial in partials),
+            'num_resources': sum(partial['num_resources'] for partial in partials),
+            'table': sum((partial['table'] for partial in partials), []),
+            }
+
+def publisher_resources_by_organization(organization_ids=None):
+    '''Works out the publisher_resources rows and counts for the datasets
+    of each organization (not including sub-organizations) - for all
+    organizations, or just the given ones.'''
+    pkgs = model.Session.query(model.Package)\
+                .filter_by(state='active')\
+                .options(sqlalchemy.orm.subqueryload('_extras'))\
+                .order_by(model.Package.name)
+    resources = model.Session.query(model.ResourceGroup.package_id,
+                                    model.Resource)\
+                     .join(model.Resource,
+                           model.Resource.resource_group_id == model.ResourceGroup.id)\
+                     .join(model.Package,
+                           model.Package.id == model.ResourceGroup.package_id)\
+                     .filter(model.Resource.state != 'deleted')\
+                     .filter(model.Package.state == 'active')\
+                     .order_by(model.Resource.position)
+    orgs = model.Session.query(model.Group)\
+                .filter(model.Group.type == 'organization')
+    if organization_ids is not None:
+        pkgs = pkgs.filter(model.Package.owner_org.in_(organization_ids))
+        resources = resources.filter(model.Package.owner_org.in_(organization_ids))
+        orgs = orgs.filter(model.Group.id.in_(organization_ids))
+    orgs = dict((org.id, org) for org in orgs)
+    resources_by_package_id = collections.defaultdict(list)
+    for package_id, res in resources:
+        resources_by_package_id[package_id].append(res)
+
+    def create_row(pkg_, org_, resource_dict):
         return OrderedDict((
                 ('publisher_title', org_.title),
                 ('publisher_name', org_.name),
@@ -128,10 +246,15 @@ def publisher_resources(organization=None,
                 ('resource_format', resource_dict.get('format')),
                 ('resource_created', resource_dict.get('created')),
                ))
-    num_resources = 0
-    rows = []
+    partials_by_org_id = {}
     for pkg in pkgs:
-        resources = pkg.resources
+        org = orgs.get(pkg.owner_org)
+        if not org:
+            continue
+        partial = partials_by_org_id.setdefault(
+            org.id, {'table': [], 'num_datasets': 0, 'num_resources': 0})
+        partial['num_datasets'] += 1
+        resources = resources_by_package_id[pkg.id]
         if resources:
             for res in resources:
                 res_dict = {'id': res.id, 'position': res.position,
@@ -139,24 +262,21 @@ def publisher_resources(organization=None,
                             'format': res.format,
                             'created': (res.created.isoformat()
                                         if res.created else None)}
-                rows.append(create_row(pkg, res_dict))
-            num_resources += len(resources)
+                partial['table'].append(create_row(pkg, org, res_dict))
+            partial['num_resources'] += len(resources)
         else:
             # packages with no resources are still listed
-            rows.append(create_row(pkg, {}))
-
-    return {'organization_name': org.name,
-            'organization_title': org.title,
-            'num_datasets': len(pkgs),
-            'num_resources': num_resources,
-            'table': rows,
-            }
+            partial['table'].append(create_row(pkg, org, {}))
+    return partials_by_org_id
 
 def publisher_resources_combinations():
+    set_precomputed('publisher-resources',
+                    publisher_resources_by_organization())
     for organization in lib.all_organizations():
         for include_sub_organizations in (False, True):
                 yield {'organization': organization,
                        'include_sub_organizations': include_sub_organizations}
+    clear_precomputed('publisher-resources')
 
 publisher_resources_info = {
     'name': 'publisher-resources',
@@ -185,35 +305,185 @@ def get_quarter_dates(datetime_now):
             'last': (last_q_started, last_q_ended)}
 
 
+# These are the authors whose revisions we ignore, as they are trivial
+# changes. NB we do want to know about revisions by:
+# * harvest (harvested metadata)
+# * dgu (NS Stat Hub imports)
+# * Fix national indicators
+system_authors = ('autotheme', 'co-prod3.dh.bytemark.co.uk',
+                  'Date format tidier', 'current_revision_fixer',
+                  'current_revision_fixer2', 'fix_contact_details.py',
+                  'Repoint 410 Gone to webarchive url',
+                  'Fix duplicate resources',
+                  'fix_secondary_theme.py',
+                  )
+system_author_template = 'script-%'  # "%" is a wildcard
+
+
+class PublisherActivity(object):
+    '''The datasets created and modified in this and last quarter, worked out
+    for all datasets (or just the given ones) at once, in a few grouped
+    queries over the revision tables. The results can then be split up by
+    organization in memory.'''
+
+    def __init__(self, now, package_ids=None):
+        self.now = now
+        self.quarters = get_quarter_dates(now)
+        self.package_ids = package_ids
+        self.earliest = min(q[0] for q in self.quarters.values())
+        self.latest = max(q[1] for q in self.quarters.values())
+
+        # package_id: (name, title, timestamp, author) of its first revision
+        self.created = self._get_created()
+        # package_id: set of (author, date, latest timestamp that day)
+        self.modified = self._get_modified()
+
+    def _filter_packages(self, q, package_id_column):
+        if self.package_ids is not None:
+            q = q.filter(package_id_column.in_(self.package_ids))
+        return q
+
+    def _get_created(self):
+        # DISTINCT ON gives just the first revision of each package
+        q = model.Session.query(model.PackageRevision.id,
+                                model.PackageRevision.name,
+                                model.PackageRevision.title,
+                                model.PackageRevision.revision_timestamp,
+                                model.Revision.author)\
+            .join(model.Revision,
+                  model.Revision.id == model.PackageRevision.revision_id)\
+            .distinct(model.PackageRevision.id)\
+            .order_by(model.PackageRevision.id,
+                      model.PackageRevision.revision_timestamp)
+        q = self._filter_packages(q, model.PackageRevision.id)
+        return dict((row[0], row[1:]) for row in q)
+
+    def _get_modified(self):
+        def grouped(q, package_id_column, obj_revision_table):
+            timestamp_column = obj_revision_table.revision_timestamp
+            # Only the authors and dates are reported, so one row per
+            # author per day is enough. The latest timestamp is kept to
+            # compare with the time the package was created.
+            day = sqlalchemy.func.date_trunc('day', timestamp_column)
+            q = q.join(model.Revision,
+                       model.Revision.id == obj_revision_table.revision_id)\
+                .filter(timestamp_column > self.earliest)\
+                .filter(timestamp_column < self.latest)\
+                .filter(~model.Revision.author.in_(system_authors))\
+                .filter(~model.Revision.author.like(system_author_template))\
+                .group_by(package_id_column, model.Revision.author, day)
+            return self._filter_packages(q, package_id_column)
+
+        queries = (
+            grouped(model.Session.query(
+                        model.PackageRevision.id, model.Revision.author,
+                        sqlalchemy.func.max(model.PackageRevision.revision_timestamp))
+                    .filter(model.PackageRevision.state == 'active'),
+                    model.PackageRevision.id, model.PackageRevision),
+            grouped(model.Session.query(
+                        model.Package.id, model.Revision.author,
+                        sqlalchemy.func.max(model.ResourceRevision.revision_timestamp))
+                    .filter(model.Package.state == 'active')
+                    .join(model.ResourceGroup)
+                    .join(model.ResourceRevision,
+                          model.ResourceGroup.id == model.ResourceRevision.resource_group_id),
+                    model.Package.id, model.ResourceRevision),
+            grouped(model.Session.query(
+                        model.Package.id, model.Revision.author,
+                        sqlalchemy.func.max(model.PackageExtraRevision.revision_timestamp))
+                    .filter(model.Package.state == 'active')
+                    .join(model.PackageExtraRevision,
+                          model.Package.id == model.PackageExtraRevision.package_id),
+                    model.Package.id, model.PackageExtraRevision),
+            )
+        modified = collections.defaultdict(set)
+        for q in queries:
+            for package_id, author, timestamp in q:
+                modified[package_id].add((author, timestamp.date(), timestamp))
+        return modified
+
+    def table(self, package_ids=None):
+        '''Returns the report rows for the given packages (default all of
+        them), sorted as the report shows them.'''
+        from paste.deploy.converters import asbool
+
+        if package_ids is None:
+            package_ids = set(self.created) | set(self.modified)
+        created = {'this': [], 'last': []}
+        modified = {'this': [], 'last': []}
+
+        events = {}  # (package_id, quarter_name, event): details
+        for package_id in package_ids:
+            if package_id not in self.created:
+                continue
+            name, title, created_timestamp, created_author = \
+                self.created[package_id]
+            for quarter_name, quarter in self.quarters.items():
+                # created
+                if quarter[0] < created_timestamp < quarter[1]:
+                    events[(package_id, quarter_name, 'created')] = \
+                        (name, title, created_timestamp, created_author)
+
+                # modified
+                # exclude the creation revision
+                period_start = max(quarter[0], created_timestamp)
+                changes = [(author, date) for author, date, timestamp
+                           in self.modified.get(package_id, ())
+                           if period_start < timestamp and date < quarter[1].date()]
+                if changes:
+                    events[(package_id, quarter_name, 'modified')] = changes
+        if not events:
+            return []
+
+        # Only now load the packages that feature, for the notes etc
+        pkgs = dict((pkg.id, pkg) for pkg in
+                    model.Session.query(model.Package)
+                         .filter(model.Package.id.in_(
+                             set(key[0] for key in events))))
+        for (package_id, quarter_name, event), details in events.items():
+            pkg = pkgs.get(package_id)
+            if not pkg:
+                continue
+            published = not asbool(pkg.extras.get('unpublished'))
+            if event == 'created':
+                name, title, timestamp, author = details
+                created[quarter_name].append(
+                    (name, title, lib.dataset_notes(pkg),
+                     'created', quarter_name,
+                     timestamp.isoformat(), author, published))
+            else:
+                authors = ' '.join(set(author for author, date in details))
+                dates = set(date for author, date in details)
+                dates_formatted = ' '.join([date.isoformat()
+                                            for date in sorted(dates)])
+                modified[quarter_name].append(
+                    (pkg.name, pkg.title, lib.dataset_notes(pkg),
+                        'modified', quarter_name,
+                        dates_formatted, authors, published))
+
+        datasets = []
+        for quarter_name in self.quarters:
+            datasets += sorted(created[quarter_name], key=lambda x: x[1])
+            datasets += sorted(modified[quarter_name], key=lambda x: x[1])
+        return datasets
+
+
+def get_all_publisher_activity(now):
+    '''Returns the PublisherActivity for all datasets, if it has been
+    precomputed recently (today), otherwise None.'''
+    activity = get_precomputed('publisher-activity')
+    if activity and activity.now.date() == now.date():
+        return activity
+    return None
+
+
 def publisher_activity(organization, include_sub_organizations=False):
     """
     Contains information about the datasets a specific organization has
     released in this and last quarter (calendar year). This is needed by
     departments for their quarterly transparency reports.
     """
-    import datetime
-    import ckan.model as model
-    from paste.deploy.converters import asbool
-
-    # These are the authors whose revisions we ignore, as they are trivial
-    # changes. NB we do want to know about revisions by:
-    # * harvest (harvested metadata)
-    # * dgu (NS Stat Hub imports)
-    # * Fix national indicators
-    system_authors = ('autotheme', 'co-prod3.dh.bytemark.co.uk',
-                      'Date format tidier', 'current_revision_fixer',
-                      'current_revision_fixer2', 'fix_contact_details.py',
-                      'Repoint 410 Gone to webarchive url',
-                      'Fix duplicate resources',
-                      'fix_secondary_theme.py',
-                      )
-    system_author_template = 'script-%'  # "%" is a wildcard
-
-    created = {'this': [], 'last': []}
-    modified = {'this': [], 'last': []}
-
     now = datetime.datetime.now()
-    quarters = get_quarter_dates(now)
 
     if organization:
         organization = model.Group.by_name(organization)
@@ -221,94 +491,34 @@ def publisher_activity(organization, include_sub_organizations=False):
             raise p.toolkit.ObjectNotFound()
 
     if not organization:
-        pkgs = model.Session.query(model.Package)\
-                .all()
+        package_ids = None
     else:
-        pkgs = model.Session.query(model.Package)
-        pkgs = lib.filter_by_organizations(pkgs, organization,
-                                           include_sub_organizations).all()
-
-    for pkg in pkgs:
-        created_ = model.Session.query(model.PackageRevision)\
-            .filter(model.PackageRevision.id == pkg.id) \
-            .order_by("revision_timestamp asc").first()
-
-        pr_q = model.Session.query(model.PackageRevision, model.Revision)\
-            .filter(model.PackageRevision.id == pkg.id)\
-            .filter_by(state='active')\
-            .join(model.Revision)\
-            .filter(~model.Revision.author.in_(system_authors)) \
-            .filter(~model.Revision.author.like(system_author_template))
-        rr_q = model.Session.query(model.Package, model.ResourceRevision, model.Revision)\
-            .filter(model.Package.id == pkg.id)\
-            .filter_by(state='active')\
-            .join(model.ResourceGroup)\
-            .join(model.ResourceRevision,
-                  model.ResourceGroup.id == model.ResourceRevision.resource_group_id)\
-            .join(model.Revision)\
-            .filter(~model.Revision.author.in_(system_authors))\
-            .filter(~model.Revision.author.like(system_author_template))
-        pe_q = model.Session.query(model.Package, model.PackageExtraRevision, model.Revision)\
-            .filter(model.Package.id == pkg.id)\
-            .filter_by(state='active')\
-            .join(model.PackageExtraRevision,
-                  model.Package.id == model.PackageExtraRevision.package_id)\
-            .join(model.Revision)\
-            .filter(~model.Revision.author.in_(system_authors))\
-            .filter(~model.Revision.author.like(system_author_template))
-
-        for quarter_name in quarters:
-            quarter = quarters[quarter_name]
-            # created
-            if quarter[0] < created_.revision_timestamp < quarter[1]:
-                published = not asbool(pkg.extras.get('unpublished'))
-                created[quarter_name].append(
-                    (created_.name, created_.title, lib.dataset_notes(pkg),
-                     'created', quarter_name,
-                     created_.revision_timestamp.isoformat(),
-                     created_.revision.author, published))
-
-            # modified
-            # exclude the creation revision
-            period_start = max(quarter[0], created_.revision_timestamp)
-            prs = pr_q.filter(model.PackageRevision.revision_timestamp > period_start)\
-                        .filter(model.PackageRevision.revision_timestamp < quarter[1])
-            rrs = rr_q.filter(model.ResourceRevision.revision_timestamp > period_start)\
-                        .filter(model.ResourceRevision.revision_timestamp < quarter[1])
-            pes = pe_q.filter(model.PackageExtraRevision.revision_timestamp > period_start)\
-                        .filter(model.PackageExtraRevision.revision_timestamp < quarter[1])
-            authors = ' '.join(set([r[1].author for r in prs] +
-                                   [r[2].author for r in rrs] +
-                                   [r[2].author for r in pes]))
-            dates = set([r[1].timestamp.date() for r in prs] +
-                        [r[2].timestamp.date() for r in rrs] +
-                        [r[2].timestamp.date() for r in pes])
-            dates_formatted = ' '.join([date.isoformat()
-                                        for date in sorted(dates)])
-            if authors:
-                published = not asbool(pkg.extras.get('unpublished'))
-                modified[quarter_name].append(
-                    (pkg.name, pkg.title, lib.dataset_notes(pkg),
-                        'modified', quarter_name,
-                        dates_formatted, authors, published))
-
-    datasets = []
-    for quarter_name in quarters:
-        datasets += sorted(created[quarter_name], key=lambda x: x[1])
-        datasets += sorted(modified[quarter_name], key=lambda x: x[1])
+        org_ids = organization_ids(organization, include_sub_organizations)
+        package_ids = set(id_ for (id_,) in
+                          model.Session.query(model.Package.id)
+                               .filter(model.Package.owner_org.in_(org_ids)))
+
+    activity = get_all_publisher_activity(now) or \
+        PublisherActivity(now, package_ids)
+    datasets = activity.table(package_ids)
     columns = ('Dataset name', 'Dataset title', 'Dataset notes', 'Modified or created', 'Quarter', 'Timestamp', 'Author', 'Published')
 
     quarters_iso = dict([(last_or_this, [date_.isoformat() for date_ in q_list])
-                         for last_or_this, q_list in quarters.iteritems()])
+                         for last_or_this, q_list in activity.quarters.iteritems()])
 
     return {'table': datasets, 'columns': columns,
             'quarters': quarters_iso}
 
 def publisher_activity_combinations():
+    # Work out the activity of all datasets once, to share between all the
+    # organizations
+    set_precomputed('publisher-activity',
+                    PublisherActivity(datetime.datetime.now()))
     for org in lib.all_organizations(include_none=False):
         for include_sub_organizations in (False, True):
             yield {'organization': org,
                    'include_sub_organizations': include_sub_organizations}
+    clear_precomputed('publisher-activity')
 
 publisher_activity_report_info = {
     'name': 'publisher-activity',
@@ -490,93 +700,176 @@ app_dataset_theme_report_info = {
 
 # admin-editor report
 
-def get_user_realname(user):
-    from ckanext.dgu.drupalclient import DrupalClient
+# Drupal users' real names are looked up in Drupal at most once a day
+REALNAME_CACHE_SECONDS = 24 * 60 * 60
+DRUPAL_LOOKUP_THREADS = 4
+# drupal_user_id:(time fetched, realname) - used when drupal_cache_filepath
+# is not configured
+_drupal_realnames = {}
+
+def _realname_from_drupal_properties(properties):
     from HTMLParser import HTMLParser
 
-    if user.name.startswith('user_d'):
-        user_id = user.name[len('user_d'):]
+    html_parser = HTMLParser()
+    try:
+        first_name = properties['field_first_name']['und'][0]['safe_value']
+        first_name = html_parser.unescape(first_name)
+    except:
+        first_name = ''
 
-        html_parser = HTMLParser()
+    try:
+        surname = properties['field_surname']['und'][0]['safe_value']
+        surname = html_parser.unescape(surname)
+    except:
+        surname = ''
 
-        try:
-            dc = DrupalClient()
-            properties = dc.get_user_properties(user_id)
-        except Exception, ex:
-            return user.fullname
+    return '%s %s' % (first_name, surname)
 
-        try:
-            first_name = properties['field_first_name']['und'][0]['safe_value']
-            first_name = html_parser.unescape(first_name)
-        except:
-            first_name = ''
+def get_drupal_realnames(drupal_user_ids):
+    '''Returns the real names of the given Drupal users, as
+    {drupal_user_id: name}. Names are cached for a day (in the Drupal lookup
+    cache, if drupal_cache_filepath is configured) and those not cached are
+    requested from Drupal in parallel. Users that cannot be retrieved are
+    left out.'''
+    from pylons import config
+    from ckanext.dgu.authentication.drupal_cache import DrupalLookupCache
+    from ckanext.dgu.drupalclient import DrupalClient
 
-        try:
-            surname = properties['field_surname']['und'][0]['safe_value']
-            surname = html_parser.unescape(surname)
-        except:
-            surname = ''
-    else:
-        first_name = ''
-        surname = ''
+    cache_filepath = config.get('drupal_cache_filepath')
+    cache = DrupalLookupCache(cache_filepath) if cache_filepath else None
 
-    name = '%s %s' % (first_name, surname)
-    if name.strip() == '':
-        name = user.fullname
+    names = {}
+    to_fetch = []
+    for drupal_user_id in set(drupal_user_ids):
+        if cache:
+            found, name = cache.get(
+                DrupalLookupCache.realname_key(drupal_user_id))
+        else:
+            fetched, name = _drupal_realnames.get(drupal_user_id, (0, None))
+            found = time.time() - fetched < REALNAME_CACHE_SECONDS
+        if found:
+            names[drupal_user_id] = name
+        else:
+            to_fetch.append(drupal_user_id)
+    if not to_fetch:
+        return names
+
+    errors = {}
+    try:
+        properties_by_id = DrupalClient().get_users_properties(
+            to_fetch, threads=DRUPAL_LOOKUP_THREADS, errors=errors)
+    except Exception, e:
+        log.error('Could not get users from Drupal: %r', e)
+        return names
+    if errors:
+        # not cached, so they are tried again next time
+        log.warning('Could not get %i users from Drupal, e.g. %r',
+                    len(errors), errors.values()[0])
+    for drupal_user_id, properties in properties_by_id.items():
+        name = _realname_from_drupal_properties(properties)
+        names[drupal_user_id] = name
+        if cache:
+            cache.set(DrupalLookupCache.realname_key(drupal_user_id), name,
+                      REALNAME_CACHE_SECONDS)
+        else:
+            _drupal_realnames[drupal_user_id] = (time.time(), name)
+    return names
+
+def get_user_realnames(users):
+    '''Returns the real names of the users, as {user_id: name}. The names
+    of Drupal users (named user_d<drupal_user_id>) are looked up in Drupal,
+    all at once. Otherwise, or failing that, it is the user's fullname.'''
+    drupal_user_ids = dict((user.id, user.name[len('user_d'):])
+                           for user in users
+                           if user.name.startswith('user_d'))
+    drupal_names = get_drupal_realnames(drupal_user_ids.values()) \
+        if drupal_user_ids else {}
+
+    names = {}
+    for user in users:
+        name = drupal_names.get(drupal_user_ids.get(user.id))
+        if not name or name.strip() == '':
+            name = user.fullname
+        names[user.id] = name
+    return names
 
-    return name
+def get_user_realname(user):
+    return get_user_realnames([user])[user.id]
 
 def admin_editor(org=None, include_sub_organizations=False):
-    from ckanext.dgu.lib.helpers import group_get_users
-
     table = []
 
     if org:
-        q = model.Group.all('organization')
         parent = model.Group.by_name(org)
         if not parent:
             raise p.toolkit.ObjectNotFound('Publisher not found')
 
-        if include_sub_organizations:
-            child_ids = [ch[0] for ch in parent.get_children_group_hierarchy(type='organization')]
-        else:
-            child_ids = []
-
-        q = q.filter(model.Group.id.in_([parent.id] + child_ids))
-
-        for g in q.all():
-            record = {}
-            record['publisher_name'] = g.name
-            record['publisher_title'] = g.title
-
-            admin_users = group_get_users(g, capacity='admin')
-            admins = []
-            for u in admin_users:
-                name = get_user_realname(u)
-                admins.append('%s <%s>' % (name, u.email))
-
-            record['admins'] = "\n".join(admins)
-
-            editor_users = group_get_users(g, capacity='editor')
-            editors = []
-            for u in editor_users:
-                name = get_user_realname(u)
-                editors.append('%s <%s>' % (name, u.email))
-
-            record['editors'] = "\n".join(editors)
-            table.append(record)
+        records_by_org_id = get_precomputed('admin_editor')
+        if records_by_org_id is None:
+            records_by_org_id = admin_editor_by_organization(
+                organization_ids(parent, include_sub_organizations))
+        table = sorted(merge_precomputed(records_by_org_id, parent,
+                                         include_sub_organizations),
+                       key=lambda record: record['publisher_title'])
     else:
         table.append({})
 
     return {'table': table}
 
+def admin_editor_by_organization(organization_ids=None):
+    '''Returns the admin_editor record of each organization (not including
+    sub-organizations) - for all organizations, or just the given ones. The
+    memberships are got in one query, and the users' names are looked up
+    together.'''
+    orgs = model.Session.query(model.Group)\
+                .filter(model.Group.type == 'organization')\
+                .filter(model.Group.state == 'active')
+    members = model.Session.query(model.Member.group_id,
+                                  model.Member.capacity,
+                                  model.User)\
+                   .join(model.User, model.User.id == model.Member.table_id)\
+                   .filter(model.Member.table_name == 'user')\
+                   .filter(model.Member.state == 'active')\
+                   .filter(model.User.state == 'active')\
+                   .filter(model.Member.capacity.in_(('admin', 'editor')))
+    if organization_ids is not None:
+        orgs = orgs.filter(model.Group.id.in_(organization_ids))
+        members = members.filter(model.Member.group_id.in_(organization_ids))
+
+    users_by_org_id = collections.defaultdict(
+        lambda: {'admin': [], 'editor': []})
+    for group_id, capacity, user in members:
+        users_by_org_id[group_id][capacity].append(user)
+
+    # all the users' names are looked up together
+    all_users = dict((user.id, user)
+                 for org_users in users_by_org_id.values()
+                 for capacity_users in org_users.values()
+                 for user in capacity_users)
+    realnames = get_user_realnames(all_users.values())
+    def user_string(user):
+        return '%s <%s>' % (realnames[user.id], user.email)
+
+    records_by_org_id = {}
+    for g in orgs:
+        users = users_by_org_id[g.id]
+        records_by_org_id[g.id] = {
+            'publisher_name': g.name,
+            'publisher_title': g.title,
+            'admins': "\n".join(user_string(u) for u in users['admin']),
+            'editors': "\n".join(user_string(u) for u in users['editor']),
+            }
+    return records_by_org_id
+
 def admin_editor_combinations():
     from ckanext.dgu.lib.helpers import organization_list
 
+    set_precomputed('admin_editor', admin_editor_by_organization())
     for org, _ in organization_list(top=False):
         for include_sub_organizations in (False, True):
             yield {'org': org,
                     'include_sub_organizations': include_sub_organizations}
+    clear_precomputed('admin_editor')
 
 def user_is_admin(user, org=None):
     import ckan.lib.helpers as helpers
@@ -0,0 +1,305 @@
+'''
+Serving HTML pages from the archiver's resource cache. Before they are
+shown, a <base> is added (so that relative links go to the original site)
+and a header saying the page is cached.
+
+The rewriting is done as the file is read, a chunk at a time, so a large
+page is never held in memory. The rewritten page is also kept on disk (in
+dgu.rewritten_cache_dir), named after the archived file's mtime and size and
+the resource URL, so later requests for it are served as a plain file.
+
+Files are served with an ETag and Last-Modified, so that clients and Varnish
+can revalidate them (304 Not Modified), and a byte Range of them can be
+requested, to resume a download.
+'''
+import email.utils
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+HEADER_MARKER = '__archiver__cache__header__'
+
+head_regex = re.compile(re.escape('<head>'), re.IGNORECASE)
+body_end_regex = re.compile(re.escape('</body>'), re.IGNORECASE)
+
+
+def read_chunks(f, chunk_size=CHUNK_SIZE):
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def contains(filepath, text, ignore_case=False):
+    '''Returns whether the file contains the text, reading it a chunk at a
+    time.'''
+    if ignore_case:
+        text = text.lower()
+    overlap = len(text) - 1
+    tail = ''
+    with open(filepath, 'rb') as f:
+        for chunk in read_chunks(f):
+            if ignore_case:
+                chunk = chunk.lower()
+            if text in tail + chunk:
+                return True
+            # a match may straddle the chunks
+            tail = (tail + chunk)[-overlap:] if overlap else ''
+    return False
+
+
+def stream_sub(chunks, regex, replacement, count, max_match_length):
+    '''Like regex.sub(replacement, content, count), over content given as a
+    stream of chunks. Matches must be no longer than max_match_length.'''
+    buf = ''
+    for chunk in chunks:
+        buf += chunk
+        while count:
+            match = regex.search(buf)
+            if not match:
+                break
+            yield buf[:match.start()] + replacement
+            buf = buf[match.end():]
+            count -= 1
+        if not count:
+            yield buf
+            buf = ''
+        elif len(buf) >= max_match_length:
+            # keep back what could be the start of a match
+            keep = max_match_length - 1
+            yield buf[:len(buf) - keep]
+            buf = buf[len(buf) - keep:]
+    if buf:
+        yield buf
+
+
+def rewrite_html(filepath, base_string, header):
+    '''Yields the cached page, in chunks, with the base_string in place of
+    <head> (unless it has a <base> already) and the header HTML before
+    </body> (unless it has one already).
+
+    As before, at most two of each are replaced.'''
+    add_base = not contains(filepath, '<base ', ignore_case=True)
+    add_header = not contains(filepath, HEADER_MARKER)
+    with open(filepath, 'rb') as f:
+        chunks = read_chunks(f)
+        if add_base:
+            chunks = stream_sub(chunks, head_regex, base_string, 2,
+                                len('<head>'))
+        if add_header:
+            chunks = stream_sub(chunks, body_end_regex,
+                                '{0}</body>'.format(header), 2,
+                                len('</body>'))
+        for chunk in chunks:
+            yield chunk
+
+
+def file_key(filepath, resource_url=None):
+    '''Returns a key that changes when the file does (by its mtime and size)
+    or, if given, the resource URL (which is in the header of an HTML page).
+    '''
+    stat = os.stat(filepath)
+    return hashlib.sha1('%s %s %s' % (
+        stat.st_mtime, stat.st_size,
+        (resource_url or '').encode('utf-8'))).hexdigest()[:16]
+
+
+def etag(key):
+    return '"%s"' % key
+
+
+def rewritten_filepath(rewritten_dir, resource_id, filepath, key):
+    '''Returns where the rewritten version of the cached file is kept. The
+    name includes the file_key, so changes if the file or the resource URL
+    changes.'''
+    filename = os.path.basename(filepath)
+    return os.path.join(rewritten_dir, resource_id, '%s-%s' % (key, filename))
+
+
+def rewrite_and_keep(filepath, rewritten_filepath, base_string, header):
+    '''Yields the rewritten page, as rewrite_html does, and saves it to
+    rewritten_filepath once it has all been read. Older versions of it are
+    deleted.'''
+    rewritten_dir = os.path.dirname(rewritten_filepath)
+    try:
+        if not os.path.exists(rewritten_dir):
+            os.makedirs(rewritten_dir)
+        tmp_filepath = '%s.%s.tmp' % (rewritten_filepath, uuid.uuid4().hex)
+        out = open(tmp_filepath, 'wb')
+    except (IOError, OSError), e:
+        log.error('Cannot write to the rewritten cache dir: %s', e)
+        for chunk in rewrite_html(filepath, base_string, header):
+            yield chunk
+        return
+
+    completed = False
+    try:
+        for chunk in rewrite_html(filepath, base_string, header):
+            out.write(chunk)
+            yield chunk
+        completed = True
+    finally:
+        # If the client went away early, the partial file is thrown away
+        out.close()
+        if completed:
+            os.rename(tmp_filepath, rewritten_filepath)
+            _delete_older_versions(rewritten_filepath)
+        else:
+            os.remove(tmp_filepath)
+
+
+def _delete_older_versions(rewritten_filepath):
+    dirname, name = os.path.split(rewritten_filepath)
+    filename = name.split('-', 1)[1]
+    for other_name in os.listdir(dirname):
+        if other_name != name and other_name.split('-', 1)[1:] == [filename]:
+            try:
+                os.remove(os.path.join(dirname, other_name))
+            except OSError:
+                # another process got there first
+                pass
+
+
+# resource_id:(time cached, format, url)
+_resource_info_cache = {}
+RESOURCE_INFO_CACHE_SECONDS = 600
+MAX_RESOURCE_INFO_CACHE_SIZE = 10000
+
+def resource_format_and_url(resource_id):
+    '''Returns the format of the resource, as worked out by QA, and its URL
+    - (None, None) if the resource doesn't exist. The lookups are cached for
+    a while, since the same resource is often requested many times, e.g.
+    when a download is resumed.'''
+    cached = _resource_info_cache.get(resource_id)
+    if cached and time.time() - cached[0] < RESOURCE_INFO_CACHE_SECONDS:
+        return cached[1:]
+
+    from ckan import model
+    from ckanext.qa.model import QA
+    fmt = url = None
+    resource = model.Resource.get(resource_id)
+    if resource:
+        url = resource.url
+        qa = QA.get_for_resource(resource.id)
+        fmt = qa.format if qa else ''
+    if len(_resource_info_cache) >= MAX_RESOURCE_INFO_CACHE_SIZE:
+        _resource_info_cache.clear()
+    _resource_info_cache[resource_id] = (time.time(), fmt, url)
+    return fmt, url
+
+
+def is_not_modified(environ, etag_, last_modified):
+    '''Returns whether the request is conditional (If-None-Match or
+    If-Modified-Since) and the client's copy is still current.'''
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in etags or etag_ in etags or 'W/' + etag_ in etags
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+        since = email.utils.parsedate_tz(if_modified_since)
+        return since is not None and \
+            int(last_modified) <= email.utils.mktime_tz(since)
+    return False
+
+
+def parse_range(environ, etag_, size):
+    '''Returns the (first, last) byte positions asked for by a Range header,
+    None if the whole file should be sent (no Range, several ranges or an
+    If-Range that doesn't match), or False if it can't be satisfied.'''
+    range_header = environ.get('HTTP_RANGE', '')
+    if not range_header.startswith('bytes=') or ',' in range_header:
+        return None
+    if_range = environ.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag_:
+        return None
+    first, sep, last = range_header[len('bytes='):].strip().partition('-')
+    try:
+        if not first:
+            # the last so many bytes
+            length = int(last)
+            if length <= 0:
+                return False
+            return max(size - length, 0), size - 1
+        first = int(first)
+        last = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if first >= size or last < first:
+        return False
+    return first, min(last, size - 1)
+
+
+def _read_range(filepath, first, length):
+    with open(filepath, 'rb') as f:
+        f.seek(first)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+def serve_file(environ, start_response, filepath, content_type=None,
+               etag_=None):
+    '''A WSGI app that sends the file, answering conditional and Range
+    requests. The Content-Type is guessed from the file extension if not
+    given. The ETag defaults to one from the file's mtime and size.'''
+    stat = os.stat(filepath)
+    if etag_ is None:
+        etag_ = etag(file_key(filepath))
+    if content_type is None:
+        content_type = mimetypes.guess_type(filepath)[0] or \
+            'application/octet-stream'
+    headers = [('ETag', etag_),
+               ('Last-Modified', email.utils.formatdate(stat.st_mtime,
+                                                        usegmt=True)),
+               ('Accept-Ranges', 'bytes')]
+
+    if is_not_modified(environ, etag_, stat.st_mtime):
+        start_response('304 Not Modified', headers)
+        return ['']
+
+    size = stat.st_size
+    byte_range = parse_range(environ, etag_, size)
+    if byte_range is False:
+        start_response('416 Requested Range Not Satisfiable',
+                       headers + [('Content-Range', 'bytes */%s' % size),
+                                  ('Content-Length', '0')])
+        return ['']
+    headers.append(('Content-Type', content_type))
+    is_head = environ.get('REQUEST_METHOD') == 'HEAD'
+    if byte_range:
+        first, last = byte_range
+        length = last - first + 1
+        start_response('206 Partial Content', headers + [
+            ('Content-Range', 'bytes %s-%s/%s' % (first, last, size)),
+            ('Content-Length', str(length))])
+        return [''] if is_head else _read_range(filepath, first, length)
+
+    start_response('200 OK', headers + [('Content-Length', str(size))])
+    if is_head:
+        return ['']
+    f = open(filepath, 'rb')
+    # the server may be able to send the file without copying it
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper:
+        return file_wrapper(f, CHUNK_SIZE)
+    return _close_after(read_chunks(f), f)
+
+
+def _close_after(chunks, f):
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        f.close()
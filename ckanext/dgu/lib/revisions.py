@@ -0,0 +1,88 @@
+'''
+Finding out what has changed since a given time, from the revision tables.
+'''
+import collections
+
+from ckan import model
+
+
+def _package_change_queries(revision_filter, with_revision_id=False):
+    '''Returns queries of the package_ids changed in some way (the package,
+    its tags, extras, resources or group membership) in the revisions
+    matching the filter, which is given each object revision table's
+    revision_id column. Optionally the revision_id is returned too, before
+    the package_id.'''
+    def query(obj_revision_table, package_id_column):
+        columns = (obj_revision_table.revision_id, package_id_column) \
+            if with_revision_id else (package_id_column,)
+        return model.Session.query(*columns)\
+            .select_from(obj_revision_table)\
+            .filter(revision_filter(obj_revision_table.revision_id))
+
+    return (
+        query(model.PackageRevision, model.PackageRevision.id),
+        query(model.PackageTagRevision, model.PackageTagRevision.package_id),
+        query(model.PackageExtraRevision, model.PackageExtraRevision.package_id),
+        query(model.ResourceRevision, model.ResourceGroup.package_id)
+             .join(model.ResourceGroup,
+                   model.ResourceRevision.resource_group_id == model.ResourceGroup.id),
+        query(model.MemberRevision, model.MemberRevision.table_id)
+             .filter(model.MemberRevision.table_name == 'package'),
+        )
+
+
+def changed_package_ids(since_timestamp):
+    '''Returns the ids of packages that changed in some way (the package,
+    its tags, extras, resources or group membership) in revisions since the
+    given timestamp.'''
+    revision_id_q = model.Session.query(model.Revision.id)\
+        .filter(model.Revision.timestamp >= since_timestamp)
+    queries = _package_change_queries(
+        lambda revision_id_column: revision_id_column.in_(revision_id_q))
+    # one UNION query, which also removes duplicates
+    package_ids = set(id_ for (id_,) in queries[0].union(*queries[1:]))
+    # due to corrupt old obj revision tables, some package_ids may be blank
+    package_ids.discard(None)
+    return package_ids
+
+
+def changed_package_ids_by_revision(revision_ids):
+    '''Returns the ids of the packages changed in each of the given
+    revisions, as {revision_id: set(package_ids)}, got in one query.'''
+    if not revision_ids:
+        return {}
+    queries = _package_change_queries(
+        lambda revision_id_column: revision_id_column.in_(revision_ids),
+        with_revision_id=True)
+    package_ids_by_revision = collections.defaultdict(set)
+    for revision_id, package_id in queries[0].union(*queries[1:]):
+        # due to corrupt old obj revision tables, some package_ids may be blank
+        if package_id:
+            package_ids_by_revision[revision_id].add(package_id)
+    return package_ids_by_revision
+
+
+def changed_organization_ids(since_timestamp):
+    '''Returns the ids of organizations whose details (e.g. title) or extras
+    changed in revisions since the given timestamp, or which were moved in
+    the hierarchy (along with their old and new parents). The descendants of
+    a moved organization are not included, but are affected too.'''
+    revision_id_q = model.Session.query(model.Revision.id)\
+        .filter(model.Revision.timestamp >= since_timestamp)
+    group_ids = set()
+    member_q = model.Session.query(model.MemberRevision)\
+        .filter(model.MemberRevision.revision_id.in_(revision_id_q))\
+        .filter(model.MemberRevision.table_name == 'group')
+    for q in (
+            model.Session.query(model.GroupRevision.id)
+                 .filter(model.GroupRevision.revision_id.in_(revision_id_q)),
+            model.Session.query(model.GroupExtraRevision.group_id)
+                 .filter(model.GroupExtraRevision.revision_id.in_(revision_id_q)),
+            # a change of parent - the parent is group_id and the child
+            # table_id
+            member_q.with_entities(model.MemberRevision.group_id),
+            member_q.with_entities(model.MemberRevision.table_id),
+            ):
+        group_ids.update(id_ for (id_,) in q.distinct())
+    group_ids.discard(None)
+    return group_ids
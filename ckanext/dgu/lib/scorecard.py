@@ -0,0 +1,289 @@
+'''
+The publisher scorecard - resource counts, openness scores, broken links and
+the traffic lights derived from them, for every publisher with and without
+its sub-publishers.
+
+The figures are worked out for all publishers at once, in a few queries
+grouped by dataset, and stored in the publisher_scorecard table. They are
+refreshed by the "publisher_scorecard" paster command. When a dataset
+changes, the scorecards of its publisher and the publishers above it are
+marked stale, to be recomputed by the next "refresh_stale".
+'''
+import collections
+import datetime
+import json
+import logging
+
+from sqlalchemy import func
+from pylons import config
+
+from ckan import model
+from ckanext.dgu.lib.publisher import (PublisherHierarchy,
+                                       openness_scores_by_package,
+                                       package_resources_query,
+                                       packages_of_publishers,
+                                       publisher_package_ids)
+from ckanext.dgu.model.publisher_scorecard import PublisherScorecard
+
+log = logging.getLogger(__name__)
+
+
+def traffic_lights(publisher, resource_count, openness_total,
+                   openness_counts, broken_count):
+    '''Returns the broken link percentage and the traffic lights for a
+    publisher's figures.
+
+        broken_links - green = 0%, amber <= 60% broken links, red > 60% broken
+        openness - green if all > 4 *, amber for 50%> 3*, red otherwise
+    '''
+    # Issues data
+    issues = 'green'
+    if 'issues' in config.get('ckan.plugins', ''):
+        # If issues are installed then we can use the info to determine
+        # whether the issues are older than a month, between a fortnight
+        # and a month, or less than a fortnight.
+        from ckanext.issues.lib import util
+
+        if util.old_unresolved(publisher, days=30):
+            issues = 'red'
+        elif util.old_unresolved(publisher, days=14):
+            issues = 'amber'
+
+    from ckanext.dgu.lib.helpers import publisher_has_spend_data
+    spending = 'green'
+    if publisher_has_spend_data(publisher):
+        spending = 'red'
+
+    if broken_count == 0 or resource_count == 0:
+        pct = 0
+    else:
+        pct = int(100 * float(broken_count) / float(resource_count))
+
+    broken_links = 'green'
+    if 1 < pct <= 60:
+        broken_links = 'amber'
+    elif pct > 60:
+        broken_links = 'red'
+
+    number_x_or_above = lambda x: sum(openness_counts.get(str(c), 0)
+                                      for c in xrange(x, 6))
+    above_3 = number_x_or_above(3)
+    pct_above_3 = int(100 * float(openness_total) / float(above_3)) \
+        if above_3 else 0
+    if number_x_or_above(4) == openness_total:
+        openness = 'green'
+    elif pct_above_3 >= 50:
+        openness = 'amber'
+    else:
+        openness = 'red'
+
+    return pct, {'broken_links': broken_links,
+                 'openness': openness,
+                 'issues': issues,
+                 'spending': spending}
+
+
+def package_figures(publisher_ids=None):
+    '''Returns the resource count, openness score counts and broken link
+    count of every dataset - or just those of the given publishers - as
+    {package_id: {'resource_count': 3, 'openness': {'3': 2, ...},
+    'broken_count': 1}}.'''
+    from ckanext.archiver.model import Archival
+
+    figures = collections.defaultdict(
+        lambda: {'resource_count': 0,
+                 'openness': collections.defaultdict(int),
+                 'broken_count': 0})
+
+    q = package_resources_query(publisher_ids, func.count(model.Resource.id))\
+        .group_by(model.Package.id)
+    for package_id, count in q:
+        figures[package_id]['resource_count'] = count
+
+    for package_id, counts in \
+            openness_scores_by_package(publisher_ids).items():
+        figures[package_id]['openness'] = counts
+
+    q = package_resources_query(publisher_ids, func.count(model.Resource.id))\
+        .join(Archival, Archival.resource_id == model.Resource.id)\
+        .filter(Archival.is_broken == True)\
+        .group_by(model.Package.id)
+    for package_id, count in q:
+        figures[package_id]['broken_count'] = count
+
+    return figures
+
+
+def refresh_scorecards(publisher_ids=None):
+    '''Works out and stores the scorecards of the given publishers (default
+    all of them), with and without their sub-publishers.
+
+    The figures of the datasets are added up for each publisher, so a
+    dataset in more than one publisher of a sub-tree is only counted once.'''
+    publishers = model.Session.query(model.Group)\
+        .filter(model.Group.type == 'organization')\
+        .filter(model.Group.state == 'active')
+    if publisher_ids is not None:
+        publishers = publishers.filter(model.Group.id.in_(publisher_ids))
+    publishers = publishers.all()
+    log.info('Refreshing the scorecards of %i publishers', len(publishers))
+    if not publishers:
+        return
+
+    hierarchy = PublisherHierarchy.instance()
+    if publisher_ids is None:
+        figure_ids = None
+    else:
+        # just the figures of these publishers and their sub-publishers
+        figure_ids = set()
+        for publisher in publishers:
+            figure_ids.update(hierarchy.descendant_ids(publisher.id)
+                              or [publisher.id])
+    figures = package_figures(figure_ids)
+    package_ids_by_publisher = publisher_package_ids(figure_ids)
+    for publisher in publishers:
+        for include_sub_publishers in (False, True):
+            if include_sub_publishers:
+                ids = hierarchy.descendant_ids(publisher.id) or [publisher.id]
+            else:
+                ids = [publisher.id]
+            package_ids = packages_of_publishers(package_ids_by_publisher,
+                                                 ids)
+            resource_count = sum(figures[id_]['resource_count']
+                                 for id_ in package_ids)
+            openness_counts = collections.defaultdict(int)
+            for id_ in package_ids:
+                for score, count in figures[id_]['openness'].items():
+                    openness_counts[score] += count
+            openness_total = sum(openness_counts.values())
+            broken_count = sum(figures[id_]['broken_count']
+                               for id_ in package_ids)
+            broken_pct, lights = traffic_lights(
+                publisher, resource_count, openness_total, openness_counts,
+                broken_count)
+
+            scorecard = PublisherScorecard.get(publisher.id,
+                                               include_sub_publishers)
+            if not scorecard:
+                scorecard = PublisherScorecard(
+                    publisher_id=publisher.id,
+                    include_sub_publishers=include_sub_publishers)
+                model.Session.add(scorecard)
+            scorecard.resource_count = resource_count
+            scorecard.openness_scores = json.dumps(openness_counts)
+            scorecard.openness_total = openness_total
+            scorecard.broken_count = broken_count
+            scorecard.broken_pct = broken_pct
+            for light, colour in lights.items():
+                setattr(scorecard, light, colour)
+            scorecard.stale = False
+            scorecard.updated = datetime.datetime.now()
+    model.Session.commit()
+
+
+def refresh_stale_scorecards():
+    '''Refreshes the scorecards marked stale since the last refresh.'''
+    stale_ids = set(id_ for (id_,) in
+                    model.Session.query(PublisherScorecard.publisher_id)
+                         .filter(PublisherScorecard.stale == True))
+    if stale_ids:
+        refresh_scorecards(stale_ids)
+    return stale_ids
+
+
+def mark_stale(session, publisher_ids=None):
+    '''Marks the scorecards of the given publishers and all the publishers
+    above them (default all publishers) as stale. To be called within a
+    session that is about to commit.'''
+    table = PublisherScorecard.__table__
+    update = table.update().values(stale=True)
+    if publisher_ids is not None:
+        hierarchy = PublisherHierarchy.instance()
+        ids = set(publisher_ids)
+        for publisher_id in publisher_ids:
+            ids.update(hierarchy.ancestor_ids(publisher_id))
+        if not ids:
+            return
+        update = update.where(table.c.publisher_id.in_(ids))
+    session.execute(update)
+
+
+def mark_stale_for_changes(session, objects):
+    '''Given the objects changed in a session that is about to commit, marks
+    stale the scorecards they affect.'''
+    package_ids = set()
+    resource_ids = set()
+    publisher_ids = set()
+    for obj in objects:
+        if isinstance(obj, model.Group) or \
+                (isinstance(obj, model.Member) and obj.table_name == 'group'):
+            # the publisher hierarchy may have changed
+            mark_stale(session)
+            return
+        elif isinstance(obj, model.Package):
+            publisher_ids.add(obj.owner_org)
+        elif isinstance(obj, model.Member) and obj.table_name == 'package':
+            publisher_ids.add(obj.group_id)
+        elif isinstance(obj, model.Resource):
+            resource_ids.add(obj.id)
+        elif isinstance(obj, model.TaskStatus) and obj.task_type == 'qa':
+            resource_ids.add(obj.entity_id)
+        elif type(obj).__name__ in ('QA', 'Archival'):
+            # ckanext-qa and ckanext-archiver results
+            package_ids.add(obj.package_id)
+    resource_ids.discard(None)
+    if resource_ids:
+        package_ids.update(
+            id_ for (id_,) in
+            session.query(model.ResourceGroup.package_id)
+                   .join(model.Resource,
+                         model.Resource.resource_group_id == model.ResourceGroup.id)
+                   .filter(model.Resource.id.in_(resource_ids)))
+    package_ids.discard(None)
+    if package_ids:
+        publisher_ids.update(
+            id_ for (id_,) in
+            session.query(model.Package.owner_org)
+                   .filter(model.Package.id.in_(package_ids)))
+    publisher_ids.discard(None)
+    if publisher_ids:
+        mark_stale(session, publisher_ids)
+
+
+_table_exists = None
+
+def scorecard_table_exists():
+    '''Whether publisher_scorecard has been created (by "paster
+    publisher_scorecard init"). Found out once per process.'''
+    global _table_exists
+    if _table_exists is None:
+        _table_exists = PublisherScorecard.__table__.exists(
+            bind=model.meta.engine)
+    return _table_exists
+
+
+def get_scorecard(publisher, include_sub_publishers):
+    '''Returns the stored scorecard of the publisher, or None if it has not
+    been worked out yet. Nothing is worked out or stored here - that is left
+    to the "publisher_scorecard" paster command.'''
+    return PublisherScorecard.get(publisher.id, include_sub_publishers)
+
+
+def live_traffic_lights(publisher, include_sub_publishers):
+    '''Works out the traffic lights of a publisher there and then, as was
+    done before there was a publisher_scorecard table. Uses the cached
+    openness scores and broken links reports where they exist. Nothing is
+    stored.'''
+    from ckanext.qa.reports import broken_resource_links_for_organisation
+    from ckanext.dgu.lib import publisher as publib
+
+    resource_count = publib.resource_count(publisher, include_sub_publishers)
+    openness_total, openness_counts = publib.openness_scores(
+        publisher, include_sub_publishers)
+    data = broken_resource_links_for_organisation(
+        publisher.name, include_sub_publishers, use_cache=True)
+    broken_count = len(data['data'])
+    broken_pct, lights = traffic_lights(publisher, resource_count,
+                                        openness_total, openness_counts,
+                                        broken_count)
+    return lights
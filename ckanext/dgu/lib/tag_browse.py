@@ -0,0 +1,134 @@
+'''
+Browsing the (free) tags by their first letter, a page at a time.
+
+Only the tags on the requested page are got from the database, with a
+prefix query on lower(name), which is indexed by "paster tag_browse init".
+The number of tags for each letter is kept in the tag_letter_count table,
+which is emptied when tags change and filled again when next needed. It is
+filled in a transaction of its own, not the request's.
+'''
+import logging
+
+from sqlalchemy import func, exists, and_, select
+
+from ckan import model
+from ckanext.dgu.model.tag_letter_count import TagLetterCount
+
+log = logging.getLogger(__name__)
+
+LETTERS = [char for char in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ']
+OTHER = 'Other'  # tags not starting with a letter
+
+
+def _tags_query(*columns):
+    '''Query of the tags listed by tag_list - free tags on an active
+    dataset.'''
+    return model.Session.query(*columns)\
+        .filter(model.Tag.vocabulary_id == None)\
+        .filter(exists().where(and_(
+            model.PackageTag.tag_id == model.Tag.id,
+            model.PackageTag.state == 'active')))
+
+
+def _filter_by_letter(q, letter):
+    lower_name = func.lower(model.Tag.name)
+    if letter == OTHER:
+        return q.filter(~lower_name.op('~')(u'^[a-z]'))
+    if letter not in LETTERS:
+        raise ValueError('Not a letter: %r' % letter)
+    return q.filter(lower_name.like(u'%s%%' % letter.lower()))
+
+
+def count_tags_by_letter(connection=None):
+    '''Works out the number of tags starting with each letter, in one
+    grouped query, as {letter: count} (including OTHER). The query is run on
+    the connection, if given, rather than the session.'''
+    counts = dict.fromkeys(LETTERS + [OTHER], 0)
+    first_char = func.upper(func.substr(model.Tag.name, 1, 1))
+    q = _tags_query(first_char, func.count(model.Tag.id))\
+        .group_by(first_char)
+    rows = connection.execute(q.statement) if connection else q
+    for char, count in rows:
+        counts[char if char in counts else OTHER] += count
+    return counts
+
+
+_table_exists = None
+
+def tag_letter_table_exists():
+    '''Whether tag_letter_count has been created (by "paster tag_browse
+    init"). Found out once per process.'''
+    global _table_exists
+    if _table_exists is None:
+        _table_exists = TagLetterCount.__table__.exists(
+            bind=model.meta.engine)
+    return _table_exists
+
+
+def letter_counts():
+    '''Returns the number of tags starting with each letter, as
+    {letter: count}, from the tag_letter_count table, filling it first if
+    it has been emptied.'''
+    if not tag_letter_table_exists():
+        return count_tags_by_letter()
+    counts = TagLetterCount.counts()
+    if counts:
+        return counts
+    return _fill_letter_counts()
+
+
+def _fill_letter_counts():
+    '''Counts the tags and stores the counts, on a connection of its own,
+    so that the session (of a GET request, say) is not committed. The table
+    is locked meanwhile, so a commit that changes tags (and so empties the
+    table) either waits for the counts to be stored, or finishes before the
+    tags are counted.'''
+    table = TagLetterCount.__table__
+    connection = model.meta.engine.connect()
+    trans = connection.begin()
+    try:
+        if connection.dialect.name == 'postgresql':
+            connection.execute('LOCK TABLE tag_letter_count '
+                               'IN SHARE ROW EXCLUSIVE MODE')
+        # another request may have filled it first
+        counts = dict(connection.execute(
+            select([table.c.letter, table.c.count])).fetchall())
+        if not counts:
+            counts = count_tags_by_letter(connection)
+            connection.execute(table.insert(),
+                               [{'letter': letter, 'count': count}
+                                for letter, count in counts.items()])
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        connection.close()
+    return counts
+
+
+def clear_letter_counts(session):
+    '''Empties the tag_letter_count table, for it to be filled again when
+    next needed. To be called within a session that is about to commit.'''
+    session.execute(TagLetterCount.__table__.delete())
+
+
+def clear_letter_counts_for_changes(session, objects):
+    '''Given the objects changed in a session that is about to commit,
+    empties the letter counts if any tags have changed.'''
+    for obj in objects:
+        if isinstance(obj, (model.Tag, model.PackageTag)):
+            clear_letter_counts(session)
+            return
+
+
+def tags_for_letter(letter, limit=None, offset=0):
+    '''Returns the names of the tags starting with the letter (or OTHER),
+    in name order. Give None to get all tags.'''
+    q = _tags_query(model.Tag.name)
+    if letter is not None:
+        q = _filter_by_letter(q, letter)
+    q = q.order_by(model.Tag.name)
+    if limit:
+        q = q.limit(limit).offset(offset)
+    return [name for (name,) in q]
@@ -2,12 +2,12 @@ import os.path
 import simplejson as json
 import codecs
 import re
+import time
 from collections import defaultdict
 
 # Use nltk.download() to get the 'stopwords' corpus
 import nltk
 from nltk.corpus import stopwords
-from nltk.util import bigrams, trigrams
 import sqlalchemy
 
 from ckanext.dgu.schema import tag_munge
@@ -101,32 +101,132 @@ class Themes(object):
         self.topic_bigrams_set = self.topic_bigrams.viewkeys()
         self.topic_trigrams_set = self.topic_trigrams.viewkeys()
 
+        # All the topics in one trie, so that the text of a package can be
+        # matched against them in a single pass. Each node is a dict of
+        # word:child node, plus the key None for the topic it completes.
+        self.topic_trie = {}
+        for topic_dict in (self.topic_words, self.topic_bigrams,
+                           self.topic_trigrams):
+            for key in topic_dict:
+                node = self.topic_trie
+                for word in (key if isinstance(key, tuple) else (key,)):
+                    node = node.setdefault(word, {})
+                node[None] = key
+
+    def match_topics(self, words):
+        '''Returns the topics occurring in the (normalized) words, as a dict
+        for each number of words in the topic: {num_words: {topic: occurrences}}.
+        Single-word topics are not matched on stopwords.'''
+        stop_words = english_stopwords()
+        matches = {1: {}, 2: {}, 3: {}}
+        trie = self.topic_trie
+        num_words = len(words)
+        for i in xrange(num_words):
+            node = trie
+            for j in xrange(i, min(i + 3, num_words)):
+                node = node.get(words[j])
+                if node is None:
+                    break
+                topic = node.get(None)
+                if topic is None or (j == i and words[i] in stop_words):
+                    continue
+                topic_matches = matches[j - i + 1]
+                topic_matches[topic] = topic_matches.get(topic, 0) + 1
+        return matches
+
+
+_stopwords = None
+def english_stopwords():
+    '''Returns the NLTK English stopwords as a set, loaded once.'''
+    global _stopwords
+    if _stopwords is None:
+        _stopwords = frozenset(stopwords.words('english'))
+    return _stopwords
+
+# (time cached, counts) - cleared when datasets are committed by this process
+_theme_counts_cache = []
+THEME_COUNTS_CACHE_SECONDS = 300
+
+def theme_counts():
+    '''Returns the number of active datasets with each theme as primary and
+    as a secondary theme:
+
+        {'primary': {theme_name: count}, 'secondary': {theme_name: count}}
+
+    Every theme is listed, even if it has no datasets. Worked out in one
+    grouped query and cached.
+    '''
+    if _theme_counts_cache and \
+            time.time() - _theme_counts_cache[0] < THEME_COUNTS_CACHE_SECONDS:
+        return _theme_counts_cache[1]
+
+    theme_names = Themes.instance().data.keys()
+    counts = {'primary': dict.fromkeys(theme_names, 0),
+              'secondary': dict.fromkeys(theme_names, 0)}
+    q = model.Session.query(model.PackageExtra.key,
+                            model.PackageExtra.value,
+                            sqlalchemy.func.count(model.Package.id))\
+             .join(model.Package)\
+             .filter(model.PackageExtra.key.in_((PRIMARY_THEME,
+                                                 SECONDARY_THEMES)))\
+             .filter(model.Package.state == 'active')\
+             .group_by(model.PackageExtra.key, model.PackageExtra.value)
+    for key, value, count in q:
+        if key == PRIMARY_THEME:
+            if value in counts['primary']:
+                counts['primary'][value] += count
+        else:
+            # usually a JSON list, but be lenient, as helpers.secondary_themes
+            themes = set(theme.strip() for theme in
+                         re.sub('[["\]]', '', value or '').split(','))
+            for theme in themes:
+                if theme in counts['secondary']:
+                    counts['secondary'][theme] += count
+    _theme_counts_cache[:] = [time.time(), counts]
+    return counts
+
+def clear_theme_counts_cache():
+    del _theme_counts_cache[:]
 
 def normalize_text(text):
     words = [normalize_token(w) for w in split_words(text)]
+    stop_words = english_stopwords()
     words_without_stopwords = [word for word in words
-            if word not in stopwords.words('english')]
+            if word not in stop_words]
     return words, words_without_stopwords
 
+number_comma_regex = re.compile('(\d+),(\d+)')
+word_regex = re.compile(r'\w+', flags=re.UNICODE)
 def split_words(sentence):
     # remove "," in a number so that "25,000" is treated as one word
-    re.sub('(\d+),(\d+)', r'\1\2', sentence)
-    words = re.findall(r'\w+', sentence, flags=re.UNICODE)
+    number_comma_regex.sub(r'\1\2', sentence)
+    words = word_regex.findall(sentence)
     return words
 
 # some words change meaning if you reduce them to their stem
 stem_exceptions = set(('parking', 'national', 'coordinates', 'granted', 'hospitality', 'employers', 'employer', 'employee', 'employees', 'nhs', 'consultation'))
 
 porter = None
+non_word_regex = re.compile('[^\w]')
+# token:normalized token. Stemming is slow and the vocabulary of the
+# datasets is small enough to remember, up to a limit.
+_normalized_tokens = {}
+MAX_NORMALIZED_TOKENS = 100000
 def normalize_token(token):
+    normalized = _normalized_tokens.get(token)
+    if normalized is not None:
+        return normalized
     global porter
     if not porter:
         porter = nltk.PorterStemmer()
-    token = re.sub('[^\w]', '', token)
-    token = token.lower()
-    if token not in stem_exceptions:
-        token = porter.stem(token)
-    return token
+    normalized = non_word_regex.sub('', token)
+    normalized = normalized.lower()
+    if normalized not in stem_exceptions:
+        normalized = porter.stem(normalized)
+    if len(_normalized_tokens) >= MAX_NORMALIZED_TOKENS:
+        _normalized_tokens.clear()
+    _normalized_tokens[token] = normalized
+    return normalized
 
 def dictize_package_nice(pkg):
     # package comes in as dict or an object. Convert both to a convenient dict.
@@ -154,6 +254,71 @@ def dictize_package_nice(pkg):
             pkg_dict['extras'] = dict(pkg['extras'].items())
         return pkg_dict
 
+def get_tags_and_extras(pkg_ids):
+    '''Returns the tags and extras of the given packages, as they appear in
+    dictize_package_nice, in one query each:
+    ({pkg_id: [tag_name, ...]}, {pkg_id: {key: value}})'''
+    tags = defaultdict(list)
+    extras = defaultdict(dict)
+    if not pkg_ids:
+        return tags, extras
+    # as Package.get_tags() - free tags only
+    q = model.Session.query(model.PackageTag.package_id, model.Tag.name)\
+             .join(model.Tag, model.Tag.id == model.PackageTag.tag_id)\
+             .filter(model.PackageTag.package_id.in_(pkg_ids))\
+             .filter(model.PackageTag.state == 'active')\
+             .filter(model.Tag.vocabulary_id == None)\
+             .order_by(model.Tag.name)
+    for pkg_id, tag_name in q:
+        tags[pkg_id].append(tag_name)
+    # as Package.extras - active ones only
+    q = model.Session.query(model.PackageExtra.package_id,
+                            model.PackageExtra.key,
+                            model.PackageExtra.value)\
+             .filter(model.PackageExtra.package_id.in_(pkg_ids))\
+             .filter(model.PackageExtra.state == 'active')
+    for pkg_id, key, value in q:
+        extras[pkg_id][key] = value
+    return tags, extras
+
+def dictize_packages_nice(pkgs):
+    '''Like dictize_package_nice, for a list of packages (objects or dicts).
+    The tags and extras of the package objects are got in one query each,
+    rather than a few per package.'''
+    tags, extras = get_tags_and_extras(
+        [pkg.id for pkg in pkgs if isinstance(pkg, model.Package)])
+    pkg_dicts = []
+    for pkg in pkgs:
+        if isinstance(pkg, model.Package):
+            pkg_dicts.append({'name': pkg.name,
+                              'title': pkg.title,
+                              'tags': tags[pkg.id],
+                              'notes': pkg.notes,
+                              'extras': extras[pkg.id],
+                              })
+        else:
+            pkg_dicts.append(dictize_package_nice(pkg))
+    return pkg_dicts
+
+def categorize_packages(pkgs, stats=None, chunk_size=500):
+    '''Categorizes many packages, as categorize_package2, returning their
+    theme scores in the same order.
+
+    pkgs - list (or query) of package objects or dicts
+    '''
+    theme_scores = []
+    chunk = []
+    for pkg in pkgs:
+        chunk.append(pkg)
+        if len(chunk) == chunk_size:
+            theme_scores.extend(categorize_package2(pkg_dict, stats)
+                                for pkg_dict in dictize_packages_nice(chunk))
+            chunk = []
+    if chunk:
+        theme_scores.extend(categorize_package2(pkg_dict, stats)
+                            for pkg_dict in dictize_packages_nice(chunk))
+    return theme_scores
+
 def categorize_package(pkg, stats=None):
     '''Given a package it does various searching for topic keywords and returns
     its estimate for primary-theme and secondary-theme.
@@ -228,35 +393,25 @@ def categorize_package2(pkg, stats=None):
 def score_by_topic(pkg, scores):
     '''Examines the pkg and adds scores according to topics in it.'''
     themes = Themes.instance()
+    topic_dicts = {1: themes.topic_words,
+                   2: themes.topic_bigrams,
+                   3: themes.topic_trigrams}
     for level in range(3):
         pkg_text = package_text(pkg, level)
-        words, words_without_stopwords = normalize_text(pkg_text)
+        words = [normalize_token(w) for w in split_words(pkg_text)]
+        matches = themes.match_topics(words)
         for num_words in (1, 2, 3):
-            if num_words == 1:
-                ngrams = words_without_stopwords
-                topic_ngrams = themes.topic_words
-                topic_ngrams_set = themes.topic_words_set
-            elif num_words == 2:
-                ngrams = bigrams(words)
-                topic_ngrams = themes.topic_bigrams
-                topic_ngrams_set = themes.topic_bigrams_set
-            elif num_words == 3:
-                ngrams = trigrams(words)
-                topic_ngrams = themes.topic_trigrams
-                topic_ngrams_set = themes.topic_trigrams_set
-            matching_ngrams = set(ngrams) & topic_ngrams_set
-            if matching_ngrams:
-                for ngram in matching_ngrams:
-                    occurrences = ngrams.count(ngram)
-                    score = (3-level) * occurrences * num_words
-                    themes_for_ngram = topic_ngrams[ngram]
-                    ngram_printable = ' '.join(ngram) if isinstance(ngram, tuple) else ngram
-                    reason = '"%s" matched %s' % (ngram_printable, LEVELS[level])
-                    if occurrences > 1:
-                        reason += ' (%s times)' % occurrences
-                    for theme in themes_for_ngram:
-                        scores[theme].append((score, reason))
-                    log.debug(' %s %s %s', theme, score, reason)
+            topic_ngrams = topic_dicts[num_words]
+            for ngram, occurrences in matches[num_words].items():
+                score = (3-level) * occurrences * num_words
+                themes_for_ngram = topic_ngrams[ngram]
+                ngram_printable = ' '.join(ngram) if isinstance(ngram, tuple) else ngram
+                reason = '"%s" matched %s' % (ngram_printable, LEVELS[level])
+                if occurrences > 1:
+                    reason += ' (%s times)' % occurrences
+                for theme in themes_for_ngram:
+                    scores[theme].append((score, reason))
+                log.debug(' %s %s %s', theme, score, reason)
 
 def score_by_gemet(pkg, scores):
     if pkg['extras'].get('UKLP') != 'True':
@@ -70,6 +70,18 @@ def suggest_themes(context, data_dict):
 
     return results
 
+@side_effect_free
+def theme_counts(context, data_dict):
+    '''Returns the number of datasets with each theme, as primary theme and
+    as a secondary theme.
+
+    :returns example:
+        {'primary': {'Health': 530, 'Environment': 203, ...},
+         'secondary': {'Health': 41, 'Environment': 97, ...}}
+    '''
+    from ckanext.dgu.lib.theme import theme_counts
+    return theme_counts()
+
 @side_effect_free
 def schema_list(context, data_dict):
     check_access('schema_list', context, data_dict)
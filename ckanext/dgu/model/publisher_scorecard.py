@@ -0,0 +1,66 @@
+import datetime
+import json
+
+from sqlalchemy import Column, types
+from sqlalchemy.ext.declarative import declarative_base
+
+import ckan.model as model
+
+Base = declarative_base()
+
+
+class PublisherScorecard(Base):
+    """
+    The performance figures and traffic lights shown for a publisher,
+    worked out in the background (see ckanext.dgu.lib.scorecard) so that
+    the publisher page only has to look them up. There are two rows per
+    publisher - with and without its sub-publishers.
+    """
+    __tablename__ = 'publisher_scorecard'
+
+    publisher_id = Column(types.UnicodeText, primary_key=True)
+    include_sub_publishers = Column(types.Boolean, primary_key=True)
+
+    resource_count = Column(types.Integer, nullable=False, default=0)
+    # JSON dict of the number of resources with each openness score
+    openness_scores = Column(types.UnicodeText, nullable=False, default=u'{}')
+    openness_total = Column(types.Integer, nullable=False, default=0)
+    broken_count = Column(types.Integer, nullable=False, default=0)
+    broken_pct = Column(types.Integer, nullable=False, default=0)
+
+    # traffic lights - 'green', 'amber' or 'red'
+    broken_links = Column(types.UnicodeText)
+    openness = Column(types.UnicodeText)
+    issues = Column(types.UnicodeText)
+    spending = Column(types.UnicodeText)
+
+    # set when a dataset of the publisher changes, until it is refreshed
+    stale = Column(types.Boolean, nullable=False, default=False, index=True)
+    updated = Column(types.DateTime, default=datetime.datetime.now,
+                     onupdate=datetime.datetime.now)
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def get(cls, publisher_id, include_sub_publishers):
+        return model.Session.query(cls)\
+                    .filter(cls.publisher_id == publisher_id)\
+                    .filter(cls.include_sub_publishers == include_sub_publishers)\
+                    .first()
+
+    def traffic_lights(self):
+        return {
+            'broken_links': self.broken_links,
+            'openness': self.openness,
+            'issues': self.issues,
+            'spending': self.spending,
+        }
+
+    def openness_score_counts(self):
+        return json.loads(self.openness_scores)
+
+
+def init_tables(e):
+    Base.metadata.create_all(e)
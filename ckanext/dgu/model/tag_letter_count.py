@@ -0,0 +1,42 @@
+from sqlalchemy import Column, types
+from sqlalchemy.ext.declarative import declarative_base
+
+import ckan.model as model
+
+Base = declarative_base()
+
+
+class TagLetterCount(Base):
+    """
+    The number of (free) tags starting with each letter, for the tag browse
+    pages (see ckanext.dgu.lib.tag_browse). The rows are deleted when tags
+    change and worked out again when next needed.
+    """
+    __tablename__ = 'tag_letter_count'
+
+    # 'A' to 'Z', or 'Other' for tags not starting with a letter
+    letter = Column(types.UnicodeText, primary_key=True)
+    count = Column(types.Integer, nullable=False, default=0)
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def counts(cls):
+        return dict(model.Session.query(cls.letter, cls.count))
+
+
+def init_tables(e):
+    Base.metadata.create_all(e)
+    if e.dialect.name == 'postgresql':
+        # Lets the tags for a letter be got with an index scan of
+        # "lower(name) LIKE 'x%'", whatever the database's collation. It is
+        # checked for, so this can be run again (CREATE INDEX IF NOT EXISTS
+        # needs PostgreSQL 9.5).
+        index_exists = e.execute(
+            "SELECT 1 FROM pg_indexes WHERE tablename = 'tag' "
+            "AND indexname = 'tag_lower_name_prefix_idx'").first()
+        if not index_exists:
+            e.execute('CREATE INDEX tag_lower_name_prefix_idx '
+                      'ON tag (lower(name) text_pattern_ops)')
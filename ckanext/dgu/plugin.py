@@ -62,6 +62,9 @@ class DguReportPlugin(p.SingletonPlugin):
         report_ctlr = 'ckanext.report.controllers:ReportController'
         map.connect('reports', '/data/report', controller=report_ctlr, action='index')
         map.redirect('/data/reports', '/data/report')
+        map.connect('report_nii_csv', '/data/report/nii.csv',
+                    controller='ckanext.dgu.controllers.data:DataController',
+                    action='nii_report_csv')
         map.connect('report', '/data/report/:report_name', controller=report_ctlr, action='view')
         map.connect('report-org', '/data/report/:report_name/:organization', controller=report_ctlr, action='view')
 
@@ -111,6 +114,7 @@ class ThemePlugin(p.SingletonPlugin):
     p.implements(p.IConfigurer)
     p.implements(p.IRoutes, inherit=True)
     p.implements(p.ITemplateHelpers, inherit=True)
+    p.implements(p.ISession, inherit=True)
 
     from ckan.lib.base import h, BaseController
     # [Monkey patch] Replace h.linked_user with a version to hide usernames
@@ -146,6 +150,16 @@ class ThemePlugin(p.SingletonPlugin):
         if not config.get('dgu.shared_assets_timestamp_path'):
             toolkit.add_public_directory(config, '../../../shared_dguk_assets')
 
+    def before_commit(self, session):
+        '''If tags have changed, the counts of tags for each letter, shown
+        on the tag browse pages, are cleared to be worked out again.'''
+        from ckanext.dgu.lib import tag_browse
+        if not hasattr(session, '_object_cache'):
+            return
+        if tag_browse.tag_letter_table_exists():
+            tag_browse.clear_letter_counts_for_changes(
+                session, set.union(*session._object_cache.values()))
+
     def get_helpers(self):
         """
         A dictionary of extra helpers that will be available to provide
@@ -285,14 +299,29 @@ class PublisherPlugin(p.SingletonPlugin):
         """
         Before we commit a session we will check to see if any of the new
         items are users so we can notify them to apply for publisher access.
+
+        Also, if the organization tree may have changed, the in-memory
+        publisher hierarchy is thrown away, to be reloaded when next needed,
+        and the publisher scorecards affected by the changes are marked stale.
         """
         from pylons.i18n import _
-        from ckan.model import User
+        from ckan.model import User, Group, Member
+        from ckanext.dgu.lib.publisher import PublisherHierarchy
+        from ckanext.dgu.lib import scorecard
 
         session.flush()
         if not hasattr(session, '_object_cache'):
             return
 
+        changed_objects = set.union(*session._object_cache.values())
+        for obj in changed_objects:
+            if isinstance(obj, Group) or \
+                    (isinstance(obj, Member) and obj.table_name == 'group'):
+                PublisherHierarchy.invalidate()
+                break
+        if scorecard.scorecard_table_exists():
+            scorecard.mark_stale_for_changes(session, changed_objects)
+
         pubctlr = 'ckanext.dgu.controllers.publisher:PublisherController'
         for obj in set(session._object_cache['new']):
             if isinstance(obj, (User)):
@@ -522,6 +551,26 @@ class ApiPlugin(p.SingletonPlugin):
     '''DGU-specific API'''
     p.implements(p.IRoutes, inherit=True)
     p.implements(p.IActions)
+    p.implements(p.ISession, inherit=True)
+
+    def before_commit(self, session):
+        '''Notes if any datasets are being committed, so the cached list of
+        latest datasets and theme counts can be cleared once they are.'''
+        from ckan.model import Package, PackageExtra
+        if not hasattr(session, '_object_cache'):
+            return
+        for obj in set.union(*session._object_cache.values()):
+            if isinstance(obj, (Package, PackageExtra)):
+                session._dgu_packages_changed = True
+                break
+
+    def after_commit(self, session):
+        from ckanext.dgu.controllers.api import clear_latest_datasets_cache
+        from ckanext.dgu.lib.theme import clear_theme_counts_cache
+        if getattr(session, '_dgu_packages_changed', False):
+            session._dgu_packages_changed = False
+            clear_latest_datasets_cache()
+            clear_theme_counts_cache()
 
     def before_map(self, map):
         api_controller = 'ckanext.dgu.controllers.api:DguApiController'
@@ -534,10 +583,12 @@ class ApiPlugin(p.SingletonPlugin):
         return map
 
     def get_actions(self):
-        from ckanext.dgu.logic.action.get import publisher_show, suggest_themes
+        from ckanext.dgu.logic.action.get import (publisher_show,
+                                                  suggest_themes, theme_counts)
         return {
             'publisher_show': publisher_show,
             'suggest_themes': suggest_themes,
+            'theme_counts': theme_counts,
             }
 
 
@@ -1,4 +1,7 @@
 from logging import getLogger
+from contextlib import contextmanager
+from collections import defaultdict
+import datetime
 import re
 import string
 import json
@@ -8,14 +11,184 @@ from paste.deploy.converters import asbool
 from ckan.model.group import Group
 from ckan import model
 from ckanext.dgu.lib.formats import Formats
+from ckanext.dgu.lib.publisher import PublisherHierarchy
 from ckanext.dgu.plugins_toolkit import ObjectNotFound
 
 log = getLogger(__name__)
 
+
+class IndexingBatch(object):
+    '''Lookups that SearchIndexing needs, prefetched for a whole batch of
+    packages in a few set-based queries. Used when reindexing in bulk, so that
+    the cost is per batch, rather than several queries per package.
+
+    Anything not found here for a package in the batch is treated as missing,
+    just as if the per-package lookup had found nothing.
+    '''
+    def __init__(self, package_ids):
+        from ckanext.dgu.lib.helpers import is_plugin_enabled
+        self.package_ids = set(package_ids)
+        self.load_organizations()
+        if is_plugin_enabled('harvest'):
+            self.load_harvest_content()
+        if is_plugin_enabled('qa'):
+            self.load_qa()
+        if is_plugin_enabled('ga-report'):
+            self.load_popularity()
+        if is_plugin_enabled('dgu_schema'):
+            self.load_schemas()
+
+    def load_organizations(self):
+        '''Loads all the groups - there are only a few thousand, so it is
+        quicker to get them all than to be selective. The hierarchy comes from
+        PublisherHierarchy.'''
+        self.groups = {}
+        for id_, name, title in model.Session.query(
+                model.Group.id, model.Group.name, model.Group.title):
+            group = {'id': id_, 'name': name, 'title': title,
+                     'abbreviation': None}
+            self.groups[id_] = self.groups[name] = group
+
+        abbreviations = model.Session.query(model.GroupExtra.group_id,
+                                            model.GroupExtra.value)\
+                             .filter(model.GroupExtra.key == 'abbreviation')\
+                             .filter(model.GroupExtra.state == 'active')
+        for group_id, abbreviation in abbreviations:
+            if group_id in self.groups:
+                self.groups[group_id]['abbreviation'] = abbreviation
+
+    def load_harvest_content(self):
+        from ckanext.harvest.model import HarvestObject
+        self.harvest_content = {}
+        harvest_object_ids = model.Session.query(model.PackageExtra.package_id,
+                                                 model.PackageExtra.value)\
+            .filter(model.PackageExtra.key == 'harvest_object_id')\
+            .filter(model.PackageExtra.state == 'active')\
+            .filter(model.PackageExtra.package_id.in_(self.package_ids))\
+            .all()
+        object_ids = [object_id for pkg_id, object_id in harvest_object_ids]
+        if not object_ids:
+            return
+        content = dict(model.Session.query(HarvestObject.id,
+                                           HarvestObject.content)
+                       .filter(HarvestObject.id.in_(object_ids)))
+        for pkg_id, object_id in harvest_object_ids:
+            if object_id in content:
+                self.harvest_content[pkg_id] = content[object_id] or ''
+
+    def load_qa(self):
+        '''Mirrors qa_package_openness_show (the best score of the package's
+        resources) and qa_package_broken_show (are all/some/none of the
+        package's resources broken).'''
+        from ckanext.qa.model import QA
+        from ckanext.archiver.model import Archival
+        self.openness_score = {}
+        scores = model.Session.query(QA.package_id, QA.openness_score)\
+                      .filter(QA.package_id.in_(self.package_ids))
+        for pkg_id, score in scores:
+            best = self.openness_score.get(pkg_id)
+            if best is None or (score is not None and score > best):
+                self.openness_score[pkg_id] = score
+
+        archivals = defaultdict(list)
+        for pkg_id, is_broken in model.Session.query(Archival.package_id,
+                                                     Archival.is_broken)\
+                .filter(Archival.package_id.in_(self.package_ids)):
+            archivals[pkg_id].append(is_broken)
+        self.archival_is_broken = {}
+        for pkg_id, brokenness in archivals.items():
+            num_broken = brokenness.count(True)
+            if num_broken == len(brokenness):
+                self.archival_is_broken[pkg_id] = True
+            elif num_broken:
+                self.archival_is_broken[pkg_id] = 'some'
+            elif None in brokenness:
+                self.archival_is_broken[pkg_id] = None
+            else:
+                self.archival_is_broken[pkg_id] = False
+
+    def load_popularity(self):
+        '''Mirrors ckanext-ga-report's get_score_for_dataset - views per day
+        over the current and previous month, with last month discounted by
+        50%.'''
+        from ckanext.ga_report.ga_model import GA_Url
+        now = datetime.datetime.now()
+        last_month = now - datetime.timedelta(days=30)
+        period_names = ['%s-%02d' % (last_month.year, last_month.month),
+                        '%s-%02d' % (now.year, now.month)]
+        pkg_names = [name for (name,) in
+                     model.Session.query(model.Package.name)
+                          .filter(model.Package.id.in_(self.package_ids))]
+        views_per_day = defaultdict(dict)
+        entries = model.Session.query(GA_Url)\
+                       .filter(GA_Url.period_name.in_(period_names))\
+                       .filter(GA_Url.package_id.in_(pkg_names))
+        for entry in entries:
+            if entry.package_id in views_per_day and \
+                    entry.period_name in views_per_day[entry.package_id]:
+                # first entry wins, as it does for get_score_for_dataset
+                continue
+            views = float(entry.pageviews)
+            if entry.period_complete_day:
+                views_per_day[entry.package_id][entry.period_name] = \
+                    views / entry.period_complete_day
+            else:
+                views_per_day[entry.package_id][entry.period_name] = views / 15
+        self.popularity = {}
+        for pkg_name in pkg_names:
+            score = 0
+            for period_name in period_names:
+                score /= 2
+                score += views_per_day[pkg_name].get(period_name, 0)
+            self.popularity[pkg_name] = int(score * 100)
+
+    def load_schemas(self):
+        from ckanext.dgu.model.schema_codelist import Schema, Codelist
+        self.schema_titles = dict(
+            model.Session.query(Schema.id, Schema.title))
+        self.codelist_titles = dict(
+            model.Session.query(Codelist.id, Codelist.title))
+
+    def get_group(self, group_name_or_id):
+        return self.groups.get(group_name_or_id)
+
+    def get_ancestors(self, group_name_or_id):
+        '''Returns the group and its ancestors, as group dicts, starting with
+        the group itself.'''
+        hierarchy = PublisherHierarchy.instance()
+        ancestor_ids = hierarchy.ancestor_ids(group_name_or_id)
+        if not ancestor_ids:
+            # e.g. created since the hierarchy was loaded
+            group = self.groups.get(group_name_or_id)
+            return [group] if group else []
+        return [self.groups[id_] for id_ in ancestor_ids
+                if id_ in self.groups]
+
+
 class SearchIndexing(object):
     '''Functions that edit the package dictionary fields to affect the way it
     gets indexed in Solr.'''
 
+    # When reindexing in bulk, this holds the IndexingBatch of prefetched
+    # lookups, which the add_* functions use instead of querying per package.
+    _batch = None
+
+    @classmethod
+    @contextmanager
+    def batch(cls, package_ids):
+        '''Context manager that prefetches everything needed to index the
+        given packages. Index the packages within the with block.'''
+        cls._batch = IndexingBatch(package_ids)
+        try:
+            yield cls._batch
+        finally:
+            cls._batch = None
+
+    @classmethod
+    def _in_batch(cls, pkg_dict):
+        return cls._batch is not None and \
+            pkg_dict.get('id') in cls._batch.package_ids
+
     @classmethod
     def add_popularity(cls, pkg_dict):
         '''Adds the views field from the ga-report plugin, if it is installed'''
@@ -24,8 +197,11 @@ class SearchIndexing(object):
         score = 0
 
         if 'ga-report' in config.get('ckan.plugins'):
-            from ckanext.ga_report.ga_model import get_score_for_dataset
-            score += get_score_for_dataset(pkg_dict['name'])
+            if cls._in_batch(pkg_dict):
+                score += cls._batch.popularity.get(pkg_dict['name'], 0)
+            else:
+                from ckanext.ga_report.ga_model import get_score_for_dataset
+                score += get_score_for_dataset(pkg_dict['name'])
 
         pkg_dict['popularity'] = score
         log.debug('Popularity: %s', pkg_dict['popularity'])
@@ -107,11 +283,15 @@ class SearchIndexing(object):
     @classmethod
     def add_field__group_titles(cls, pkg_dict):
         '''Adds the group titles.'''
-        groups = [Group.get(g) for g in pkg_dict['groups']]
+        if cls._in_batch(pkg_dict):
+            titles = [cls._batch.get_group(g)['title']
+                      for g in pkg_dict['groups']]
+        else:
+            titles = [Group.get(g).title for g in pkg_dict['groups']]
 
         # Group titles
         if not pkg_dict.has_key('organization_titles'):
-            pkg_dict['organization_titles'] = [g.title for g in groups]
+            pkg_dict['organization_titles'] = titles
         else:
             log.warning('Unable to add "organization_titles" to index, as the datadict '
                         'already contains a key of that name')
@@ -121,15 +301,18 @@ class SearchIndexing(object):
         '''Adds any group abbreviation '''
         abbr = None
 
-        g = model.Group.get(pkg_dict['organization'])
+        if cls._in_batch(pkg_dict):
+            g = cls._batch.get_group(pkg_dict['organization'])
+        else:
+            g = model.Group.get(pkg_dict['organization'])
         if not g:
             log.error("Package %s does not belong to an organization" % pkg_dict['name'])
             return
 
-        try:
+        if cls._in_batch(pkg_dict):
+            abbr = g['abbreviation']
+        else:
             abbr = g.extras.get('abbreviation')
-        except:
-            raise
 
         if abbr:
             pkg_dict['group_abbreviation'] = abbr
@@ -140,6 +323,9 @@ class SearchIndexing(object):
         '''Adds the 'publisher' based on group.'''
         import ckan.model as model
 
+        if cls._in_batch(pkg_dict):
+            return cls._add_field__publisher_from_batch(pkg_dict)
+
         publisher = model.Group.get(pkg_dict.get('organization'))
         if not publisher:
             log.warning('Dataset %s doesn\'t seem to have a publisher!  '
@@ -150,28 +336,40 @@ class SearchIndexing(object):
         # Publisher names
         if not pkg_dict.has_key('publisher'):
             pkg_dict['publisher'] = publisher.name
+            pkg_dict['publisher_title'] = publisher.title
             log.debug(u"Publisher: %s", publisher.name)
         else:
             log.warning('Unable to add "publisher" to index, as the datadict '
                         'already contains a key of that name')
 
         # Ancestry of publishers
-        ancestors = []
-        while(publisher is not None):
-            ancestors.append(publisher)
-            parent_publishers = publisher.get_parent_groups('organization')
-            if len(parent_publishers) == 0:
-                publisher = None
-            else:
-                if len(parent_publishers) > 1:
-                    log.warning('Publisher %s has more than one parent publisher. '
-                                'Ignoring all but the first. %s',
-                                publisher, repr(parent_publishers))
-                publisher = parent_publishers[0]
+        ancestors = PublisherHierarchy.instance().ancestor_names(publisher.id) \
+            or [publisher.name]
 
+        if not pkg_dict.has_key('parent_publishers'):
+            pkg_dict['parent_publishers'] = ancestors
+        else:
+            log.warning('Unable to add "parent_publishers" to index, as the datadict '
+                        'already contains a key of that name. '
+                        'Package: %s Parent_publishers: %r', \
+                        pkg_dict['name'], pkg_dict['parent_publishers'])
 
+    @classmethod
+    def _add_field__publisher_from_batch(cls, pkg_dict):
+        ancestors = cls._batch.get_ancestors(pkg_dict.get('organization'))
+        if not ancestors:
+            log.warning('Dataset %s doesn\'t seem to have a publisher!  '
+                        'Unable to add publisher to index.',
+                        pkg_dict['name'])
+            return pkg_dict
+        if not pkg_dict.has_key('publisher'):
+            pkg_dict['publisher'] = ancestors[0]['name']
+            pkg_dict['publisher_title'] = ancestors[0]['title']
+        else:
+            log.warning('Unable to add "publisher" to index, as the datadict '
+                        'already contains a key of that name')
         if not pkg_dict.has_key('parent_publishers'):
-            pkg_dict['parent_publishers'] = [ p.name for p in ancestors ]
+            pkg_dict['parent_publishers'] = [p['name'] for p in ancestors]
         else:
             log.warning('Unable to add "parent_publishers" to index, as the datadict '
                         'already contains a key of that name. '
@@ -182,7 +380,16 @@ class SearchIndexing(object):
     def add_field__harvest_document(cls, pkg_dict):
         '''Index a harvested dataset\'s XML content
            (Given a low priority when searching)'''
-        if pkg_dict.get('UKLP', '') == 'True':
+        if pkg_dict.get('UKLP', '') == 'True' and cls._in_batch(pkg_dict):
+            if pkg_dict['id'] in cls._batch.harvest_content:
+                pkg_dict['extras_harvest_document_content'] = \
+                    cls._batch.harvest_content[pkg_dict['id']]
+            else:
+                log.warning('Unable to find harvest object "%s" '
+                            'referenced by dataset "%s"',
+                            pkg_dict.get('harvest_object_id', ''),
+                            pkg_dict['id'])
+        elif pkg_dict.get('UKLP', '') == 'True':
             import ckan
             from ckanext.dgu.plugins_toolkit import get_action
 
@@ -203,6 +410,8 @@ class SearchIndexing(object):
     @classmethod
     def add_field__openness(cls, pkg_dict):
         '''Add the openness score (stars) to the search index'''
+        if cls._in_batch(pkg_dict) and hasattr(cls._batch, 'openness_score'):
+            return cls._add_field__openness_from_batch(pkg_dict)
         import ckan
         from ckanext.dgu.plugins_toolkit import get_action
         context = {'model': ckan.model, 'session': ckan.model.Session,
@@ -225,16 +434,31 @@ class SearchIndexing(object):
         except ObjectNotFound:
             log.warning('No brokenness info for package %s', pkg_dict['name'])
             return
-        if not hasattr(cls, 'broken_links_map'):
-            cls.broken_links_map = {
-                    True: 'Broken',
-                    'some': 'Partially broken',
-                    False: 'OK',
-                    None: 'TBC'
-                    }
         pkg_dict['broken_links'] = cls.broken_links_map[qa_broken.get('archival_is_broken')]
         log.debug('Broken links: %s', pkg_dict['broken_links'])
 
+    broken_links_map = {
+        True: 'Broken',
+        'some': 'Partially broken',
+        False: 'OK',
+        None: 'TBC'
+        }
+
+    @classmethod
+    def _add_field__openness_from_batch(cls, pkg_dict):
+        if pkg_dict['id'] not in cls._batch.openness_score:
+            log.warning('No QA info for package %s', pkg_dict['name'])
+            return
+        pkg_dict['openness_score'] = cls._batch.openness_score[pkg_dict['id']]
+        log.debug('Openness score: %s', pkg_dict['openness_score'])
+
+        if pkg_dict['id'] not in cls._batch.archival_is_broken:
+            log.warning('No brokenness info for package %s', pkg_dict['name'])
+            return
+        pkg_dict['broken_links'] = cls.broken_links_map[
+            cls._batch.archival_is_broken[pkg_dict['id']]]
+        log.debug('Broken links: %s', pkg_dict['broken_links'])
+
     @classmethod
     def add_theme(cls, pkg_dict):
         # Extract all primary and secondary themes into the 'all_themes' field
@@ -262,7 +486,14 @@ class SearchIndexing(object):
                       pkg_dict['name'], pkg_dict.get('schema'))
             schema_ids = None
         schemas = []
-        for schema_id in schema_ids:
+        for schema_id in schema_ids or []:
+            if cls._in_batch(pkg_dict):
+                title = cls._batch.schema_titles.get(schema_id)
+                if title is None:
+                    log.error('Invalid schema_id: %r', schema_id)
+                else:
+                    schemas.append(title)
+                continue
             try:
                 schemas.append(Schema.get(schema_id).title)
             except AttributeError, e:
@@ -275,9 +506,12 @@ class SearchIndexing(object):
         except ValueError:
             log.error('Not valid JSON in codelists field: %s %r',
                       pkg_dict['name'], pkg_dict.get('codelist'))
-            codelists = None
+            codelist_ids = []
         codelists = []
         for codelist_id in codelist_ids:
-            codelists.append(Codelist.get(codelist_id).title)
+            if cls._in_batch(pkg_dict):
+                codelists.append(cls._batch.codelist_titles[codelist_id])
+            else:
+                codelists.append(Codelist.get(codelist_id).title)
         pkg_dict['codelist_multi'] = codelists
         log.debug('Code lists: %s', ' '.join(codelists))
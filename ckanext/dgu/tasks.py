@@ -8,8 +8,10 @@ import datetime
 import json
 import os
 import requests
+import threading
 import urlparse
 import traceback
+from multiprocessing.pool import ThreadPool
 
 import messytables
 
@@ -18,6 +20,11 @@ import ckan.lib.munge as munge
 from ckan.lib.field_types import DateType, DateConvertError
 from ckanclient import CkanClient, CkanApiError
 
+# Number of threads creating/updating the datasets of an upload
+INVENTORY_UPLOAD_THREADS = 4
+# How often (in rows) the progress of an upload is recorded
+PROGRESS_EVERY_ROWS = 10
+
 def _process_upload(context, data):
     """
     When provided with a filename this function will process each row
@@ -28,6 +35,10 @@ def _process_upload(context, data):
                  'package': 'a_package_id',
                  'action':  'Added' or 'Updated'
                 }
+
+    The whole file is read and checked first, and each publisher named in it
+    is looked up once. The datasets are then created/updated by a few
+    threads, with the progress recorded in task_status.
     """
     log = inventory_upload.get_logger()
 
@@ -55,6 +66,9 @@ def _process_upload(context, data):
         errors.append("Unable to read data from uploaded file. Please contact a sysadmin.")
         return errors, results
 
+    # Read all of the rows, before changing anything
+    row_errors = {}  # pos: error message
+    rows = []  # (pos, row_identity, fields)
     first = True
     pos = 0
     for row in tableset.tables[0]:
@@ -64,29 +78,116 @@ def _process_upload(context, data):
             ok, msg = validate_incoming_inventory_header(row)
             if not ok:
                 errors.append(msg)
-                break
+                return errors, results
             first = False
             continue
 
+        row_identity = _row_identity(pos, row)
         try:
-            pkg, msg = \
-                process_incoming_inventory_row(pos, row, publisher_name, client, log)
-            if pkg:
-                results.append({'package': pkg['id'], 'action': msg})
+            rows.append((pos, row_identity,
+                         parse_incoming_inventory_row(row, log)))
         except Exception, exc:
-            row_identity = str(pos)
-            try:
-                row_identity += ' (%s)' % row[0].value
-            except:
-                pass
-            errors.append('Row %s: %s' % (row_identity, str(exc)))
+            row_errors[pos] = 'Row %s: %s' % (row_identity, str(exc))
 
-    if pos < 2 and len(errors) == 0:
+    if pos < 2 and len(row_errors) == 0:
         errors.append("There was not enough data in the upload file")
+        return errors, results
+
+    publishers, publisher_errors = find_publishers(
+        set(fields['publisher_name'] for _, _, fields in rows
+            if fields['publisher_name']),
+        client, log)
 
+    # Rows which would make datasets with the same name (i.e. the same title)
+    # are done in turn by the same thread, so that they don't clash
+    jobs = {}  # dataset name: [(pos, row_identity, fields, group)]
+    for pos_, row_identity, fields in rows:
+        try:
+            group = check_incoming_inventory_row(fields, publishers,
+                                                 publisher_errors)
+        except Exception, exc:
+            row_errors[pos_] = 'Row %s: %s' % (row_identity, str(exc))
+            continue
+        name = munge.munge_title_to_name(fields['title'].decode('utf-8'))
+        jobs.setdefault(name, []).append((pos_, row_identity, fields, group))
+
+    progress = {'total': pos - 1, 'processed': len(row_errors)}
+    _update_progress(context, data, progress, log)
+
+    # Each thread has its own client, as a client keeps the last response
+    clients = threading.local()
+
+    def apply_rows(job):
+        if not hasattr(clients, 'client'):
+            clients.client = CkanClient(
+                base_location=urlparse.urljoin(context['site_url'], 'api'),
+                api_key=context['apikey'])
+        job_results = []
+        for pos_, row_identity, fields, group in job:
+            try:
+                pkg, msg = apply_incoming_inventory_row(
+                    fields, group, clients.client, log)
+                job_results.append((pos_, pkg, msg, None))
+            except Exception, exc:
+                job_results.append(
+                    (pos_, None, None, 'Row %s: %s' % (row_identity, str(exc))))
+        return job_results
+
+    row_results = {}  # pos: {'package': ..., 'action': ...}
+    if jobs:
+        pool = ThreadPool(min(INVENTORY_UPLOAD_THREADS, len(jobs)))
+        try:
+            last_reported = progress['processed']
+            for job_results in pool.imap_unordered(apply_rows, jobs.values()):
+                for pos_, pkg, msg, error in job_results:
+                    if error:
+                        row_errors[pos_] = error
+                    elif pkg:
+                        row_results[pos_] = {'package': pkg['id'], 'action': msg}
+                progress['processed'] += len(job_results)
+                if progress['processed'] - last_reported >= PROGRESS_EVERY_ROWS:
+                    _update_progress(context, data, progress, log)
+                    last_reported = progress['processed']
+        finally:
+            pool.close()
+            pool.join()
+        _update_progress(context, data, progress, log)
+
+    # report in the order of the spreadsheet
+    errors.extend(row_errors[pos_] for pos_ in sorted(row_errors))
+    results.extend(row_results[pos_] for pos_ in sorted(row_results))
     return errors, results
 
 
+def _row_identity(pos, row):
+    row_identity = str(pos)
+    try:
+        row_identity += ' (%s)' % row[0].value
+    except:
+        pass
+    return row_identity
+
+
+def _update_progress(context, data, progress, log):
+    """
+    Records how many of the rows have been processed so far, for the upload
+    status page. A failure to do so is logged, but doesn't stop the upload.
+    """
+    try:
+        update_task_status(context, {
+            'entity_id': data['jobid'],
+            'entity_type': u'inventory',
+            'task_type': 'inventory.upload',
+            'key': u'progress',
+            'value': json.dumps(progress),
+            'state': 'Processing',
+            'error': u'',
+            'last_updated': datetime.datetime.now().isoformat()
+        }, log)
+    except Exception, e:
+        log.warning('Could not record the upload progress: %s', e)
+
+
 def upload_inventory_file(context, data):
     """
 
@@ -214,6 +315,21 @@ def process_incoming_inventory_row(row_number, row, default_group_name, client,
     The text of any exception raised will be shown to the user and the
     processing aborted.
     """
+    fields = parse_incoming_inventory_row(row, log)
+    publisher_names = [fields['publisher_name']] \
+        if fields['publisher_name'] else []
+    publishers, publisher_errors = find_publishers(publisher_names, client, log)
+    group = check_incoming_inventory_row(fields, publishers, publisher_errors)
+    return apply_incoming_inventory_row(fields, group, client, log)
+
+
+def parse_incoming_inventory_row(row, log):
+    """
+    Reads the values of the provided row, returning them as a dict of:
+    title, description, publisher_name, publish_date, release_notes
+
+    The text of any exception raised will be shown to the user.
+    """
     try:
         title = row[0].value.encode('utf-8')
     except Exception, e:
@@ -245,33 +361,77 @@ def process_incoming_inventory_row(row_number, row, default_group_name, client,
         log.error(msg)
         raise Exception(msg)
 
-    group = None
-    if publisher_name:
+    return {'title': title,
+            'description': description,
+            'publisher_name': publisher_name,
+            'publish_date': publish_date,
+            'release_notes': release_notes}
+
+
+def find_publishers(publisher_names, client, log):
+    """
+    Looks up each of the named publishers (once each, however many rows
+    name it). Returns a tuple of:
+        - a dict of publisher_name: group dict
+        - a dict of publisher_name: error message, for those not found
+    """
+    publishers = {}
+    errors = {}
+    for publisher_name in publisher_names:
         try:
             result = client.action('group_search', query=publisher_name, exact=True)
-            if result['count'] == 0:
-                group = None
-                raise Exception('Publisher does not exist in data.gov.uk: "%s"' % publisher_name)
-            else:
-                group = result['results'][0]
         except Exception, e:
             log.exception('System error on group_search: %s', e)
-            raise Exception('System error checking publisher: %s' % e)
+            errors[publisher_name] = 'System error checking publisher: %s' % e
+            continue
+        if result['count'] == 0:
+            errors[publisher_name] = \
+                'Publisher does not exist in data.gov.uk: "%s"' % publisher_name
+        else:
+            publishers[publisher_name] = result['results'][0]
+    return publishers, errors
+
+
+def check_incoming_inventory_row(fields, publishers, publisher_errors):
+    """
+    Checks there is enough in the row (as read by
+    parse_incoming_inventory_row) to either update or create an unpublished
+    item, and returns its publisher's group dict.
+
+    The text of any exception raised will be shown to the user.
+    """
+    publisher_name = fields['publisher_name']
+    if publisher_name in publisher_errors:
+        raise Exception(publisher_errors[publisher_name])
+    group = publishers.get(publisher_name) if publisher_name else None
 
-    # First validation check, make sure we have enough to either update or create an
-    # unpublished item
     missing_fields = []
-    if not title.strip():
+    if not fields['title'].strip():
         missing_fields.append("Dataset title")
 
-    if not description.strip():
+    if not fields['description'].strip():
         missing_fields.append("Description of dataset")
 
     if not group:
         missing_fields.append("Owner")
 
     if missing_fields:
-        raise Exception("The following fields were missing: {1}".format(", ".join(missing_fields)))
+        raise Exception("The following fields were missing: {0}".format(", ".join(missing_fields)))
+    return group
+
+
+def apply_incoming_inventory_row(fields, group, client, log):
+    """
+    Updates the unpublished item with the title of the row (as read by
+    parse_incoming_inventory_row) or creates one. Returns a tuple of the
+    package dict and "Updated" or "Added".
+
+    The text of any exception raised will be shown to the user.
+    """
+    title = fields['title']
+    description = fields['description']
+    publish_date = fields['publish_date']
+    release_notes = fields['release_notes']
 
     # Check if we can find the dataset by title (for inventory items)
     # If this happens it's kinda hard to work out which we want.  The group might be different
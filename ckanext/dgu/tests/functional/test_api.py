@@ -416,6 +416,20 @@ class TestDrupalApi(ControllerTestCase, TestSearchIndexer):
         assert set(res.keys()) >= set(('since_timestamp', 'datasets')), res.keys()
         revs = self._get_revisions()
         assert_equal(res['since_revision_id'], revs[0].id)
-        assert_equal(res['newest_revision_id'], revs[-1].id)
-        assert res['number_of_revisions'] == len(revs), res['number_of_revisions']
-        assert res['results_limited'] == True, res['results_limited']
+
+        # if there are too many revisions or datasets for one response, the
+        # rest of the revisions are got by continuing
+        rev_ids = [rev.id for rev in revs]
+        number_of_revisions = res['number_of_revisions']
+        while res['results_limited']:
+            assert_equal(res['newest_revision_id'],
+                         rev_ids[number_of_revisions - 1])
+            offset = '/api/util/revisions?%s' % urlencode(
+                {'continue-from': res['continue_from']})
+            res = json.loads(self.app.get(offset, status=[200]).body)
+            if res['number_of_revisions']:
+                assert_equal(res['since_revision_id'],
+                             rev_ids[number_of_revisions])
+            number_of_revisions += res['number_of_revisions']
+        assert_equal(number_of_revisions, len(revs))
+        assert 'continue_from' not in res
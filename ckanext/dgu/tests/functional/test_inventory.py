@@ -1,4 +1,6 @@
+import csv
 import os
+import StringIO
 from nose.tools import assert_equal, assert_raises
 
 from ckan import model
@@ -7,6 +9,8 @@ from ckan.tests import WsgiAppCase, CommonFixtureMethods, url_for
 from ckan.tests.html_check import HtmlCheckMethods
 from ckan.tests.mock_mail_server import SmtpServerHarness
 from ckanext.dgu.lib import publisher as publib
+from ckanext.dgu.lib.inventory import (render_inventory_header,
+                                       render_inventory_row)
 from ckanext.dgu.testtools.create_test_data import DguCreateTestData
 
 
@@ -67,6 +71,43 @@ class TestInventory(WsgiAppCase, HtmlCheckMethods):
         item_count = res.body.count('\n') - 1 # -1 for header
         assert item_count == 2, item_count
 
+    def test_download_include_sub(self):
+        # an unpublished item, to check that column
+        model.repo.new_revision()
+        pkg = model.Package.get('directgov-cota')
+        pkg.extras['unpublished'] = u'true'
+        model.repo.commit_and_remove()
+
+        offset = url_for('/unpublished/national-health-service/edit/download')
+        res = self.app.get(offset, params={'include_sub': 'true'}, status=200,
+                           extra_environ={'REMOTE_USER': 'sysadmin'})
+
+        # the rows as they were written a dataset at a time
+        buf = StringIO.StringIO()
+        writer = csv.writer(buf)
+        render_inventory_header(writer)
+        nhs = model.Group.get('national-health-service')
+        for group in publib.go_down_tree(nhs):
+            datasets = sorted([pkg for pkg in
+                               group.members_of_type(model.Package).all()
+                               if pkg.state == 'active'],
+                              key=lambda pkg: pkg.name)
+            render_inventory_row(writer, datasets, group)
+        assert_equal(res.body, buf.getvalue())
+
+        rows = list(csv.reader(StringIO.StringIO(res.body)))
+        assert_equal(len(rows), 3)
+        header, rows = rows[0], dict((row[1], row) for row in rows[1:])
+        assert_equal(header[3:5], ['Number of resources', 'Unpublished'])
+        cota = rows[model.Package.get('directgov-cota').title]
+        assert_equal(cota[0], 'National Health Service')
+        assert_equal(cota[3], '1')
+        assert_equal(cota[4], 'true')
+        barnsley_pkg = model.Package.get('nhs-spend-over-25k-barnsleypct')
+        barnsley = rows[barnsley_pkg.title]
+        assert_equal(barnsley[3], str(len(barnsley_pkg.resources)))
+        assert_equal(barnsley[4], 'False')
+
     def test_upload(self):
         import tempfile
         offset = url_for('/unpublished/national-health-service/edit')
@@ -0,0 +1,112 @@
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+
+import unicodecsv as csv
+from nose.tools import assert_equal
+
+from ckan import model
+from ckanext.dgu.lib.dumper import CSVDumper, ZipMemberWriter
+from ckanext.dgu.lib.publisher import PublisherHierarchy
+from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+
+
+class TestZipMemberWriter(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.zip_filepath = os.path.join(self.dir, 'dump.zip')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def test_streamed_and_spooled_members(self):
+        dataset_lines = ['dataset-%s,Title %s\r\n' % (i, i)
+                         for i in xrange(5000)]
+        resource_lines = ['dataset-%s,http://example.com/%s.csv\r\n' % (i, i)
+                          for i in xrange(5000)]
+        zip_file = zipfile.ZipFile(self.zip_filepath, 'w', zipfile.ZIP_DEFLATED)
+        dataset_file = ZipMemberWriter(zip_file, 'datasets.csv')
+        resource_file = ZipMemberWriter(zip_file, 'resources.csv', spool=True)
+        # written to at the same time
+        for dataset_line, resource_line in zip(dataset_lines, resource_lines):
+            dataset_file.write(dataset_line)
+            resource_file.write(resource_line)
+        dataset_file.close()
+        resource_file.close()
+        datasets = ''.join(dataset_lines)
+        resources = ''.join(resource_lines)
+        assert_equal(dataset_file.file_size, len(datasets))
+        assert_equal(resource_file.file_size, len(resources))
+        zip_file.close()
+
+        zip_file = zipfile.ZipFile(self.zip_filepath)
+        assert_equal(zip_file.testzip(), None)
+        assert_equal(zip_file.namelist(), ['datasets.csv', 'resources.csv'])
+        assert_equal(zip_file.read('datasets.csv'), datasets)
+        assert_equal(zip_file.read('resources.csv'), resources)
+        zip_file.close()
+
+    def test_unicode_is_encoded(self):
+        zip_file = zipfile.ZipFile(self.zip_filepath, 'w', zipfile.ZIP_DEFLATED)
+        with ZipMemberWriter(zip_file, 'notes.txt') as member_file:
+            member_file.write(u'Caf\xe9')
+        assert_equal(member_file.file_size, 5)
+        zip_file.close()
+
+        zip_file = zipfile.ZipFile(self.zip_filepath)
+        assert_equal(zip_file.testzip(), None)
+        assert_equal(zip_file.read('notes.txt'), 'Caf\xc3\xa9')
+        zip_file.close()
+
+
+class TestCSVDumper(object):
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+        model.repo.new_revision()
+        for pkg in model.Session.query(model.Package):
+            if not pkg.owner_org:
+                pkg.owner_org = pkg.get_groups('organization')[0].id
+        # the first dataset by name has a certificate, which is not a column
+        # of its own
+        model.Package.get('cabinet-office-energy-use').extras[
+            'odi-certificate'] = json.dumps(
+                {'certificate_url': 'http://certificates.theodi.org/1'})
+        model.repo.commit_and_remove()
+        PublisherHierarchy.invalidate()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+        PublisherHierarchy.invalidate()
+
+    def _dump(self, processes):
+        dumper = CSVDumper()
+        dumper.dump(processes=processes)
+        contents = []
+        for filename in dumper.close():
+            with open(filename, 'rb') as f:
+                contents.append(f.read())
+            os.remove(filename)
+        return contents
+
+    def test_columns(self):
+        datasets, resources = self._dump(processes=1)
+        rows = list(csv.DictReader(datasets.splitlines()))
+        assert_equal(len(rows), model.Session.query(model.Package)
+                     .filter_by(state='active', private=False).count())
+        assert 'Odi Certificate' not in rows[0]
+        certificate_urls = dict((row['Name'], row['ODI Certificate URL'])
+                                for row in rows)
+        assert_equal(certificate_urls['cabinet-office-energy-use'],
+                     'http://certificates.theodi.org/1')
+        assert_equal(certificate_urls['directgov-cota'], '')
+
+    def test_sharded_dump_is_the_same(self):
+        datasets, resources = self._dump(processes=1)
+        sharded_datasets, sharded_resources = self._dump(processes=2)
+        assert_equal(sharded_datasets, datasets)
+        assert_equal(sharded_resources, resources)
+        assert len(resources.splitlines()) > 1
@@ -0,0 +1,96 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckan import model
+from ckanext.dgu.lib import incremental_dumper
+from ckanext.dgu.lib.incremental_dumper import IncrementalDumper
+from ckanext.dgu.lib.publisher import PublisherHierarchy
+from ckanext.dgu.lib.revisions import changed_organization_ids
+from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+
+
+class TestMovedPublisher:
+    @classmethod
+    def setup_class(cls):
+        # just the publishers, so that nhs-dataset is the only dataset
+        DguCreateTestData.create_groups(DguCreateTestData._publishers)
+        model.repo.new_revision()
+        pkg = model.Package(name=u'nhs-dataset', title=u'NHS dataset')
+        pkg.owner_org = model.Group.get('national-health-service').id
+        model.Session.add(pkg)
+        model.repo.commit_and_remove()
+        PublisherHierarchy.invalidate()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+        PublisherHierarchy.invalidate()
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.margin = incremental_dumper.REVISION_MARGIN
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+        incremental_dumper.REVISION_MARGIN = self.margin
+
+    def _last_revision_timestamp(self):
+        return model.Session.query(model.Revision.timestamp)\
+                    .order_by(model.Revision.timestamp.desc()).first()[0]
+
+    def _move(self, publisher_name, new_parent_name):
+        publisher = model.Group.get(publisher_name)
+        new_parent = model.Group.get(new_parent_name)
+        model.repo.new_revision()
+        member = model.Session.query(model.Member)\
+                      .filter_by(table_name='group', table_id=publisher.id,
+                                 state='active').one()
+        old_parent_id = member.group_id
+        member.group_id = new_parent.id
+        model.repo.commit_and_remove()
+        PublisherHierarchy.invalidate()
+        return old_parent_id
+
+    def _top_level_publisher(self, dumper, pkg_name):
+        row = dumper.store.execute(
+            'SELECT dataset_row FROM dataset WHERE name=?',
+            (pkg_name,)).fetchone()
+        # name, title, url, publisher, top level publisher, ...
+        return json.loads(row[0])[4]
+
+    def test_moved_publisher(self):
+        store_filepath = os.path.join(self.dir, 'store.db')
+        dumper = IncrementalDumper(store_filepath)
+        dumper.update()
+        assert_equal(self._top_level_publisher(dumper, 'nhs-dataset'),
+                     'Department of Health')
+        # only look at the revisions from here on
+        since = self._last_revision_timestamp() + \
+            datetime.timedelta(microseconds=1)
+        dumper._set_meta('last_started',
+                         since.strftime('%Y-%m-%dT%H:%M:%S.%f'))
+        dumper.store.commit()
+        dumper.close()
+        incremental_dumper.REVISION_MARGIN = datetime.timedelta(0)
+
+        old_parent_id = self._move('national-health-service',
+                                   'cabinet-office')
+        try:
+            changed_ids = changed_organization_ids(since)
+            assert_equal(changed_ids, set([
+                model.Group.get('national-health-service').id,
+                old_parent_id,
+                model.Group.get('cabinet-office').id]))
+
+            dumper = IncrementalDumper(store_filepath)
+            dumper.update()
+            assert_equal(self._top_level_publisher(dumper, 'nhs-dataset'),
+                         'Cabinet Office')
+            dumper.close()
+        finally:
+            self._move('national-health-service', 'dept-health')
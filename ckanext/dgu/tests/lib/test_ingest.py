@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.dgu.lib.ingest import Ingester, IngestException
+
+
+class MockSession(object):
+    def __init__(self):
+        self.commits = 0
+        self.rollbacks = 0
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class TestIngester(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.dir, 'checkpoint')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, lines):
+        filepath = os.path.join(self.dir, 'data.csv')
+        with open(filepath, 'wb') as f:
+            f.write('\n'.join(lines) + '\n')
+        return filepath
+
+    def test_errors_are_reported(self):
+        filepath = self._write(['Name,Value', 'a,1', 'b,-', ',', 'c,x', 'd,4'])
+        processed = []
+
+        def row_validator(row):
+            if row[1] == '-':
+                return False, 'No value'
+            return True, ''
+
+        def processor(row):
+            if row[1] == 'x':
+                raise IngestException('Bad value', True)
+            processed.append(row[0])
+
+        report = Ingester(filepath).process(processor,
+                                            row_validator=row_validator)
+        assert_equal(processed, ['a', 'd'])
+        assert_equal(report.processed, 2)
+        assert_equal(report.skipped, 1)
+        assert_equal(report.errors, [(3, 'No value'), (5, 'Bad value')])
+        assert_equal(report.aborted, None)
+
+    def test_header_error(self):
+        filepath = self._write(['Wrong,Value', 'a,1'])
+        report = Ingester(filepath).process(
+            lambda row: None,
+            header_validator=lambda row: (row[0] == 'Name', 'Bad header'))
+        assert_equal(report.aborted, 'Bad header')
+        assert_equal(report.processed, 0)
+
+    def test_batches(self):
+        filepath = self._write(['Name'] + ['row%s' % i for i in range(5)])
+        session = MockSession()
+        batches = []
+        report = Ingester(filepath).process(
+            lambda row: None, prepare_batch=batches.append,
+            session=session, batch_size=2, checkpoint=self.checkpoint)
+        assert_equal(report.processed, 5)
+        assert_equal([len(batch) for batch in batches], [2, 2, 1])
+        assert_equal(session.commits, 3)
+        # it finished, so there is nothing to resume
+        assert not os.path.exists(self.checkpoint)
+
+    def test_resume(self):
+        filepath = self._write(['Name'] + ['row%s' % i for i in range(5)])
+        session = MockSession()
+        processed = []
+
+        def failing_processor(row):
+            if row[0] == 'row3':
+                raise Exception('Database error')
+            processed.append(row[0])
+
+        report = Ingester(filepath).process(
+            failing_processor, session=session, batch_size=2,
+            checkpoint=self.checkpoint)
+        assert_equal(report.aborted, 'Row 5: Database error')
+        assert_equal(report.processed, 2)
+        assert_equal(session.rollbacks, 1)
+
+        processed = []
+        report = Ingester(filepath).process(
+            lambda row: processed.append(row[0]), session=session,
+            batch_size=2, checkpoint=self.checkpoint)
+        # the rolled back batch is done again, but not the committed one
+        assert_equal(processed, ['row2', 'row3', 'row4'])
+        assert_equal(report.processed, 5)
+        assert_equal(report.aborted, None)
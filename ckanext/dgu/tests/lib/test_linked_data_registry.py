@@ -0,0 +1,173 @@
+import json
+import os
+import shutil
+import tempfile
+
+import rdflib
+from rdflib.namespace import RDFS
+from nose.tools import assert_equal
+
+from ckanext.dgu.lib import linked_data_registry
+from ckanext.dgu.lib.linked_data_registry import (fetch, fetch_graph,
+                                                  LinkedDataRegistry, REG,
+                                                  SKOS, TTL_PARAM)
+
+REGISTER_URI = 'http://example.com/registry/codes'
+
+REGISTER_TTL = '''
+@prefix reg: <http://purl.org/linked-data/registry#> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix skos: <http://www.w3.org/2004/02/skos/core#> .
+
+<http://example.com/registry/codes> a reg:Register, skos:ConceptScheme ;
+    rdfs:label "Codes" ;
+    reg:subregister <http://example.com/registry/codes/sub> .
+<http://example.com/registry/codes/sub> a reg:Register .
+<http://example.com/registry/codes/a> a skos:Concept ; rdfs:label "A" .
+<http://example.com/registry/codes/b> a skos:Concept ; rdfs:label "B" .
+'''
+
+
+class MockResponse(object):
+    def __init__(self, status_code, content='', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception('HTTP error %s' % self.status_code)
+
+
+class MockRequests(object):
+    '''Stands in for the requests module, returning the given responses in
+    turn and recording the headers of each request.'''
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.request_headers = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.request_headers.append(headers)
+        return self.responses.pop(0)
+
+
+class TestFetch(object):
+    def setup(self):
+        self.cache_dir = os.path.join(tempfile.mkdtemp(), 'cache')
+        self.requests = linked_data_registry.requests
+
+    def teardown(self):
+        linked_data_registry.requests = self.requests
+        shutil.rmtree(os.path.dirname(self.cache_dir))
+
+    def test_not_modified(self):
+        url = 'http://example.com/registry?_format=ttl'
+        headers = {'etag': '"v1"',
+                   'last-modified': 'Mon, 01 Sep 2014 10:00:00 GMT'}
+        mock_requests = MockRequests(MockResponse(200, 'content', headers),
+                                     MockResponse(304))
+        linked_data_registry.requests = mock_requests
+
+        assert_equal(fetch(url, self.cache_dir), 'content')
+        # the headers are kept alongside the content
+        cached = os.listdir(self.cache_dir)
+        assert_equal(len(cached), 2)
+        headers_filename = [f for f in cached if f.endswith('.json')][0]
+        with open(os.path.join(self.cache_dir, headers_filename)) as f:
+            assert_equal(json.load(f), headers)
+
+        assert_equal(fetch(url, self.cache_dir), 'content')
+        assert_equal(mock_requests.request_headers,
+                     [{}, {'If-None-Match': '"v1"',
+                           'If-Modified-Since': headers['last-modified']}])
+
+    def test_changed(self):
+        url = 'http://example.com/registry?_format=ttl'
+        mock_requests = MockRequests(
+            MockResponse(200, 'old', {'etag': '"v1"'}),
+            MockResponse(200, 'new', {'etag': '"v2"'}),
+            MockResponse(304))
+        linked_data_registry.requests = mock_requests
+
+        assert_equal(fetch(url, self.cache_dir), 'old')
+        assert_equal(fetch(url, self.cache_dir), 'new')
+        assert_equal(fetch(url, self.cache_dir), 'new')
+        assert_equal(mock_requests.request_headers,
+                     [{}, {'If-None-Match': '"v1"'},
+                      {'If-None-Match': '"v2"'}])
+
+    def test_no_cache_headers(self):
+        url = 'http://example.com/registry?_format=ttl'
+        mock_requests = MockRequests(MockResponse(200, 'content'),
+                                     MockResponse(200, 'content'))
+        linked_data_registry.requests = mock_requests
+
+        assert_equal(fetch(url, self.cache_dir), 'content')
+        assert_equal(fetch(url, self.cache_dir), 'content')
+        # nothing to make a conditional request with, so nothing kept
+        assert not os.path.exists(self.cache_dir)
+        assert_equal(mock_requests.request_headers, [{}, {}])
+
+
+class TestFetchGraph(object):
+    def setup(self):
+        self.fetch = linked_data_registry.fetch
+
+    def teardown(self):
+        linked_data_registry.fetch = self.fetch
+
+    def test_relative_uris(self):
+        linked_data_registry.fetch = \
+            lambda url, cache_dir=None: '<a> <b> <c> .'
+        graph = fetch_graph('http://example.com/registry/x' + TTL_PARAM)
+        assert_equal(list(graph.subjects()),
+                     [rdflib.URIRef('http://example.com/registry/a')])
+
+
+class TestLinkedDataRegistry(object):
+    def setup(self):
+        self.fetch_graph = linked_data_registry.fetch_graph
+        self.fetched = []
+
+        def mock_fetch_graph(url, cache_dir=None):
+            self.fetched.append(str(url))
+            assert_equal(str(url), REGISTER_URI + TTL_PARAM)
+            graph = rdflib.Graph()
+            graph.parse(data=REGISTER_TTL, format='turtle')
+            return graph
+        linked_data_registry.fetch_graph = mock_fetch_graph
+
+    def teardown(self):
+        linked_data_registry.fetch_graph = self.fetch_graph
+
+    def test_type_index(self):
+        ldr = LinkedDataRegistry(REGISTER_URI)
+        subjects_by_type = ldr.subjects_by_type[REGISTER_URI]
+        assert_equal(subjects_by_type[REG.Register],
+                     set([rdflib.URIRef(REGISTER_URI),
+                          rdflib.URIRef(REGISTER_URI + '/sub')]))
+        assert_equal(subjects_by_type[SKOS.Concept],
+                     set([rdflib.URIRef(REGISTER_URI + '/a'),
+                          rdflib.URIRef(REGISTER_URI + '/b')]))
+
+    def test_member_items(self):
+        ldr = LinkedDataRegistry(REGISTER_URI)
+        register = ldr.get_resource(REGISTER_URI)
+        members = ldr.get_member_items(register)
+        # not the register itself, nor its sub-register
+        assert_equal(sorted(unicode(member[RDFS.label].next())
+                            for member in members),
+                     [u'A', u'B'])
+        assert ldr.has_sub_registers(register)
+        assert_equal(self.fetched, [REGISTER_URI + TTL_PARAM])
+
+    def test_member_items_after_release(self):
+        ldr = LinkedDataRegistry(REGISTER_URI)
+        register = ldr.get_resource(REGISTER_URI)
+        ldr.release(REGISTER_URI)
+        assert REGISTER_URI not in ldr.graphs
+
+        # it is downloaded again
+        members = list(ldr.get_member_items(register))
+        assert_equal(len(members), 2)
+        assert_equal(len(self.fetched), 2)
@@ -129,3 +129,66 @@ class TestGoDownTree:
     def test_barnsley(self):
         assert_equal(to_names(go_down_tree(model.Group.get(u'barnsley-primary-care-trust'))),
                      ['barnsley-primary-care-trust'])
+
+class TestPublisherHierarchy:
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+        PublisherHierarchy.invalidate()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+        PublisherHierarchy.invalidate()
+
+    def test_ancestors(self):
+        assert_equal(PublisherHierarchy.instance().ancestor_names('barnsley-primary-care-trust'),
+                     ['barnsley-primary-care-trust', 'national-health-service', 'dept-health'])
+
+    def test_descendants(self):
+        assert_equal(set(PublisherHierarchy.instance().descendant_names('dept-health')),
+                     set(['dept-health', 'national-health-service', 'barnsley-primary-care-trust', 'newham-primary-care-trust']))
+
+    def test_top_level(self):
+        hierarchy = PublisherHierarchy.instance()
+        assert_equal(hierarchy.top_level_id('barnsley-primary-care-trust'),
+                     model.Group.get(u'dept-health').id)
+        assert_equal(hierarchy.top_level_id('dept-health'),
+                     model.Group.get(u'dept-health').id)
+
+    def test_unknown(self):
+        assert_equal(PublisherHierarchy.instance().ancestor_ids('not-a-publisher'), [])
+
+class TestResourceCount:
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+        PublisherHierarchy.invalidate()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+        PublisherHierarchy.invalidate()
+
+    def test_dataset_in_two_publishers_of_the_tree(self):
+        nhs = model.Group.get('national-health-service')
+        barnsley = model.Group.get('barnsley-primary-care-trust')
+        pkg = model.Package.get('directgov-cota')
+        num_resources = len(pkg.resources)
+        assert num_resources
+        nhs_count = resource_count(nhs, include_sub_publishers=True)
+        nhs_scores = openness_scores(nhs, include_sub_publishers=True,
+                                     use_cache=False)
+        barnsley_count = resource_count(barnsley)
+
+        # directgov-cota is in NHS, and now in Barnsley (below NHS) too
+        model.repo.new_revision()
+        model.Session.add(model.Member(group=barnsley, table_id=pkg.id,
+                                       table_name='package'))
+        model.repo.commit_and_remove()
+
+        assert_equal(resource_count(barnsley), barnsley_count + num_resources)
+        assert_equal(resource_count(nhs, include_sub_publishers=True),
+                     nhs_count)
+        assert_equal(openness_scores(nhs, include_sub_publishers=True,
+                                     use_cache=False), nhs_scores)
@@ -1,6 +1,10 @@
+import os
+import shutil
+import tempfile
 from datetime import datetime as dt
 from nose.tools import assert_equal
 
+from ckanext.dgu.drupalclient import DrupalRequestError
 from ckanext.dgu.lib.reports import get_quarter_dates
 
 class TestQuarters(object):
@@ -20,3 +24,325 @@ class TestQuarters(object):
         assert_equal(qs['last'], (dt(2014, 1, 1), dt(2014, 3, 31)))
 
 
+
+
+class TestPublisherActivity(object):
+    @classmethod
+    def setup_class(cls):
+        from ckan import model
+
+        def new_revision(author, timestamp):
+            rev = model.repo.new_revision()
+            rev.author = author
+            cls.timestamps[author] = timestamp
+            return rev
+
+        cls.timestamps = {}
+        new_revision('creator', dt(2014, 5, 2, 12, 0))
+        pkg = model.Package(name=u'activity-test', title=u'Original title')
+        model.Session.add(pkg)
+        pkg.extras['theme-primary'] = 'Health'
+        model.repo.commit_and_remove()
+
+        new_revision('editor', dt(2014, 5, 3, 12, 0))
+        pkg = model.Package.by_name(u'activity-test')
+        pkg.title = u'New title'
+        model.repo.commit_and_remove()
+
+        # system authors are ignored
+        new_revision('autotheme', dt(2014, 5, 4, 12, 0))
+        pkg = model.Package.by_name(u'activity-test')
+        pkg.extras['theme-primary'] = 'Society'
+        model.repo.commit_and_remove()
+
+        cls.backdate_revisions()
+        cls.pkg_id = model.Package.by_name(u'activity-test').id
+
+    @classmethod
+    def backdate_revisions(cls):
+        from ckan import model
+        for rev in model.Session.query(model.Revision):
+            timestamp = cls.timestamps.get(rev.author)
+            if not timestamp:
+                continue
+            rev.timestamp = timestamp
+            for obj_revision_table in (model.PackageRevision,
+                                       model.PackageExtraRevision,
+                                       model.ResourceRevision):
+                model.Session.query(obj_revision_table)\
+                    .filter(obj_revision_table.revision_id == rev.id)\
+                    .update({'revision_timestamp': timestamp},
+                            synchronize_session=False)
+        model.repo.commit_and_remove()
+
+    @classmethod
+    def teardown_class(cls):
+        from ckan import model
+        model.repo.rebuild_db()
+
+    def _rows(self, table):
+        # leave out the notes
+        return [row[:2] + row[3:] for row in table]
+
+    def test_created_and_modified(self):
+        from ckanext.dgu.lib.reports import PublisherActivity
+        activity = PublisherActivity(dt(2014, 5, 10), [self.pkg_id])
+        assert_equal(self._rows(activity.table()), [
+            ('activity-test', 'Original title', 'created', 'this',
+             '2014-05-02T12:00:00', 'creator', True),
+            ('activity-test', 'New title', 'modified', 'this',
+             '2014-05-03', 'editor', True)])
+
+    def test_all_packages_then_split(self):
+        from ckanext.dgu.lib.reports import PublisherActivity
+        # as precomputed for all organizations
+        activity = PublisherActivity(dt(2014, 5, 10))
+        assert_equal(
+            self._rows(activity.table([self.pkg_id])),
+            self._rows(PublisherActivity(dt(2014, 5, 10),
+                                         [self.pkg_id]).table()))
+
+    def test_next_quarter(self):
+        from ckanext.dgu.lib.reports import PublisherActivity
+        activity = PublisherActivity(dt(2014, 7, 10), [self.pkg_id])
+        assert_equal([row[3:5] for row in activity.table()],
+                     [('created', 'last'), ('modified', 'last')])
+
+
+class TestAdminEditor(object):
+    @classmethod
+    def setup_class(cls):
+        from ckan import model
+        from ckanext.dgu.lib import reports
+        from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+        DguCreateTestData.create_dgu_test_data()
+        model.repo.new_revision()
+        model.User.by_name(u'nhseditor').state = u'deleted'
+        model.repo.commit_and_remove()
+        # don't look up names in Drupal
+        cls.get_drupal_realnames = reports.get_drupal_realnames
+        reports.get_drupal_realnames = lambda drupal_user_ids: {}
+
+    @classmethod
+    def teardown_class(cls):
+        from ckan import model
+        from ckanext.dgu.lib import reports
+        from ckanext.dgu.lib.publisher import PublisherHierarchy
+        reports.get_drupal_realnames = cls.get_drupal_realnames
+        model.repo.rebuild_db()
+        PublisherHierarchy.invalidate()
+
+    def test_organization(self):
+        from ckanext.dgu.lib.reports import admin_editor
+        table = admin_editor('national-health-service')['table']
+        assert_equal(len(table), 1)
+        assert_equal(table[0]['publisher_name'], 'national-health-service')
+        assert_equal(table[0]['admins'], 'NHS Admin <admin@nhs.gov.uk>')
+        # nhseditor is deleted
+        assert_equal(table[0]['editors'],
+                     'NHS Editor imported from Drupal <None>')
+
+    def test_precomputed_matches(self):
+        from ckanext.dgu.lib import reports
+        direct = reports.admin_editor('national-health-service',
+                                      include_sub_organizations=True)
+        assert_equal([record['publisher_name'] for record in direct['table']],
+                     ['barnsley-primary-care-trust',
+                      'national-health-service',
+                      'newham-primary-care-trust'])
+        reports.set_precomputed('admin_editor',
+                                reports.admin_editor_by_organization())
+        try:
+            precomputed = reports.admin_editor('national-health-service',
+                                               include_sub_organizations=True)
+        finally:
+            reports.clear_precomputed('admin_editor')
+        assert_equal(precomputed, direct)
+
+
+class TestNii(object):
+    @classmethod
+    def setup_class(cls):
+        from ckan import model
+        from ckanext.archiver import model as archiver
+        from ckanext.archiver.model import Archival
+        from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+        DguCreateTestData.create_dgu_test_data()
+        archiver.init_tables(model.meta.engine)
+        model.repo.new_revision()
+        for pkg_name, org_name in (
+                ('directgov-cota', 'national-health-service'),
+                ('nhs-spend-over-25k-barnsleypct',
+                 'barnsley-primary-care-trust')):
+            pkg = model.Package.get(pkg_name)
+            pkg.owner_org = model.Group.get(org_name).id
+            pkg.extras['core-dataset'] = 'true'
+        model.repo.commit_and_remove()
+
+        pkg = model.Package.get('nhs-spend-over-25k-barnsleypct')
+        cls.broken_resources = [(res.description, res.id)
+                                for res in pkg.resources[:2]]
+        for _, resource_id in cls.broken_resources:
+            archival = Archival.create(resource_id)
+            archival.is_broken = True
+            model.Session.add(archival)
+        # an archival that is not broken
+        archival = Archival.create(pkg.resources[2].id)
+        archival.is_broken = False
+        model.Session.add(archival)
+        model.Session.commit()
+        cls.num_resources = dict(
+            (pkg_name, len(model.Package.get(pkg_name).resources))
+            for pkg_name in ('directgov-cota',
+                             'nhs-spend-over-25k-barnsleypct'))
+
+    @classmethod
+    def teardown_class(cls):
+        from ckan import model
+        from ckanext.dgu.lib.publisher import PublisherHierarchy
+        model.repo.rebuild_db()
+        PublisherHierarchy.invalidate()
+
+    def test_report(self):
+        from ckanext.dgu.lib.reports import nii_report
+        report = nii_report()
+        assert_equal([row['name'] for row in report['table']],
+                     ['nhs-spend-over-25k-barnsleypct', 'directgov-cota'])
+        barnsley_row, cota_row = report['table']
+        assert_equal(barnsley_row['num_broken_resources'], 2)
+        assert_equal(sorted(barnsley_row['broken_resources']),
+                     sorted(self.broken_resources))
+        assert_equal(cota_row['num_broken_resources'], 0)
+        assert_equal(cota_row['broken_resources'], [])
+        assert_equal(report['num_datasets'], 2)
+        assert_equal(report['num_resources'], sum(self.num_resources.values()))
+        assert_equal(report['num_organizations'], 2)
+        assert_equal(report['num_broken_resources'], 2)
+        assert_equal(report['num_broken_datasets'], 1)
+        assert_equal(report['num_broken_organizations'], 1)
+
+    def test_csv_rows(self):
+        from ckanext.dgu.lib.reports import (nii_report_csv_rows,
+                                             NII_CSV_HEADER)
+        rows = list(nii_report_csv_rows())
+        assert_equal(rows[0], NII_CSV_HEADER)
+        assert_equal(len(rows), 3)
+        barnsley_row, cota_row = rows[1:]
+        assert_equal(barnsley_row[:6], (
+            'barnsley-primary-care-trust', 'Barnsley Primary Care Trust',
+            'nhs-spend-over-25k-barnsleypct',
+            u'Spend over \xa325k for Barnsley PCT', False,
+            self.num_resources['nhs-spend-over-25k-barnsleypct']))
+        assert_equal(barnsley_row[6], 2)
+        assert_equal(sorted(barnsley_row[7].split(' ')),
+                     sorted(resource_id
+                            for _, resource_id in self.broken_resources))
+        assert_equal(cota_row[2], 'directgov-cota')
+        assert_equal(cota_row[5:], (self.num_resources['directgov-cota'], 0,
+                                    ''))
+
+
+def drupal_properties(first_name, surname):
+    return {'field_first_name': {'und': [{'safe_value': first_name}]},
+            'field_surname': {'und': [{'safe_value': surname}]}}
+
+
+class StubDrupalClient(object):
+    '''Stands in for DrupalClient, recording the users requested.'''
+    users = {'101': drupal_properties('Fred', 'Bloggs'),
+             '102': drupal_properties('Jo', 'Smith'),
+             '103': drupal_properties('', '')}
+    failing = set()
+    requested = []
+
+    def get_users_properties(self, user_ids, threads=4, errors=None):
+        StubDrupalClient.requested.append(sorted(user_ids))
+        properties = {}
+        for user_id in user_ids:
+            if user_id in self.failing:
+                errors[user_id] = DrupalRequestError('Connection refused')
+            else:
+                properties[user_id] = self.users[user_id]
+        return properties
+
+
+class MockUser(object):
+    def __init__(self, name, fullname):
+        self.id = 'id-%s' % name
+        self.name = name
+        self.fullname = fullname
+
+
+class TestRealnames(object):
+    '''Uses the in-memory cache of names. (TestRealnamesLookupCache uses the
+    Drupal lookup cache.)'''
+    cache_filepath = None
+
+    def setup(self):
+        from pylons import config
+        from ckanext.dgu import drupalclient
+        from ckanext.dgu.lib import reports
+        self.drupal_client = drupalclient.DrupalClient
+        drupalclient.DrupalClient = StubDrupalClient
+        StubDrupalClient.failing = set()
+        StubDrupalClient.requested = []
+        reports._drupal_realnames.clear()
+        self.config_cache_filepath = config.get('drupal_cache_filepath')
+        config['drupal_cache_filepath'] = self.cache_filepath
+
+    def teardown(self):
+        from pylons import config
+        from ckanext.dgu import drupalclient
+        drupalclient.DrupalClient = self.drupal_client
+        config['drupal_cache_filepath'] = self.config_cache_filepath
+
+    def test_fetched_once(self):
+        from ckanext.dgu.lib.reports import get_drupal_realnames
+        names = get_drupal_realnames(['101', '102', '101'])
+        assert_equal(names, {'101': 'Fred Bloggs', '102': 'Jo Smith'})
+        assert_equal(StubDrupalClient.requested, [['101', '102']])
+
+        # cached
+        assert_equal(get_drupal_realnames(['102', '101']), names)
+        assert_equal(StubDrupalClient.requested, [['101', '102']])
+
+    def test_errors_are_fetched_again(self):
+        from ckanext.dgu.lib.reports import get_drupal_realnames
+        StubDrupalClient.failing = set(['102'])
+        assert_equal(get_drupal_realnames(['101', '102']),
+                     {'101': 'Fred Bloggs'})
+
+        StubDrupalClient.failing = set()
+        assert_equal(get_drupal_realnames(['101', '102']),
+                     {'101': 'Fred Bloggs', '102': 'Jo Smith'})
+        assert_equal(StubDrupalClient.requested, [['101', '102'], ['102']])
+
+    def test_user_realnames(self):
+        from ckanext.dgu.lib.reports import get_user_realnames
+        users = [MockUser('user_d101', 'Fred imported from Drupal'),
+                 MockUser('user_d103', 'Nameless imported from Drupal'),
+                 MockUser('user_d101', 'Fred again'),
+                 MockUser('ckanuser', 'CKAN User')]
+        users[2].id = 'id-user_d101-2'
+        names = get_user_realnames(users)
+        assert_equal(names, {'id-user_d101': 'Fred Bloggs',
+                             'id-user_d103': 'Nameless imported from Drupal',
+                             'id-user_d101-2': 'Fred Bloggs',
+                             'id-ckanuser': 'CKAN User'})
+        # each Drupal user is requested once
+        assert_equal(StubDrupalClient.requested, [['101', '103']])
+
+        # all cached
+        assert_equal(get_user_realnames(users), names)
+        assert_equal(StubDrupalClient.requested, [['101', '103']])
+
+
+class TestRealnamesLookupCache(TestRealnames):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_filepath = os.path.join(self.dir, 'drupal_cache.db')
+        super(TestRealnamesLookupCache, self).setup()
+
+    def teardown(self):
+        super(TestRealnamesLookupCache, self).teardown()
+        shutil.rmtree(self.dir)
@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.dgu.lib.resource_cache import (stream_sub, head_regex,
+                                            rewrite_html, rewritten_filepath,
+                                            rewrite_and_keep, file_key,
+                                            serve_file)
+
+BASE = "<head><base href='http://example.com'>"
+HEADER = '<div id="__archiver__cache__header__">Cached</div>'
+
+
+class TestStreamSub(object):
+    def test_match_across_chunks(self):
+        chunks = ['<html><he', 'AD></head><HEAD>', '<head>']
+        assert_equal(''.join(stream_sub(iter(chunks), head_regex, '<x>', 2, 6)),
+                     '<html><x></head><x><head>')
+
+    def test_no_match(self):
+        chunks = ['<html>', '<body>', '</html>']
+        assert_equal(''.join(stream_sub(iter(chunks), head_regex, '<x>', 2, 6)),
+                     '<html><body></html>')
+
+
+class TestRewriteHtml(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, content):
+        filepath = os.path.join(self.dir, 'page.html')
+        with open(filepath, 'wb') as f:
+            f.write(content)
+        return filepath
+
+    def test_rewrite(self):
+        filepath = self._write('<html><HEAD></HEAD><body>Hi</BODY></html>')
+        assert_equal(''.join(rewrite_html(filepath, BASE, HEADER)),
+                     "<html><head><base href='http://example.com'></HEAD>"
+                     "<body>Hi%s</body></html>" % HEADER)
+
+    def test_already_has_base_and_header(self):
+        content = '<html><head><BASE href="x"></head><body>%s</body></html>' \
+            % HEADER
+        filepath = self._write(content)
+        assert_equal(''.join(rewrite_html(filepath, BASE, HEADER)), content)
+
+    def test_rewrite_and_keep(self):
+        filepath = self._write('<html><head></head><body>Hi</body></html>')
+        key = file_key(filepath, u'http://example.com/page')
+        rewritten = rewritten_filepath(os.path.join(self.dir, 'rewritten'),
+                                       'res-id', filepath, key)
+
+        content = ''.join(rewrite_and_keep(filepath, rewritten, BASE, HEADER))
+
+        assert_equal(open(rewritten, 'rb').read(), content)
+        assert_equal(os.listdir(os.path.dirname(rewritten)),
+                     [os.path.basename(rewritten)])
+
+
+class TestServeFile(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.dir, 'data.csv')
+        with open(self.filepath, 'wb') as f:
+            f.write('0123456789')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def _get(self, **environ):
+        environ.setdefault('REQUEST_METHOD', 'GET')
+        response = {}
+        def start_response(status, headers):
+            response['status'] = status
+            response['headers'] = dict(headers)
+        response['body'] = ''.join(serve_file(environ, start_response,
+                                              self.filepath))
+        return response
+
+    def test_get(self):
+        response = self._get()
+        assert_equal(response['status'], '200 OK')
+        assert_equal(response['body'], '0123456789')
+        assert_equal(response['headers']['Content-Type'], 'text/csv')
+        assert response['headers']['ETag']
+
+    def test_if_none_match(self):
+        etag = self._get()['headers']['ETag']
+        response = self._get(HTTP_IF_NONE_MATCH=etag)
+        assert_equal(response['status'], '304 Not Modified')
+        assert_equal(response['body'], '')
+
+    def test_if_none_match_changed(self):
+        response = self._get(HTTP_IF_NONE_MATCH='"other"')
+        assert_equal(response['status'], '200 OK')
+
+    def test_if_modified_since(self):
+        last_modified = self._get()['headers']['Last-Modified']
+        response = self._get(HTTP_IF_MODIFIED_SINCE=last_modified)
+        assert_equal(response['status'], '304 Not Modified')
+
+    def test_range(self):
+        response = self._get(HTTP_RANGE='bytes=2-4')
+        assert_equal(response['status'], '206 Partial Content')
+        assert_equal(response['body'], '234')
+        assert_equal(response['headers']['Content-Range'], 'bytes 2-4/10')
+
+    def test_range_open_ended(self):
+        assert_equal(self._get(HTTP_RANGE='bytes=7-')['body'], '789')
+        assert_equal(self._get(HTTP_RANGE='bytes=-2')['body'], '89')
+
+    def test_range_not_satisfiable(self):
+        response = self._get(HTTP_RANGE='bytes=20-')
+        assert_equal(response['status'], '416 Requested Range Not Satisfiable')
+
+    def test_range_if_range_changed(self):
+        response = self._get(HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"other"')
+        assert_equal(response['status'], '200 OK')
+        assert_equal(response['body'], '0123456789')
@@ -0,0 +1,158 @@
+from nose.tools import assert_equal
+
+from ckan import model
+from ckanext.archiver import model as archiver
+from ckanext.dgu.lib import publisher as publib
+from ckanext.dgu.lib import scorecard as scorecard_lib
+from ckanext.dgu.lib.publisher import PublisherHierarchy
+from ckanext.dgu.lib.scorecard import (traffic_lights, refresh_scorecards,
+                                       refresh_stale_scorecards, mark_stale,
+                                       get_scorecard)
+from ckanext.dgu.model import publisher_scorecard
+from ckanext.dgu.model.publisher_scorecard import PublisherScorecard
+from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+
+
+class MockPublisher(object):
+    def __init__(self, category=''):
+        self.name = 'mock-publisher'
+        self.extras = {'category': category}
+
+
+class TestTrafficLights:
+    def _lights(self, resource_count=10, openness_counts=None,
+                broken_count=0, publisher=None):
+        openness_counts = openness_counts or {}
+        return traffic_lights(publisher or MockPublisher(), resource_count,
+                              sum(openness_counts.values()), openness_counts,
+                              broken_count)
+
+    def test_broken_links(self):
+        pct, lights = self._lights(100, broken_count=0)
+        assert_equal(pct, 0)
+        assert_equal(lights['broken_links'], 'green')
+        assert_equal(self._lights(100, broken_count=1)[1]['broken_links'],
+                     'green')
+        pct, lights = self._lights(100, broken_count=30)
+        assert_equal(pct, 30)
+        assert_equal(lights['broken_links'], 'amber')
+        pct, lights = self._lights(100, broken_count=61)
+        assert_equal(pct, 61)
+        assert_equal(lights['broken_links'], 'red')
+
+    def test_no_resources(self):
+        pct, lights = self._lights(0, broken_count=0)
+        assert_equal(pct, 0)
+        assert_equal(lights['broken_links'], 'green')
+        assert_equal(lights['openness'], 'green')
+
+    def test_openness(self):
+        assert_equal(self._lights(openness_counts={'4': 2, '5': 1})[1]
+                     ['openness'], 'green')
+        assert_equal(self._lights(openness_counts={'3': 2, '1': 1})[1]
+                     ['openness'], 'amber')
+        assert_equal(self._lights(openness_counts={'0': 3})[1]
+                     ['openness'], 'red')
+
+    def test_spending(self):
+        assert_equal(self._lights()[1]['spending'], 'green')
+        publisher = MockPublisher(category='ministerial-department')
+        assert_equal(self._lights(publisher=publisher)[1]['spending'], 'red')
+
+    def test_issues(self):
+        # ckanext-issues is not in the test config
+        assert_equal(self._lights()[1]['issues'], 'green')
+
+
+class TestRefreshScorecards:
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+        archiver.init_tables(model.meta.engine)
+        publisher_scorecard.init_tables(model.meta.engine)
+        scorecard_lib._table_exists = None
+        PublisherHierarchy.invalidate()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+        # the table has gone with the rebuild
+        scorecard_lib._table_exists = None
+        PublisherHierarchy.invalidate()
+
+    def _publishers(self):
+        return model.Session.query(model.Group)\
+                    .filter_by(type='organization', state='active').all()
+
+    def test_get_scorecard_does_not_work_it_out(self):
+        model.Session.query(PublisherScorecard).delete()
+        model.Session.commit()
+        publisher = model.Group.get('national-health-service')
+        assert_equal(get_scorecard(publisher, False), None)
+        assert_equal(model.Session.query(PublisherScorecard).count(), 0)
+
+    def test_refresh_matches_live_figures(self):
+        refresh_scorecards()
+        for publisher in self._publishers():
+            for include_sub_publishers in (False, True):
+                scorecard = get_scorecard(publisher, include_sub_publishers)
+                assert scorecard, publisher.name
+                assert_equal(scorecard.resource_count,
+                             publib.resource_count(publisher,
+                                                   include_sub_publishers))
+                total, counts = publib.openness_scores(
+                    publisher, include_sub_publishers, use_cache=False)
+                assert_equal(scorecard.openness_total, total)
+                assert_equal(scorecard.openness_score_counts(), dict(counts))
+                assert_equal(scorecard.broken_count, 0)
+                assert_equal(scorecard.broken_links, 'green')
+                assert_equal(scorecard.stale, False)
+
+    def test_sub_publishers_are_included(self):
+        refresh_scorecards()
+        dh = model.Group.get('dept-health')
+        nhs = model.Group.get('national-health-service')
+        assert_equal(get_scorecard(dh, False).resource_count, 0)
+        assert get_scorecard(nhs, False).resource_count > 0
+        assert get_scorecard(dh, True).resource_count >= \
+            get_scorecard(nhs, True).resource_count
+
+    def test_refresh_stale(self):
+        refresh_scorecards()
+        nhs = model.Group.get('national-health-service')
+        mark_stale(model.Session, [nhs.id])
+        model.Session.commit()
+        stale = set(publisher.name for publisher in self._publishers()
+                    if get_scorecard(publisher, False).stale)
+        # the publisher and those above it
+        assert_equal(stale, set(['national-health-service', 'dept-health']))
+
+        refreshed = refresh_stale_scorecards()
+        assert_equal(refreshed, set([nhs.id,
+                                     model.Group.get('dept-health').id]))
+        assert_equal(model.Session.query(PublisherScorecard)
+                     .filter_by(stale=True).count(), 0)
+
+    def test_dataset_in_two_publishers_of_the_tree(self):
+        refresh_scorecards()
+        nhs = model.Group.get('national-health-service')
+        nhs_count = get_scorecard(nhs, True).resource_count
+        barnsley_id = model.Group.get('barnsley-primary-care-trust').id
+        pkg_id = model.Package.get('directgov-cota').id
+        # directgov-cota is in NHS, and now in Barnsley (below NHS) too
+        model.repo.new_revision()
+        model.Session.add(model.Member(group_id=barnsley_id, table_id=pkg_id,
+                                       table_name='package'))
+        model.repo.commit_and_remove()
+        try:
+            refresh_scorecards()
+            nhs = model.Group.get('national-health-service')
+            assert_equal(get_scorecard(nhs, True).resource_count, nhs_count)
+            assert_equal(get_scorecard(nhs, True).resource_count,
+                         publib.resource_count(nhs, True))
+        finally:
+            model.repo.new_revision()
+            model.Session.query(model.Member)\
+                 .filter_by(group_id=barnsley_id, table_id=pkg_id)\
+                 .one().delete()
+            model.repo.commit_and_remove()
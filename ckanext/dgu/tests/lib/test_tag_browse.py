@@ -0,0 +1,88 @@
+from nose.tools import assert_equal, assert_raises
+
+from ckan import model
+import ckan.new_tests.factories as factories
+from ckanext.dgu.lib import tag_browse
+from ckanext.dgu.lib.tag_browse import (count_tags_by_letter, tags_for_letter,
+                                        letter_counts)
+from ckanext.dgu.model import tag_letter_count
+from ckanext.dgu.model.tag_letter_count import TagLetterCount
+
+
+class TestTagBrowse(object):
+    @classmethod
+    def setup_class(cls):
+        factories.Dataset(tags=[{'name': 'apples'}, {'name': 'Avocados'},
+                                {'name': 'bananas'}, {'name': '2014'}])
+        factories.Dataset(tags=[{'name': 'apples'}, {'name': 'cherries'}])
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def test_count_tags_by_letter(self):
+        counts = count_tags_by_letter()
+
+        assert_equal(counts['A'], 2)
+        assert_equal(counts['B'], 1)
+        assert_equal(counts['C'], 1)
+        assert_equal(counts['Z'], 0)
+        assert_equal(counts['Other'], 1)
+
+    def test_tags_for_letter(self):
+        # (the order of upper and lower case depends on the db collation)
+        assert_equal(set(tags_for_letter('A')), set(['Avocados', 'apples']))
+
+    def test_tags_for_letter_paged(self):
+        page_1 = tags_for_letter('A', limit=1, offset=0)
+        page_2 = tags_for_letter('A', limit=1, offset=1)
+
+        assert_equal(len(page_1), 1)
+        assert_equal(set(page_1 + page_2), set(['Avocados', 'apples']))
+
+    def test_all_tags(self):
+        assert_equal(len(tags_for_letter(None)), 5)
+
+    def test_not_a_letter(self):
+        # e.g. a LIKE wildcard
+        assert_raises(ValueError, tags_for_letter, '%')
+        assert_raises(ValueError, tags_for_letter, 'a')
+
+
+class TestLetterCounts(object):
+    @classmethod
+    def setup_class(cls):
+        factories.Dataset(tags=[{'name': 'apples'}, {'name': 'bananas'}])
+        tag_letter_count.init_tables(model.meta.engine)
+        tag_browse._table_exists = None
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+        tag_browse._table_exists = None
+
+    def test_filled_when_empty(self):
+        model.Session.execute(TagLetterCount.__table__.delete())
+        model.Session.commit()
+
+        counts = letter_counts()
+
+        assert_equal(counts, count_tags_by_letter())
+        assert_equal(TagLetterCount.counts(), counts)
+        assert_equal(letter_counts()['A'], 1)
+
+    def test_session_is_not_committed(self):
+        model.Session.execute(TagLetterCount.__table__.delete())
+        model.Session.commit()
+        model.Session.add(model.Tag(name=u'uncommitted'))
+
+        letter_counts()
+        model.Session.rollback()
+
+        assert_equal(model.Tag.by_name(u'uncommitted'), None)
+        assert_equal(TagLetterCount.counts()['B'], 1)
+
+    def test_init_tables_again(self):
+        # e.g. the tag_browse init command is run a second time
+        tag_letter_count.init_tables(model.meta.engine)
+        assert TagLetterCount.__table__.exists(bind=model.meta.engine)
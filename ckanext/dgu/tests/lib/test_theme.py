@@ -4,7 +4,8 @@ from nose.tools import assert_equal
 
 from ckan import model
 from ckanext.dgu.lib.theme import (categorize_package, categorize_package2,
-                                   normalize_token)
+                                   normalize_token, theme_counts,
+                                   clear_theme_counts_cache, Themes)
 from ckanext.taxonomy.models import init_tables
 from ckanext.taxonomy import lib
 
@@ -108,6 +109,83 @@ class TestCategorizePackage2(ThemeTestBase):
         assert_equal(set(('Business & Economy',)), set(theme_names))
 
 
+class TestThemeCounts(ThemeTestBase):
+
+    def test_counts(self):
+        import ckan.new_tests.factories as factories
+        factories.Dataset(extras=[
+            {'key': 'theme-primary', 'value': 'Health'},
+            {'key': 'theme-secondary', 'value': '["Environment", "Society"]'}])
+        factories.Dataset(extras=[
+            {'key': 'theme-primary', 'value': 'Health'},
+            {'key': 'theme-secondary', 'value': '["Environment"]'}])
+        factories.Dataset(extras=[
+            {'key': 'theme-primary', 'value': 'Environment'}])
+        clear_theme_counts_cache()
+
+        counts = theme_counts()
+
+        assert_equal(counts['primary']['Health'], 2)
+        assert_equal(counts['primary']['Environment'], 1)
+        assert_equal(counts['primary']['Society'], 0)
+        assert_equal(counts['secondary']['Environment'], 2)
+        assert_equal(counts['secondary']['Society'], 1)
+        assert_equal(counts['secondary']['Health'], 0)
+
+
+class TestMatchTopics(object):
+    def _themes(self, topics):
+        # a Themes with just the trie of the given (normalized) topics
+        themes = Themes.__new__(Themes)
+        themes.topic_trie = {}
+        for topic in topics:
+            node = themes.topic_trie
+            for word in (topic if isinstance(topic, tuple) else (topic,)):
+                node = node.setdefault(word, {})
+            node[None] = topic
+        return themes
+
+    def test_multi_word_topics(self):
+        themes = self._themes(['fish', ('air', 'quality'),
+                               ('tree', 'preservation', 'order')])
+        words = ['fish', 'air', 'quality', 'of', 'tree', 'preservation',
+                 'order', 'air', 'fish', 'tree', 'preservation']
+        assert_equal(themes.match_topics(words),
+                     {1: {'fish': 2},
+                      2: {('air', 'quality'): 1},
+                      3: {('tree', 'preservation', 'order'): 1}})
+
+    def test_overlapping_topics(self):
+        themes = self._themes(['air', ('air', 'quality'),
+                               ('air', 'quality', 'report')])
+        assert_equal(themes.match_topics(['air', 'quality', 'report']),
+                     {1: {'air': 1},
+                      2: {('air', 'quality'): 1},
+                      3: {('air', 'quality', 'report'): 1}})
+
+    def test_stopwords(self):
+        themes = self._themes(['the', ('the', 'river'), 'river'])
+        # a single-word topic is not matched on a stopword, but a longer
+        # topic starting with one is
+        assert_equal(themes.match_topics(['the', 'river', 'the']),
+                     {1: {'river': 1},
+                      2: {('the', 'river'): 1},
+                      3: {}})
+
+    def test_no_words(self):
+        assert_equal(self._themes(['fish']).match_topics([]),
+                     {1: {}, 2: {}, 3: {}})
+
+
+class TestMatchThemeTopics(ThemeTestBase):
+    def test_bigram(self):
+        themes = Themes.instance()
+        words = [normalize_token(word) for word in 'air quality'.split()]
+        matches = themes.match_topics(words)
+        assert_equal(matches[2].keys(), [tuple(words)])
+        assert 'Environment' in themes.topic_bigrams[tuple(words)]
+
+
 class TestNormalizeToken(object):
     def test_no_change(self):
         assert_equal(normalize_token('fish'), 'fish')
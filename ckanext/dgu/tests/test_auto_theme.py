@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckan import model
+from ckanext.dgu.commands.auto_theme import AutoTheme
+from ckanext.dgu.lib.theme import PRIMARY_THEME, SECONDARY_THEMES
+from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+
+
+def auto_theme_command(*args):
+    cmd = AutoTheme('auto_theme')
+    cmd.options, cmd.args = cmd.parser.parse_args(list(args))
+    return cmd
+
+
+def theme_scores(*names):
+    return [{'name': name, 'score': 10, 'reasons': []} for name in names]
+
+
+class TestChanges(object):
+    def test_changes(self):
+        cmd = auto_theme_command('run')
+        pkg_dicts = [
+            {'id': 'unchanged', 'extras': {PRIMARY_THEME: 'Health',
+                                           SECONDARY_THEMES: '["Society"]'}},
+            {'id': 'new-primary', 'extras': {PRIMARY_THEME: 'Health'}},
+            {'id': 'new-secondary', 'extras': {PRIMARY_THEME: 'Health',
+                                               SECONDARY_THEMES: '[]'}},
+            {'id': 'no-secondary-guess', 'extras': {PRIMARY_THEME: 'Health'}},
+            {'id': 'no-guess', 'extras': {}},
+            ]
+        results = {'unchanged': theme_scores('Health', 'Society'),
+                   'new-primary': theme_scores('Environment'),
+                   'new-secondary': theme_scores('Health', 'Society'),
+                   'no-secondary-guess': theme_scores('Health'),
+                   'no-guess': []}
+
+        changes = cmd._changes(pkg_dicts, results)
+
+        assert_equal([(pkg_dict['id'], primary, secondary)
+                      for pkg_dict, primary, secondary, _ in changes],
+                     [('new-primary', 'Environment', None),
+                      ('new-secondary', 'Health', '["Society"]')])
+
+
+class TestCheckpoint(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.dir, 'checkpoint.json')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def test_no_checkpoint(self):
+        cmd = auto_theme_command('run', '--checkpoint', self.checkpoint)
+        assert_equal(cmd._read_checkpoint(), {})
+
+    def test_write_and_read(self):
+        cmd = auto_theme_command('run', '--checkpoint', self.checkpoint,
+                                 '--uncategorized')
+        checkpoint = {'options': cmd._checkpoint_options(),
+                      'last_id': 'abc', 'done': 500, 'changed': 12}
+        cmd._write_checkpoint(checkpoint)
+        assert_equal(os.listdir(self.dir), ['checkpoint.json'])
+
+        cmd = auto_theme_command('run', '--checkpoint', self.checkpoint,
+                                 '--uncategorized')
+        assert_equal(cmd._read_checkpoint(), checkpoint)
+        assert_equal(cmd._read_checkpoint()['options'],
+                     cmd._checkpoint_options())
+        # a run with other options cannot resume it
+        cmd = auto_theme_command('run', '--checkpoint', self.checkpoint)
+        assert cmd._read_checkpoint()['options'] != cmd._checkpoint_options()
+
+
+class TestPackageBatches(object):
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def _active_package_ids(self):
+        return sorted(id_ for (id_,) in
+                      model.Session.query(model.Package.id)
+                           .filter_by(state='active'))
+
+    def test_batches(self):
+        cmd = auto_theme_command('run', '--batch-size', '2')
+        batches = list(cmd._package_batches(None))
+        ids = [pkg_dict['id'] for batch in batches for pkg_dict in batch]
+        assert_equal(ids, self._active_package_ids())
+        assert max(len(batch) for batch in batches) == 2
+        pkg_dict = [pkg_dict for batch in batches for pkg_dict in batch
+                    if pkg_dict['name'] == 'directgov-cota'][0]
+        pkg = model.Package.get('directgov-cota')
+        assert_equal(pkg_dict['title'], pkg.title)
+        assert_equal(pkg_dict['extras'], dict(pkg.extras))
+        assert_equal(pkg_dict['tags'], sorted(tag.name
+                                              for tag in pkg.get_tags()))
+
+    def test_resume_after_id(self):
+        cmd = auto_theme_command('run', '--batch-size', '2')
+        package_ids = self._active_package_ids()
+        batches = list(cmd._package_batches(package_ids[1]))
+        ids = [pkg_dict['id'] for batch in batches for pkg_dict in batch]
+        assert_equal(ids, package_ids[2:])
+
+    def test_publisher(self):
+        model.repo.new_revision()
+        model.Package.get('directgov-cota').owner_org = \
+            model.Group.get('national-health-service').id
+        model.repo.commit_and_remove()
+        cmd = auto_theme_command('run', '--publisher',
+                                 'national-health-service')
+        batches = list(cmd._package_batches(None))
+        names = [pkg_dict['name'] for batch in batches for pkg_dict in batch]
+        assert_equal(names, ['directgov-cota'])
+
+    def test_write_changes(self):
+        cmd = auto_theme_command('run', '--write')
+        pkg = model.Package.get('directgov-cota')
+        changes = [({'id': pkg.id}, 'Society', '["Health"]',
+                    theme_scores('Society', 'Health'))]
+        cmd._write_changes(changes)
+
+        pkg = model.Package.get('directgov-cota')
+        assert_equal(pkg.extras[PRIMARY_THEME], 'Society')
+        assert_equal(json.loads(pkg.extras[SECONDARY_THEMES]), ['Health'])
+        revision = model.Session.query(model.Revision)\
+                        .order_by(model.Revision.timestamp.desc()).first()
+        assert_equal(revision.author, 'autotheme')
@@ -1,3 +1,5 @@
+import os
+import tempfile
 import time
 import datetime
 
@@ -6,6 +8,7 @@ from nose.tools import assert_equal
 from ckan import model
 
 from ckanext.dgu.authentication.drupal_auth import DrupalAuthMiddleware
+from ckanext.dgu.authentication.drupal_cache import DrupalLookupCache
 from ckanext.dgu.tests import MockDrupalCase
 
 class TestCookie:
@@ -39,6 +42,42 @@ class TestCookie:
         res = DrupalAuthMiddleware._is_this_a_ckan_cookie(self.drupal_cookie)
         assert_equal(res, False)
 
+class TestDrupalLookupCache:
+    def setup(self):
+        fd, self.filepath = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.cache = DrupalLookupCache(self.filepath, max_entries=3)
+
+    def teardown(self):
+        os.remove(self.filepath)
+
+    def test_get_and_set(self):
+        assert_equal(self.cache.get('user:62'), (False, None))
+        self.cache.set('user:62', {'name': 'testname'}, 60)
+        assert_equal(self.cache.get('user:62'), (True, {'name': 'testname'}))
+
+    def test_negative_value(self):
+        self.cache.set('session:abc', None, 60)
+        assert_equal(self.cache.get('session:abc'), (True, None))
+
+    def test_expired(self):
+        self.cache.set('user:62', {'name': 'testname'}, -1)
+        assert_equal(self.cache.get('user:62'), (False, None))
+
+    def test_shared_between_instances(self):
+        self.cache.set('user:62', {'name': 'testname'}, 60)
+        other_cache = DrupalLookupCache(self.filepath)
+        assert_equal(other_cache.get('user:62'), (True, {'name': 'testname'}))
+
+    def test_bounded(self):
+        for i in range(5):
+            self.cache.set('user:%s' % i, i, 60 + i)
+        assert_equal(self.cache.get('user:0'), (False, None))
+        assert_equal(self.cache.get('user:4'), (True, 4))
+
+    def test_session_key_hides_session_id(self):
+        assert 'abc' not in DrupalLookupCache.session_key('abc')
+
 class MockApp:
     def __init__(self):
         self.calls = []
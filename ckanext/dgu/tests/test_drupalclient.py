@@ -3,7 +3,8 @@ from nose.tools import assert_equal, assert_raises
 
 from ckanext.dgu.tests import MockDrupalCase
 from ckanext.dgu.testtools.mock_drupal import get_mock_drupal_config, MOCK_DRUPAL_URL
-from ckanext.dgu.drupalclient import DrupalClient, DrupalKeyError
+from ckanext.dgu.drupalclient import DrupalClient, DrupalKeyError, \
+     DrupalRequestError
 
 class TestDrupalConnection(MockDrupalCase):
 
@@ -26,6 +27,31 @@ class TestDrupalConnection(MockDrupalCase):
         expected_publishers = expected_user['publishers']
         assert_equal(user['publishers'], expected_publishers)
 
+    def test_get_users_properties(self):
+        client = DrupalClient()
+        errors = {}
+        users = client.get_users_properties(['62', '999'], errors=errors)
+        assert_equal(users.keys(), ['62'])
+        assert_equal(users['62']['name'], 'testname')
+        assert_equal(errors.keys(), ['999'])
+
+        assert_raises(DrupalRequestError, client.get_users_properties, ['62', '999'])
+
+    def test_get_users_properties_unexpected_error(self):
+        import httplib
+        client = DrupalClient()
+        get_user_properties = client.get_user_properties
+        def broken_get_user_properties(user_id):
+            if user_id == '63':
+                raise httplib.HTTPException('Connection broke')
+            return get_user_properties(user_id)
+        client.get_user_properties = broken_get_user_properties
+        errors = {}
+        users = client.get_users_properties(['62', '63'], errors=errors)
+        assert_equal(users.keys(), ['62'])
+        assert_equal(errors.keys(), ['63'])
+        assert isinstance(errors['63'], DrupalRequestError)
+
     def test_match_organisation(self):
         drupal_config = get_mock_drupal_config()
         client = DrupalClient()
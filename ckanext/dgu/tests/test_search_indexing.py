@@ -30,3 +30,51 @@ class TestResourceFormatCleanup:
     #def test_ical(self): self.assert_format_clean('ical', 'iCal')
     def test_shapefile(self): self.assert_format_clean('shapefile', 'SHP')
     def test_sql(self): self.assert_format_clean('sql', 'Database')
+
+
+class TestIndexingBatch:
+    @classmethod
+    def setup_class(cls):
+        from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+        DguCreateTestData.create_dgu_test_data()
+
+    @classmethod
+    def teardown_class(cls):
+        from ckan import model
+        from ckanext.dgu.lib.publisher import PublisherHierarchy
+        model.repo.rebuild_db()
+        PublisherHierarchy.invalidate()
+
+    def _pkg_dict(self):
+        from ckan import model
+        pkg = model.Package.by_name(u'directgov-cota')
+        return {'id': pkg.id, 'name': pkg.name,
+                'organization': 'national-health-service',
+                'groups': ['national-health-service']}
+
+    def _index_fields(self, pkg_dict):
+        SearchIndexing.add_field__publisher(pkg_dict)
+        SearchIndexing.add_field__group_titles(pkg_dict)
+        SearchIndexing.add_field__group_abbreviation(pkg_dict)
+        return pkg_dict
+
+    def test_batch_matches_single_package(self):
+        unbatched = self._index_fields(self._pkg_dict())
+        pkg_dict = self._pkg_dict()
+        with SearchIndexing.batch([pkg_dict['id']]):
+            batched = self._index_fields(pkg_dict)
+        assert_equal(batched, unbatched)
+        assert_equal(batched['publisher'], 'national-health-service')
+        assert_equal(batched['publisher_title'], 'National Health Service')
+        assert_equal(batched['parent_publishers'],
+                     ['national-health-service', 'dept-health'])
+        assert_equal(batched['organization_titles'], ['National Health Service'])
+        assert_equal(batched['group_abbreviation'], 'NHS')
+
+    def test_package_not_in_batch(self):
+        pkg_dict = self._pkg_dict()
+        with SearchIndexing.batch(['another-id']):
+            assert not SearchIndexing._in_batch(pkg_dict)
+            self._index_fields(pkg_dict)
+        assert_equal(pkg_dict['group_abbreviation'], 'NHS')
+        assert SearchIndexing._batch is None
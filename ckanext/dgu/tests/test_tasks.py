@@ -0,0 +1,191 @@
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from nose.tools import assert_equal, assert_raises
+
+from ckan.lib.field_types import DateType
+from ckanclient import CkanApiError
+from ckanext.dgu import tasks
+from ckanext.dgu.tasks import (parse_incoming_inventory_row, find_publishers,
+                               check_incoming_inventory_row)
+
+log = logging.getLogger(__name__)
+
+PUBLISHERS = {'National Health Service': {'name': 'national-health-service'}}
+
+
+class MockCell(object):
+    def __init__(self, value):
+        self.value = value
+
+
+def cells(*values):
+    return [MockCell(value) for value in values]
+
+
+class StubClient(object):
+    '''Stands in for CkanClient - knows the PUBLISHERS, no datasets exist
+    and new ones are registered.'''
+    def __init__(self, base_location=None, api_key=None):
+        self.last_status = None
+
+    def action(self, action_name, query=None, exact=None):
+        assert_equal(action_name, 'group_search')
+        if query == 'Broken Publisher':
+            raise Exception('Connection refused')
+        if query in PUBLISHERS:
+            return {'count': 1, 'results': [PUBLISHERS[query]]}
+        return {'count': 0, 'results': []}
+
+    def package_search(self, q, search_options):
+        return {'count': 0, 'results': []}
+
+    def package_entity_get(self, pkg_name):
+        self.last_status = 404
+        raise CkanApiError('Not found')
+
+    def package_register_post(self, package):
+        if package['title'] == 'Slow dataset':
+            # finishes after the rows below it
+            time.sleep(0.1)
+        return dict(package, id='id-%s' % package['name'])
+
+
+class TestParseIncomingInventoryRow(object):
+    def test_parse(self):
+        fields = parse_incoming_inventory_row(
+            cells(u'Title', u'Description', u'Publisher', u'',
+                  u'Release notes'), log)
+        assert_equal(fields, {'title': 'Title',
+                              'description': 'Description',
+                              'publisher_name': u'Publisher',
+                              'publish_date': u'',
+                              'release_notes': u'Release notes'})
+
+    def test_unicode_is_encoded(self):
+        fields = parse_incoming_inventory_row(
+            cells(u'Caf\xe9', u'\xa3', u'Publisher', u'', u''), log)
+        assert_equal(fields['title'], 'Caf\xc3\xa9')
+        assert_equal(fields['description'], '\xc2\xa3')
+
+    def test_dates(self):
+        fields = parse_incoming_inventory_row(
+            cells(u'Title', u'Description', u'Publisher', u'1/2/14', u''), log)
+        assert_equal(fields['publish_date'], DateType.form_to_db(u'1/2/14'))
+
+        excel_date = datetime.datetime(2014, 2, 1)
+        fields = parse_incoming_inventory_row(
+            cells(u'Title', u'Description', u'Publisher', excel_date, u''),
+            log)
+        assert_equal(fields['publish_date'], DateType.date_to_db(excel_date))
+
+    def test_bad_dates(self):
+        for publish_date in (u'next spring', 41000):
+            assert_raises(Exception, parse_incoming_inventory_row,
+                          cells(u'Title', u'Description', u'Publisher',
+                                publish_date, u''),
+                          log)
+
+
+class TestFindPublishers(object):
+    def test_find_publishers(self):
+        publishers, errors = find_publishers(
+            ['National Health Service', 'Unknown', 'Broken Publisher'],
+            StubClient(), log)
+        assert_equal(publishers, PUBLISHERS)
+        assert_equal(errors['Unknown'],
+                     'Publisher does not exist in data.gov.uk: "Unknown"')
+        assert errors['Broken Publisher'].startswith(
+            'System error checking publisher'), errors
+
+
+class TestCheckIncomingInventoryRow(object):
+    def _fields(self, **kwargs):
+        fields = {'title': 'Title', 'description': 'Description',
+                  'publisher_name': 'National Health Service',
+                  'publish_date': '', 'release_notes': ''}
+        fields.update(kwargs)
+        return fields
+
+    def _error(self, fields, publisher_errors=None):
+        try:
+            check_incoming_inventory_row(fields, PUBLISHERS,
+                                         publisher_errors or {})
+        except Exception, e:
+            return str(e)
+        assert 0, 'No error'
+
+    def test_ok(self):
+        assert_equal(check_incoming_inventory_row(self._fields(), PUBLISHERS,
+                                                  {}),
+                     PUBLISHERS['National Health Service'])
+
+    def test_missing_fields(self):
+        assert_equal(self._error(self._fields(title=' ', description='',
+                                              publisher_name=None)),
+                     'The following fields were missing: Dataset title, '
+                     'Description of dataset, Owner')
+        assert_equal(self._error(self._fields(description=' ')),
+                     'The following fields were missing: '
+                     'Description of dataset')
+
+    def test_unknown_publisher(self):
+        error = 'Publisher does not exist in data.gov.uk: "Unknown"'
+        assert_equal(self._error(self._fields(publisher_name='Unknown'),
+                                 {'Unknown': error}),
+                     error)
+
+
+class TestProcessUpload(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.client_class = tasks.CkanClient
+        self.update_task_status = tasks.update_task_status
+        tasks.CkanClient = StubClient
+        self.progress = []
+        tasks.update_task_status = \
+            lambda context, data, log: self.progress.append(data['value'])
+
+    def teardown(self):
+        tasks.CkanClient = self.client_class
+        tasks.update_task_status = self.update_task_status
+        shutil.rmtree(self.dir)
+
+    def _write(self, lines):
+        filepath = os.path.join(self.dir, 'inventory.csv')
+        with open(filepath, 'wb') as f:
+            f.write('\r\n'.join(lines) + '\r\n')
+        return filepath
+
+    def test_order_of_results_and_errors(self):
+        filepath = self._write([
+            'Title,Description,Owner,Date,Release notes',
+            'Slow dataset,Desc,National Health Service,,',
+            ',Desc,National Health Service,,',
+            'Dataset B,Desc,Unknown Publisher,,',
+            'Dataset C,Desc,National Health Service,,',
+            'Dataset D,Desc,National Health Service,next spring,',
+            'Dataset E,Desc,National Health Service,,',
+            ])
+        context = {'site_url': 'http://localhost', 'apikey': 'key'}
+        data = {'file': filepath, 'publisher': 'national-health-service',
+                'jobid': 'job-id'}
+
+        errors, results = tasks._process_upload(context, data)
+
+        assert_equal(len(errors), 3, errors)
+        assert errors[0].startswith('Row 3 (): The following fields were '
+                                    'missing: Dataset title'), errors
+        assert_equal(errors[1], 'Row 4 (Dataset B): Publisher does not exist '
+                                'in data.gov.uk: "Unknown Publisher"')
+        assert errors[2].startswith('Row 6 (Dataset D): Could not parse '
+                                    'date'), errors
+        assert_equal(results,
+                     [{'package': 'id-slow-dataset', 'action': 'Added'},
+                      {'package': 'id-dataset-c', 'action': 'Added'},
+                      {'package': 'id-dataset-e', 'action': 'Added'}])
+        assert self.progress
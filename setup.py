@@ -89,6 +89,10 @@ setup(
         publisher_request_init = ckanext.dgu.commands.publisher_request_init:InitDB
         schema = ckanext.dgu.commands.schema:Schema
         user_sync = ckanext.dgu.commands.user_sync:UserSync
+        search_index_batch = ckanext.dgu.commands.search_index:SearchIndexBatch
+        publisher_scorecard = ckanext.dgu.commands.scorecard:PublisherScorecardCommand
+        auto_theme = ckanext.dgu.commands.auto_theme:AutoTheme
+        tag_browse = ckanext.dgu.commands.tag_browse:TagBrowseCommand
     """,
     test_suite = 'nose.collector',
 )